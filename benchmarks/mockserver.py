@@ -0,0 +1,236 @@
+# benchmarks/mockserver.py
+#
+# A stand-in for a Kobold server and an OpenAI-compatible completions endpoint, so the app's
+# backend code can be measured without a model. Every request waits for the configured latency,
+# generated text then arrives at the configured token rate, and a share of requests fails.
+# Tokens are words and punctuation marks, which is close enough to a real tokenizer for timing.
+#
+#   python -m benchmarks.mockserver --port 5001 --latency 0.2 --tokens-per-s 30
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.synthetic import WORDS
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+DEFAULT_MAX_CONTEXT = 8192
+# Responses are this long unless the request asks for fewer tokens
+DEFAULT_RESPONSE_TOKENS = 200
+
+def count_tokens(text):
+    return len(TOKEN_PATTERN.findall(text))
+
+
+class MockBackend:
+    # failure_rate is the share of generations and token counts answered with failure_status.
+    # 503 is retried by the app's sessions, 500 isn't. slots is how many generations run at once,
+    # the rest wait their turn as on a real server. 0 runs them all at once.
+    def __init__(self, latency=0.05, tokens_per_s=100.0, failure_rate=0.0, failure_status=500,
+                 response_tokens=DEFAULT_RESPONSE_TOKENS, max_context=DEFAULT_MAX_CONTEXT, port=0, seed=0, slots=0):
+        self.latency = latency
+        self.tokens_per_s = tokens_per_s
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.response_tokens = response_tokens
+        self.max_context = max_context
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(slots) if slots else None
+        # Generation keys Kobold was asked to abort
+        self.aborted = set()
+        self.active = 0
+        # What /api/extra/perf reports, about the last generation
+        self.perf = {'last_process': 0.0, 'last_eval': 0.0, 'last_token_count': 0, 'last_input_count': 0,
+                     'stop_reason': -1, 'queue': 0, 'idle': 1}
+        self.requests = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.backend = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mock-backend', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count_request(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def response_words(self, max_length):
+        with self.lock:
+            return self.random.choices(WORDS, k=max(1, min(max_length, self.response_tokens)))
+
+    def begin_generation(self):
+        with self.lock:
+            self.active += 1
+            self.perf['queue'] = self.active - 1
+            self.perf['idle'] = 0
+
+    def end_generation(self, prompt, tokens, process_time, eval_time):
+        with self.lock:
+            self.active -= 1
+            self.perf.update(last_process=round(process_time, 3), last_eval=round(eval_time, 3), last_token_count=tokens,
+                             last_input_count=count_tokens(prompt), queue=max(0, self.active - 1), idle=int(self.active == 0))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, like the real servers, so connection pooling is measured too
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would hold up by tens of milliseconds
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def backend(self):
+        return self.server.backend
+
+    def do_GET(self):
+        self.backend.count_request(self.path)
+        if self.path == '/api/v1/version':
+            self.send_json({'result': '1.2.6'})
+        elif self.path == '/api/v1/model':
+            self.send_json({'result': 'mock/storywriter-benchmark'})
+        elif self.path == '/api/v1/config/max_context_length':
+            self.send_json({'value': self.backend.max_context})
+        elif self.path == '/api/extra/perf':
+            with self.backend.lock:
+                self.send_json(dict(self.backend.perf))
+        elif self.path == '/v1/models':
+            self.send_json({'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}]})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        self.backend.count_request(self.path)
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            self.send_json({'error': 'invalid JSON'}, 400)
+            return
+        if self.path == '/api/extra/abort':
+            with self.backend.lock:
+                self.backend.aborted.add(data.get('genkey'))
+            self.send_json({'success': True})
+            return
+        if self.path not in ('/api/extra/tokencount', '/api/v1/generate', '/api/extra/generate/stream', '/v1/completions'):
+            self.send_json({'error': 'not found'}, 404)
+            return
+        time.sleep(self.backend.latency)
+        if self.backend.should_fail():
+            self.send_json({'error': 'mock failure'}, self.backend.failure_status)
+            return
+        if self.path == '/api/extra/tokencount':
+            self.send_json({'value': count_tokens(data.get('prompt', ''))})
+        elif self.backend.slots is None:
+            self.generate_request(data)
+        else:
+            with self.backend.slots:
+                self.generate_request(data)
+
+    def generate_request(self, data):
+        if self.path == '/v1/completions':
+            self.generate(data.get('prompt', ''), data.get('max_tokens', 16), data.get('stream', False), openai=True)
+        else:
+            self.generate(data.get('prompt', ''), data.get('max_length', 80), self.path.endswith('/stream'),
+                          genkey=data.get('genkey'))
+
+    def generate(self, prompt, max_length, stream, openai=False, genkey=None):
+        backend = self.backend
+        words = backend.response_words(max_length)
+        backend.begin_generation()
+        start = time.monotonic()
+        sent = 0
+        try:
+            if not stream:
+                time.sleep(len(words) / backend.tokens_per_s)
+                sent = len(words)
+                text = ' ' + ' '.join(words)
+                self.send_json({'choices': [{'text': text, 'index': 0, 'finish_reason': 'length'}]} if openai
+                               else {'results': [{'text': text}]})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for word in words:
+                time.sleep(1 / backend.tokens_per_s)
+                with backend.lock:
+                    if genkey is not None and genkey in backend.aborted:
+                        break
+                payload = {'choices': [{'text': ' ' + word, 'index': 0}]} if openai else {'token': ' ' + word}
+                self.send_chunk(('data: ' if openai else 'event: message\ndata: ') + json.dumps(payload) + '\n\n')
+                sent += 1
+            if openai:
+                self.send_chunk('data: [DONE]\n\n')
+            self.send_chunk('')
+        except (BrokenPipeError, ConnectionResetError):
+            # The app closed the connection, for example when a generation was cancelled
+            self.close_connection = True
+        finally:
+            backend.end_generation(prompt, sent, backend.latency, time.monotonic() - start)
+
+    def send_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a mock Kobold and OpenAI-compatible backend for benchmarking.")
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds before each response starts (default: %(default)s)")
+    parser.add_argument('--tokens-per-s', type=float, default=100.0, help="generation speed (default: %(default)s)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of requests that fail (default: %(default)s)")
+    parser.add_argument('--failure-status', type=int, default=500, help="HTTP status of failed requests (default: %(default)s)")
+    parser.add_argument('--response-tokens', type=int, default=DEFAULT_RESPONSE_TOKENS,
+                        help="tokens generated per response at most (default: %(default)s)")
+    parser.add_argument('--max-context', type=int, default=DEFAULT_MAX_CONTEXT)
+    parser.add_argument('--slots', type=int, default=0, help="generations served at once, 0 for no limit (default: %(default)s)")
+    args = parser.parse_args(argv)
+    backend = MockBackend(args.latency, args.tokens_per_s, args.failure_rate, args.failure_status, args.response_tokens,
+                          args.max_context, args.port, slots=args.slots)
+    print(f"Kobold API at {backend.address}, OpenAI API at {backend.address}/v1")
+    try:
+        backend.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
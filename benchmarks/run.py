@@ -0,0 +1,381 @@
+# benchmarks/run.py
+#
+# Times the parts of the app that grow with the story or wait on backends: prompt assembly, saving,
+# loading and exporting synthetic stories of several sizes, token count throughput and end-to-end
+# scene generation against the mock backend in mockserver.py. Results are written to
+# benchmarks/results and compared with the previous run, so a change can be checked for regressions.
+#
+#   python -m benchmarks.run --sizes 10 100 1000
+#
+# The token count and generation benchmarks go through the same tasks and executor as the editor,
+# so they need PyQt5 and requests; without them only the story benchmarks run.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.mockserver import MockBackend
+from benchmarks.synthetic import make_story, make_paragraphs
+from src.export import snapshot_story, export_story
+from src.prompt import new_prompt_plan, add_scene_prompt
+from src.storyjournal import StoryJournal
+from src.sceneindex import SceneIndex
+from src.storymodel import save_story, load_story
+from src.tokencache import TokenCountCache
+from src.generationcache import GenerationCache
+
+try:
+    from src.executor import TaskExecutor
+    from src.llm import LLMManager, CountTask, GenerateTask, is_generation_error
+    from src.llm_base import LLMBase
+    from src.telemetry import Telemetry, GENERATE, mean
+except ImportError as e:
+    LLMManager = None
+    BACKEND_IMPORT_ERROR = str(e)
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+DEFAULT_SIZES = [10, 100, 1000]
+# Prompts built per story, spread evenly over its chapters
+PROMPTS_PER_STORY = 50
+MAX_LENGTH = 512
+# A change smaller than this share of the previous time is noise
+NOTABLE_CHANGE = 0.1
+
+# Runs fn repeat times and returns the fastest and the mean time, the fastest is the least noisy
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'mean': sum(times) / len(times)}
+
+def bench_prompts(results, name, story, repeat, llm=None):
+    positions = [(chapter_index, len(story.chapters[chapter_index].scenes) - 1)
+                 for chapter_index in range(0, len(story.chapters), max(1, len(story.chapters) // PROMPTS_PER_STORY))]
+
+    def build():
+        for chapter_index, scene_index in positions:
+            plan = add_scene_prompt(new_prompt_plan(story), story, chapter_index, scene_index)
+            if llm is not None:
+                plan.build(llm, MAX_LENGTH)
+            else:
+                plan.render()
+
+    # The first build indexes every scene for passage retrieval, later ones only check for changes
+    story.scene_index = SceneIndex()
+    results[f"{name}/prompt_first"] = dict(timed(build, 1), prompts=len(positions))
+    results[f"{name}/prompt"] = dict(timed(build, repeat), prompts=len(positions))
+
+def bench_storage(results, name, story, directory, repeat):
+    json_path = os.path.join(directory, 'story.json')
+    pack_path = os.path.join(directory, 'story.story')
+    results[f"{name}/save_json"] = timed(lambda: save_story(story, json_path), repeat)
+    results[f"{name}/save_pack"] = timed(lambda: save_story(story, pack_path), repeat)
+    results[f"{name}/load_json"] = timed(lambda: load_story(json_path), repeat)
+    # Pack files read scene texts when they're needed, so opening one and reading it all are timed apart
+    results[f"{name}/load_pack"] = timed(lambda: load_story(pack_path), repeat)
+    results[f"{name}/load_pack_texts"] = timed(
+        lambda: [scene.text for chapter in load_story(pack_path).chapters for scene in chapter.scenes], repeat)
+
+    # What a save after editing one scene costs once the story has a journal
+    loaded = load_story(pack_path)
+    journal = StoryJournal(loaded, pack_path, loaded=True)
+    scene = loaded.chapters[-1].scenes[-1]
+
+    def edit_and_save():
+        scene.text += " More."
+        journal.flush()
+    results[f"{name}/journal_save"] = timed(edit_and_save, repeat)
+
+    for extension in ('.txt', '.md', '.epub'):
+        path = os.path.join(directory, 'export' + extension)
+        results[f"{name}/export_{extension[1:]}"] = timed(lambda: export_story(snapshot_story(loaded), path), repeat)
+    results[f"{name}/size_json"] = {'bytes': os.path.getsize(json_path)}
+    results[f"{name}/size_pack"] = {'bytes': os.path.getsize(pack_path)}
+
+
+# Receives one task's result and tells the run when every task has answered
+class Latch:
+    def __init__(self, count):
+        self.remaining = count
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if count == 0:
+            self.done.set()
+
+    def countDown(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.done.set()
+
+
+class CountResult:
+    def __init__(self, latch):
+        self.latch = latch
+        self.count = None
+
+    def onTokensCounted(self, count):
+        self.count = count
+        self.latch.countDown()
+
+
+# Samples how many threads the app has while a benchmark runs. The mock backend's threads don't count.
+class ThreadPeak:
+    def __init__(self):
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='thread-peak', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(0.005):
+            self.peak = max(self.peak, sum(1 for thread in threading.enumerate() if not is_benchmark_thread(thread)))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+def is_benchmark_thread(thread):
+    return thread.name in ('thread-peak', 'mock-backend') or 'process_request_thread' in thread.name
+
+
+class GenerationResult:
+    def __init__(self, latch):
+        self.latch = latch
+        self.start = time.monotonic()
+        self.first_token = None
+        self.text = None
+
+    def onResponseGenerated(self, response, partial):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+        if not partial:
+            self.text = response
+            self.latch.countDown()
+
+
+# sync runs the backend's tasks on threads even where it could run them on the event loop
+def new_llm(config, sync):
+    llm = LLMBase.create_llm(config)
+    if sync:
+        llm.supports_async = False
+    llm.test_connection()
+    return llm
+
+
+def new_manager(llm, directory, count_concurrency):
+    manager = LLMManager()
+    manager.llms = [llm]
+    manager.token_count_llm_name = llm.name
+    manager.count_concurrency = count_concurrency
+    manager.token_cache = TokenCountCache(os.path.join(directory, 'token_cache.json'))
+    manager.generation_cache = GenerationCache(os.path.join(directory, 'generation_cache'))
+    # Kept in memory only, the run reads its averages
+    manager.telemetry = Telemetry(path=None)
+    return manager
+
+def bench_counts(results, backend, directory, count, timeout, sync):
+    texts = make_paragraphs(count)
+    for concurrency in (1, 4, 16):
+        llm = new_llm({'type': 'Kobold', 'name': 'mock', 'address': backend.address}, sync)
+        manager = new_manager(llm, directory, concurrency)
+        executor = TaskExecutor(manager)
+        for phase in ('cold', 'cached'):
+            latch = Latch(len(texts))
+            threads = ThreadPeak()
+            start = time.perf_counter()
+            for text in texts:
+                executor.addTask(CountTask(text, CountResult(latch)))
+            latch.done.wait(timeout)
+            elapsed = time.perf_counter() - start
+            results[f"count/concurrency{concurrency}_{phase}"] = {
+                'seconds': elapsed, 'texts': count, 'texts_per_s': count / elapsed if elapsed else None,
+                'unfinished': latch.remaining, 'threads': threads.stop()}
+        llm.close()
+
+# Sources hear of a response before it's measured and stored
+def wait_for_records(manager, llm, count):
+    deadline = time.monotonic() + 5
+    while len(manager.telemetry.records(llm.name, GENERATE)) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return manager.telemetry.records(llm.name, GENERATE)
+
+def bench_generation(results, backend, story, directory, args):
+    positions = [(chapter_index, len(chapter.scenes) - 1) for chapter_index, chapter in enumerate(story.chapters)][:args.generations]
+    configs = [('kobold_stream', 'Kobold', True), ('kobold', 'Kobold', False), ('openai_stream', 'OpenAI', True)]
+    for label, llm_type, stream in configs:
+        for concurrency in (1, 4):
+            address = backend.address + ('/v1' if llm_type == 'OpenAI' else '')
+            llm = new_llm({'type': llm_type, 'name': label, 'address': address, 'stream': stream,
+                           'max_concurrency': concurrency, 'max_context': backend.max_context}, args.sync)
+            manager = new_manager(llm, directory, 1)
+            executor = TaskExecutor(manager)
+            latch = Latch(len(positions))
+            sources = []
+            threads = ThreadPeak()
+            start = time.perf_counter()
+            for chapter_index, scene_index in positions:
+                source = GenerationResult(latch)
+                sources.append(source)
+                plan = add_scene_prompt(new_prompt_plan(story), story, chapter_index, scene_index)
+                executor.addTask(GenerateTask(plan, source, llm, MAX_LENGTH))
+            latch.done.wait(args.timeout)
+            elapsed = time.perf_counter() - start
+            records = wait_for_records(manager, llm, len(positions))
+            results[f"generate/{label}_concurrency{concurrency}"] = {
+                'seconds': elapsed, 'generations': len(positions),
+                'failed': sum(1 for source in sources if source.text is None or is_generation_error(source.text)),
+                'latency': mean(record['latency'] for record in records),
+                'first_token': mean(record.get('first_token') for record in records),
+                'queue_wait': mean(record['queue_wait'] for record in records),
+                'tokens_per_s': mean(record.get('tokens_per_s') for record in records),
+                'threads': threads.stop()}
+            llm.close()
+
+
+# The same generations on pools of one and more single-slot backends, each member running one at a time
+def bench_pool(results, story, directory, args):
+    positions = [(chapter_index, len(chapter.scenes) - 1) for chapter_index, chapter in enumerate(story.chapters)][:args.generations]
+    for size in sorted({1, args.pool_members}):
+        backends = [MockBackend(args.latency, args.tokens_per_s, args.failure_rate, response_tokens=args.response_tokens,
+                                seed=index, slots=1).start() for index in range(size)]
+        try:
+            llm = new_llm({'type': 'Pool', 'name': f"pool{size}", 'addresses': [backend.address for backend in backends],
+                           'max_concurrency': 1, 'max_context': backends[0].max_context}, args.sync)
+            manager = new_manager(llm, directory, 1)
+            executor = TaskExecutor(manager)
+            latch = Latch(len(positions))
+            sources = []
+            start = time.perf_counter()
+            for chapter_index, scene_index in positions:
+                source = GenerationResult(latch)
+                sources.append(source)
+                plan = add_scene_prompt(new_prompt_plan(story), story, chapter_index, scene_index)
+                executor.addTask(GenerateTask(plan, source, llm, MAX_LENGTH))
+            latch.done.wait(args.timeout)
+            elapsed = time.perf_counter() - start
+            wait_for_records(manager, llm, len(positions))
+            results[f"generate/pool{size}"] = {
+                'seconds': elapsed, 'generations': len(positions),
+                'failed': sum(1 for source in sources if source.text is None or is_generation_error(source.text)),
+                'per_member': [backend.requests.get('/api/extra/generate/stream', 0) for backend in backends]}
+            llm.close()
+        finally:
+            for backend in backends:
+                backend.stop()
+
+
+def latest_results():
+    try:
+        names = sorted(name for name in os.listdir(RESULTS_DIR) if name.endswith('.json'))
+    except FileNotFoundError:
+        return None
+    return os.path.join(RESULTS_DIR, names[-1]) if names else None
+
+def compare(results, previous_path):
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)['results']
+    print(f"\nCompared with {os.path.basename(previous_path)}:")
+    for name, result in results.items():
+        before = previous.get(name, {}).get('seconds')
+        if 'seconds' not in result or not before:
+            continue
+        change = (result['seconds'] - before) / before
+        note = " slower" if change > NOTABLE_CHANGE else " faster" if change < -NOTABLE_CHANGE else ""
+        print(f"  {name:45} {before:9.4f}s -> {result['seconds']:9.4f}s {change:+7.1%}{note}")
+
+def describe(result):
+    parts = []
+    for key, value in result.items():
+        if isinstance(value, float):
+            parts.append(f"{key}={value:.4f}")
+        elif value is not None:
+            parts.append(f"{key}={value}")
+    return ", ".join(parts)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Story Writer on synthetic stories and a mock backend.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="story sizes in chapters (default: %(default)s)")
+    parser.add_argument('--scenes', type=int, default=4, help="scenes per chapter (default: %(default)s)")
+    parser.add_argument('--scene-words', type=int, default=600, help="words per scene (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, help="times each story benchmark runs (default: %(default)s)")
+    parser.add_argument('--only', nargs='+', choices=['prompt', 'storage', 'count', 'generate'],
+                        default=['prompt', 'storage', 'count', 'generate'])
+    parser.add_argument('--counts', type=int, default=500, help="texts per token count benchmark (default: %(default)s)")
+    parser.add_argument('--generations', type=int, default=8, help="scenes per generation benchmark (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.02, help="mock backend latency in seconds (default: %(default)s)")
+    parser.add_argument('--tokens-per-s', type=float, default=500.0, help="mock backend generation speed (default: %(default)s)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of mock requests that fail (default: %(default)s)")
+    parser.add_argument('--response-tokens', type=int, default=100, help="tokens per mock response (default: %(default)s)")
+    parser.add_argument('--pool-members', type=int, default=3, help="mock backends in the pool benchmark (default: %(default)s)")
+    parser.add_argument('--sync', action='store_true', help="run backend tasks on threads even where aiohttp is installed")
+    parser.add_argument('--timeout', type=float, default=300.0, help="seconds to wait for a backend benchmark (default: %(default)s)")
+    parser.add_argument('--output', help="results file, defaults to a new file in benchmarks/results")
+    parser.add_argument('--compare', help="results file to compare with, defaults to the latest in benchmarks/results")
+    args = parser.parse_args(argv)
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix='storywriter-bench-')
+    backend = None
+    try:
+        stories = {}
+        for size in args.sizes:
+            start = time.perf_counter()
+            stories[size] = make_story(size, args.scenes, args.scene_words)
+            print(f"Built a story with {size} chapters in {time.perf_counter() - start:.1f}s")
+        llm = None
+        wants_backend = {'count', 'generate'} & set(args.only)
+        if LLMManager is None:
+            if wants_backend:
+                print(f"Skipping token count and generation benchmarks: {BACKEND_IMPORT_ERROR}")
+        else:
+            backend = MockBackend(args.latency, args.tokens_per_s, args.failure_rate,
+                                  response_tokens=args.response_tokens).start()
+            # Fits prompts with estimated counts, the backend isn't asked for anything
+            llm = LLMBase.create_llm({'type': 'Kobold', 'name': 'mock', 'address': backend.address, 'max_context': backend.max_context})
+
+        for size, story in stories.items():
+            name = f"{size}ch"
+            if 'prompt' in args.only:
+                bench_prompts(results, name, story, args.repeat, llm)
+            if 'storage' in args.only:
+                bench_storage(results, name, story, directory, args.repeat)
+            for key in [key for key in results if key.startswith(name + '/')]:
+                print(f"{key}: {describe(results[key])}")
+
+        if backend is not None:
+            if 'count' in args.only:
+                bench_counts(results, backend, directory, args.counts, args.timeout, args.sync)
+            if 'generate' in args.only:
+                bench_generation(results, backend, stories[min(stories)], directory, args)
+                bench_pool(results, stories[min(stories)], directory, args)
+            for key in [key for key in results if key.startswith(('count/', 'generate/'))]:
+                print(f"{key}: {describe(results[key])}")
+    finally:
+        if backend is not None:
+            backend.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    previous = args.compare or latest_results()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'time': time.time(), 'python': sys.version.split()[0], 'platform': platform.platform(),
+                   'args': vars(args), 'results': results}, f, indent=1)
+    print(f"\nResults written to {output}")
+    if previous:
+        compare(results, previous)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# benchmarks/synthetic.py
+#
+# Builds stories of any size for benchmarking. The text is random words, but it's shaped like a
+# real story: chapters of scenes with summaries and text in paragraphs, chapter summaries, and
+# story objects whose names turn up in the scenes, so every part of prompt building has work to do.
+
+import random
+
+from src.storymodel import Story, StoryChapter, StoryScene, StoryObject
+
+WORDS = """
+the a and of to in was he she it that his her with as at on for had but they said not from
+by be have this were is one all there when into out up then so what their no would could been
+them him which more about over like now only its down back just some time after before through
+night day door hand eyes face room house road city river forest mountain ship castle tower
+garden window fire water stone iron silver gold light shadow voice letter sword map key
+walked looked turned asked told knew thought felt found left took came saw heard waited
+slowly quietly suddenly finally again still almost never always together alone away
+old young dark cold quiet long small great strange empty bright broken hidden ancient
+""".split()
+TAGS = ['character', 'place', 'item', 'faction', 'creature']
+# Rarer made-up words follow the common ones. Word frequencies fall off with rank as in real prose,
+# so searches see the long tail of rare words that makes passages tell apart.
+VOCABULARY_SIZE = 5000
+
+def make_vocabulary(rng):
+    vocabulary = list(WORDS)
+    while len(vocabulary) < VOCABULARY_SIZE:
+        letters = ('bcdfgklmnprstvw', 'aeiou', 'lnrst', 'aeiouy', 'dmnrst')[:rng.randint(3, 5)]
+        vocabulary.append(''.join(rng.choice(choices) for choices in letters))
+    weights = []
+    total = 0.0
+    for rank in range(len(vocabulary)):
+        total += 1 / (rank + 1)
+        weights.append(total)
+    return vocabulary, weights
+
+def make_name(rng):
+    return rng.choice('BCDFGHKLMNPRSTVZ') + ''.join(rng.choice(pair) for pair in ('aeiou', 'lnrst', 'aeiou', 'nrsk'))
+
+def sentence(rng, names, vocabulary):
+    words = rng.choices(vocabulary[0], cum_weights=vocabulary[1], k=rng.randint(6, 18))
+    if names and rng.random() < 0.3:
+        words[rng.randrange(len(words))] = rng.choice(names)
+    return ' '.join(words).capitalize() + '.'
+
+def paragraph(rng, names, vocabulary, sentences):
+    return ' '.join(sentence(rng, names, vocabulary) for _ in range(sentences))
+
+def scene_text(rng, names, vocabulary, words):
+    paragraphs = []
+    length = 0
+    while length < words:
+        text = paragraph(rng, names, vocabulary, rng.randint(2, 6))
+        paragraphs.append(text)
+        length += text.count(' ') + 1
+    return '\n'.join(paragraphs)
+
+# Scene text, summaries and token counts are filled in; token counts are left unknown when
+# known_tokens is False, so prompt building has to estimate or count them.
+def make_story(chapters, scenes_per_chapter=4, scene_words=600, objects=40, seed=0, known_tokens=True):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    story = Story()
+    story.title = "Benchmark story with " + str(chapters) + " chapters"
+    story.genre = "Fantasy"
+    story.summary = paragraph(rng, [], vocabulary, 8)
+    names = []
+    for _ in range(objects):
+        name = make_name(rng)
+        names.append(name)
+        story.story_objects.append(StoryObject(name, rng.choice(TAGS), sentence(rng, [], vocabulary), paragraph(rng, [], vocabulary, 3)))
+    story.apply_settings({'story_objects': [obj.to_dict() for obj in story.story_objects]})
+    for chapter_index in range(chapters):
+        chapter = StoryChapter(f"Chapter {chapter_index + 1}")
+        if chapter_index > 0:
+            chapter.summary = paragraph(rng, names, vocabulary, 10)
+        for _ in range(scenes_per_chapter):
+            scene = StoryScene(paragraph(rng, names, vocabulary, 3), scene_text(rng, names, vocabulary, scene_words))
+            if known_tokens:
+                scene.summary_tokens = int(len(scene.summary) / 4)
+                scene.text_tokens = int(len(scene.text) / 4)
+            chapter.scenes.append(scene)
+        if known_tokens:
+            chapter.summary_tokens = int(len(chapter.summary) / 4)
+        story.chapters.append(chapter)
+    return story
+
+# Distinct paragraphs, the kind of text the editor sends for token counts
+def make_paragraphs(count, seed=0):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    return [f"{index}. " + paragraph(rng, [], vocabulary, rng.randint(2, 6)) for index in range(count)]
@@ -0,0 +1,45 @@
+# src/asyncloop.py
+#
+# One asyncio event loop on its own thread, shared by every backend that can talk asynchronously.
+# A request waiting on the network then costs a coroutine instead of a whole thread, so dozens of
+# counts and generations can be in flight across backends at once. Tasks run here hand their results
+# to their sources just like tasks run on lane threads, and the sources pass them on to the GUI
+# through Qt signals.
+
+import asyncio
+import threading
+
+class EventLoopThread:
+    def __init__(self, name='event-loop'):
+        self.name = name
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # Starts the loop the first time it's needed, returns it
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True)
+                self.thread.start()
+            return self.loop
+
+    # Calls fn(*args) on the loop's thread, from any thread
+    def call(self, fn, *args):
+        self.start().call_soon_threadsafe(fn, *args)
+
+    # Runs a coroutine on the loop from any thread, returns a concurrent.futures.Future of its result
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start())
+
+    # Runs a coroutine on the loop and waits for its result, for code that isn't async itself
+    def run(self, coroutine, timeout=None):
+        return self.submit(coroutine).result(timeout)
+
+
+shared_loop = EventLoopThread()
+
+# The loop that asynchronous tasks and backend sessions run on
+def event_loop():
+    return shared_loop
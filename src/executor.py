@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import queue
+import threading
+import time
+import traceback
+import weakref
+
+from src.asyncloop import event_loop
+
+# Every backend gets its own lanes so that a slow generation on one endpoint
+# never holds up token counts, or generations on another endpoint
+COUNT_LANE = 'count'
+GENERATE_LANE = 'generate'
+# Story saves run in order on a single thread that isn't tied to any backend
+SAVE_LANE = 'save'
+
+# Within a lane, tasks run in order of priority and then in the order they were added.
+# A task's priority attribute defaults to PRIORITY_VISIBLE.
+PRIORITY_INTERACTIVE = 0    # what the user just asked for, such as clicking Generate
+PRIORITY_VISIBLE = 1        # keeping what's on screen up to date
+PRIORITY_BACKGROUND = 2     # everything else
+
+# Lane threads exit after being idle this many seconds and are restarted on demand
+IDLE_TIMEOUT = 30
+
+class TaskLane:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.tasks = queue.PriorityQueue()
+        # Keeps tasks of the same priority in order, and tasks themselves from ever being compared
+        self.counter = itertools.count()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def put(self, task):
+        # For measuring how long the task waited, see telemetry.py
+        task.queued_at = time.monotonic()
+        self.tasks.put((getattr(task, 'priority', PRIORITY_VISIBLE), next(self.counter), task))
+        with self.lock:
+            if len(self.threads) < self.concurrency:
+                thread = threading.Thread(target=self.run, name=f"{self.name}-{len(self.threads)}", daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+    def run(self):
+        while True:
+            try:
+                _, _, task = self.tasks.get(timeout=IDLE_TIMEOUT)
+            except queue.Empty:
+                with self.lock:
+                    # put() adds the task before taking the lock, so an empty queue
+                    # here means nobody is relying on this thread
+                    if self.tasks.empty():
+                        self.threads.remove(threading.current_thread())
+                        return
+                continue
+            if getattr(task, 'superseded', False):
+                continue
+            try:
+                task.execute()
+            except Exception:
+                print("task failed:", traceback.format_exc())
+
+    def pending(self):
+        return self.tasks.qsize()
+
+
+# Runs a backend's tasks as coroutines on the shared event loop, for backends that talk asynchronously.
+# Tasks are taken in the same order as in TaskLane, by up to concurrency workers that are coroutines
+# instead of threads. Tasks without an aexecute coroutine run their execute on the loop's thread pool.
+class AsyncTaskLane:
+    def __init__(self, name, concurrency, loop):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.loop = loop
+        # Only touched on the loop's thread, so a plain heap does
+        self.tasks = []
+        self.counter = itertools.count()
+        self.workers = 0
+
+    def put(self, task):
+        task.queued_at = time.monotonic()
+        self.loop.call(self.enqueue, (getattr(task, 'priority', PRIORITY_VISIBLE), next(self.counter), task))
+
+    def enqueue(self, item):
+        heapq.heappush(self.tasks, item)
+        if self.workers < self.concurrency:
+            self.workers += 1
+            asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while self.tasks:
+            _, _, task = heapq.heappop(self.tasks)
+            if getattr(task, 'superseded', False):
+                continue
+            if hasattr(task, 'aexecute'):
+                coroutine = task.aexecute()
+            else:
+                coroutine = asyncio.get_running_loop().run_in_executor(None, task.execute)
+            # Each task runs as an asyncio task of its own, so cancelling its requests never stops this worker
+            running = asyncio.ensure_future(coroutine)
+            await asyncio.wait([running])
+            if not running.cancelled() and running.exception() is not None:
+                error = running.exception()
+                print("task failed:", "".join(traceback.format_exception(type(error), error, error.__traceback__)))
+        self.workers -= 1
+
+    def pending(self):
+        return len(self.tasks)
+
+
+class TaskExecutor:
+    def __init__(self, llm_manager):
+        self.llm_manager = llm_manager
+        self.lanes = {}
+        self.lock = threading.Lock()
+        # Target -> the last task added for it, see addTask
+        self.latest = weakref.WeakKeyDictionary()
+
+    def addTask(self, task):
+        # A task's target is whatever its result is shown in. A newer task for the same target makes
+        # the older one pointless, so it's skipped if it hasn't started yet and its result is dropped if it has.
+        target = getattr(task, 'target', None)
+        if target is not None:
+            with self.lock:
+                previous = self.latest.get(target)
+                self.latest[target] = task
+            if previous is not None:
+                previous.superseded = True
+        if task.lane == COUNT_LANE:
+            # Count tasks created without a backend use the configured token counting LLM
+            if task.llm_backend is None:
+                task.llm_backend = self.llm_manager.get_token_count_llm()
+            # Text that has been counted before never leaves the GUI thread
+            task.token_cache = self.llm_manager.token_cache
+            if task.lookupCache(task.token_cache):
+                return
+        elif task.lane == GENERATE_LANE and hasattr(task, 'generation_cache'):
+            # Generations are recorded, and answered from earlier ones when replay is turned on
+            task.generation_cache = self.llm_manager.generation_cache
+            task.replay = self.llm_manager.replay_generations
+        # Calls to backends are measured, see telemetry.py
+        if hasattr(task, 'telemetry'):
+            task.telemetry = self.llm_manager.telemetry
+        self.get_lane(task.llm_backend, task.lane).put(task)
+
+    # Drops the results of the tasks added for target so far, for when it stops showing what they were for
+    def supersede(self, target):
+        with self.lock:
+            previous = self.latest.pop(target, None)
+        if previous is not None:
+            previous.superseded = True
+
+    def get_lane(self, llm, lane):
+        key = (id(llm), lane)
+        with self.lock:
+            task_lane = self.lanes.get(key)
+            # Lanes are keyed by backend object, so LLMs recreated by the settings dialog get fresh lanes
+            if task_lane is None or task_lane.llm is not llm:
+                name = f"{llm.name if llm else 'none'}-{lane}"
+                concurrency = self.llm_manager.get_concurrency(llm, lane)
+                # Saves stay on a thread of their own, they're file I/O that asyncio can't wait on
+                if llm is not None and llm.supports_async and lane != SAVE_LANE:
+                    task_lane = AsyncTaskLane(name, concurrency, event_loop())
+                else:
+                    task_lane = TaskLane(name, concurrency)
+                task_lane.llm = llm
+                self.lanes[key] = task_lane
+            return task_lane
+
+    def pending(self):
+        with self.lock:
+            return sum(lane.pending() for lane in self.lanes.values())
@@ -0,0 +1,221 @@
+# src/export.py
+#
+# Exports a story as plain text, Markdown or EPUB. The story is walked as a stream of chapter
+# and scene events that a writer turns into output as they arrive, so only one scene's text is
+# in memory at a time and the output is written out in buffered chunks.
+
+import html
+import os
+import time
+import uuid
+import zipfile
+
+from src.executor import SAVE_LANE
+from src.fileutil import atomic_open
+
+# Output is buffered and handed to the file in chunks of this size
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+# The chapters and scenes to export, taken on the GUI thread so edits made while exporting
+# don't change the story's structure under the export. Scene texts are read as they're written.
+def snapshot_story(story):
+    return story.title, [(chapter.title, list(chapter.scenes)) for chapter in story.chapters]
+
+# Yields ('chapter', title) and ('scene', text) events, reading each scene's text only when it's reached
+def iter_story(chapters):
+    for chapter_title, scenes in chapters:
+        yield 'chapter', chapter_title
+        for scene in scenes:
+            yield 'scene', scene.read_text()
+
+def paragraphs(text):
+    return [paragraph.strip() for paragraph in text.split('\n') if paragraph.strip()]
+
+
+class TextWriter:
+    extension = '.txt'
+    name = 'Plain text'
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        return atomic_open(self.path, 'w', EXPORT_BUFFER_SIZE)
+
+    def begin(self, f, title):
+        f.write(title)
+        f.write("\n\n")
+
+    def chapter(self, f, title):
+        f.write(title)
+        f.write("\n")
+        f.write("="*len(title))
+        f.write("\n\n")
+
+    def scene(self, f, text, first):
+        f.write(text)
+        f.write("\n\n")
+
+    def end(self, f):
+        pass
+
+
+class MarkdownWriter(TextWriter):
+    extension = '.md'
+    name = 'Markdown'
+
+    def begin(self, f, title):
+        f.write(f"# {title}\n\n")
+
+    def chapter(self, f, title):
+        f.write(f"## {title}\n\n")
+
+    def scene(self, f, text, first):
+        if not first:
+            f.write("* * *\n\n")
+        for paragraph in paragraphs(text):
+            f.write(paragraph)
+            f.write("\n\n")
+
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+XHTML_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>{title}</title></head>
+<body>
+"""
+
+# Each chapter becomes its own XHTML file in the zip, written while its scenes stream in.
+# The package document and table of contents list every chapter, so they're written last.
+class EpubWriter:
+    extension = '.epub'
+    name = 'EPUB'
+
+    def __init__(self, path):
+        self.path = path
+        self.chapters = []
+        self.current = None
+
+    def open(self):
+        return atomic_open(self.path, 'wb', EXPORT_BUFFER_SIZE)
+
+    def begin(self, f, title):
+        self.title = title or "Untitled"
+        self.zip = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        # The mimetype has to come first and uncompressed
+        self.zip.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml', EPUB_CONTAINER)
+
+    def chapter(self, f, title):
+        self.closeChapter()
+        name = f"chapter-{len(self.chapters) + 1:04d}.xhtml"
+        self.chapters.append((name, title or f"Chapter {len(self.chapters) + 1}"))
+        self.current = self.zip.open('OEBPS/' + name, 'w')
+        self.write(XHTML_HEAD.format(title=html.escape(self.chapters[-1][1])))
+        self.write(f"<h1>{html.escape(self.chapters[-1][1])}</h1>\n")
+
+    def scene(self, f, text, first):
+        if not first:
+            self.write("<hr/>\n")
+        for paragraph in paragraphs(text):
+            self.write(f"<p>{html.escape(paragraph)}</p>\n")
+
+    def write(self, text):
+        self.current.write(text.encode('utf-8'))
+
+    def closeChapter(self):
+        if self.current is not None:
+            self.write("</body>\n</html>\n")
+            self.current.close()
+            self.current = None
+
+    def end(self, f):
+        self.closeChapter()
+        self.zip.writestr('OEBPS/nav.xhtml', self.navigation())
+        self.zip.writestr('OEBPS/content.opf', self.package())
+        self.zip.close()
+
+    def navigation(self):
+        items = "".join(f'      <li><a href="{name}">{html.escape(title)}</a></li>\n' for name, title in self.chapters)
+        return (XHTML_HEAD.format(title=html.escape(self.title))
+                + f'<nav epub:type="toc" id="toc">\n  <h1>{html.escape(self.title)}</h1>\n  <ol>\n{items}  </ol>\n</nav>\n</body>\n</html>\n')
+
+    def package(self):
+        manifest = "".join(f'    <item id="c{i}" href="{name}" media-type="application/xhtml+xml"/>\n'
+                           for i, (name, _) in enumerate(self.chapters))
+        spine = "".join(f'    <itemref idref="c{i}"/>\n' for i in range(len(self.chapters)))
+        modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">urn:uuid:{uuid.uuid4()}</dc:identifier>
+    <dc:title>{html.escape(self.title)}</dc:title>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{manifest}  </manifest>
+  <spine>
+{spine}  </spine>
+</package>
+"""
+
+
+EXPORT_WRITERS = {writer.extension: writer for writer in (TextWriter, MarkdownWriter, EpubWriter)}
+
+def writer_for_path(path):
+    writer = EXPORT_WRITERS.get(os.path.splitext(path)[1].lower())
+    if writer is None:
+        raise ValueError(f"Don't know how to export to {path}")
+    return writer(path)
+
+# Writes the story to path in the format its extension names. progress(done, total) is called
+# after each scene.
+def export_story(snapshot, path, progress=None):
+    title, chapters = snapshot
+    total = sum(len(scenes) for _, scenes in chapters)
+    done = 0
+    writer = writer_for_path(path)
+    with writer.open() as f:
+        writer.begin(f, title)
+        first = False
+        for kind, value in iter_story(chapters):
+            if kind == 'chapter':
+                writer.chapter(f, value)
+                first = True
+                continue
+            writer.scene(f, value, first)
+            first = False
+            done += 1
+            if progress is not None:
+                progress(done, total)
+        writer.end(f)
+
+
+# Runs an export on the save lane, so it never overlaps a save rewriting the file scene texts are read from.
+# source.onExportProgress(done, total) and source.onExportFinished(path, error) are called from that thread.
+class ExportTask:
+    lane = SAVE_LANE
+
+    def __init__(self, snapshot, path, source):
+        self.snapshot = snapshot
+        self.path = path
+        self.source = source
+        self.llm_backend = None
+
+    def execute(self):
+        try:
+            export_story(self.snapshot, self.path, self.source.onExportProgress)
+        except Exception as e:
+            self.source.onExportFinished(self.path, str(e))
+            return
+        self.source.onExportFinished(self.path, '')
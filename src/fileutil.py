@@ -0,0 +1,28 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Writes to a temporary file next to the target and renames it into place,
+# so a crash mid-write never leaves a truncated file behind
+def atomic_write(path, data, mode='w'):
+    with atomic_open(path, mode) as f:
+        f.write(data)
+
+# The same for files written piece by piece, the file only appears at path once the block completes
+@contextmanager
+def atomic_open(path, mode='w', buffering=-1):
+    path = os.path.abspath(path)
+    directory, basename = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + basename + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, buffering, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,127 @@
+# src/generationcache.py
+#
+# Remembers what backends generated for each prompt, so text that was already generated once doesn't
+# cost another generation: after an accidental second click, a restart, or to go back to an earlier
+# version of a scene. Responses are keyed by backend and model, generation settings and prompt, and
+# the last few distinct responses of each key are kept. Every response is its own zlib-compressed
+# file, listed in an index that keeps the keys least recently used first; the oldest keys are dropped
+# once the files take up more than the size limit.
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from src.fileutil import atomic_write
+
+GENERATION_CACHE_DIR = 'generation_cache'
+INDEX_FILE = 'index.json'
+RESPONSE_SUFFIX = '.z'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Distinct responses kept per prompt, the oldest is dropped first
+MAX_ALTERNATIVES = 10
+
+class GenerationCache:
+    def __init__(self, path=GENERATION_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Key -> [[file name, compressed size, time generated], ...] oldest response first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(llm, prompt, max_length):
+        digest = hashlib.sha1()
+        for part in (llm.generation_identity(), str(max_length), prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    # Returns [(time generated, response)] for the prompt, oldest first
+    def get(self, llm, prompt, max_length):
+        if llm is None:
+            return []
+        key = self.make_key(llm, prompt, max_length)
+        with self.lock:
+            responses = list(self.entries.get(key, ()))
+            if responses:
+                self.entries.move_to_end(key)
+        result = []
+        for name, size, generated in responses:
+            text = self.read(name)
+            # The file may have been evicted meanwhile
+            if text is not None:
+                result.append((generated, text))
+        return result
+
+    def put(self, llm, prompt, max_length, response):
+        if llm is None:
+            return
+        key = self.make_key(llm, prompt, max_length)
+        data = zlib.compress(response.encode('utf-8'))
+        # Named after the key and the response, so generating the same text again doesn't add a file
+        name = hashlib.sha1((key + '\0' + response).encode('utf-8')).hexdigest() + RESPONSE_SUFFIX
+        os.makedirs(self.path, exist_ok=True)
+        atomic_write(os.path.join(self.path, name), data, 'wb')
+        removed = []
+        with self.lock:
+            responses = self.entries.setdefault(key, [])
+            for entry in responses:
+                if entry[0] == name:
+                    responses.remove(entry)
+                    self.total_bytes -= entry[1]
+                    break
+            responses.append([name, len(data), time.time()])
+            self.total_bytes += len(data)
+            self.entries.move_to_end(key)
+            while len(responses) > MAX_ALTERNATIVES:
+                removed.append(responses.pop(0))
+                self.total_bytes -= removed[-1][1]
+            # The key just used is the most recent one, so it's never evicted here
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                for entry in self.entries.popitem(last=False)[1]:
+                    removed.append(entry)
+                    self.total_bytes -= entry[1]
+        for entry in removed:
+            self.remove_file(entry[0])
+        self.save()
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                return zlib.decompress(f.read()).decode('utf-8')
+        except (OSError, zlib.error):
+            return None
+
+    def remove_file(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def load(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        with self.lock:
+            self.entries = OrderedDict((key, responses) for key, responses in data.get('entries', []))
+            self.total_bytes = sum(entry[1] for responses in self.entries.values() for entry in responses)
+            known = {entry[0] for responses in self.entries.values() for entry in responses}
+        # Files the index lost track of, for example when another process saved it last, would never be evicted
+        for name in os.listdir(self.path):
+            if name.endswith(RESPONSE_SUFFIX) and name not in known:
+                self.remove_file(name)
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                # Stored least recently used first so the order survives a restart
+                data = json.dumps({'version': 1, 'entries': list(self.entries.items())})
+            atomic_write(os.path.join(self.path, INDEX_FILE), data)
@@ -0,0 +1,52 @@
+# src/generationhistorydialog.py
+
+import time
+
+from PyQt5.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QTextEdit, QListWidget, QListWidgetItem, QSplitter
+)
+from PyQt5.QtCore import Qt
+
+# Lists earlier responses to a prompt, newest first, so one of them can be used instead of generating again.
+# responses are (time generated, LLM name, text).
+class GenerationHistoryDialog(QDialog):
+    def __init__(self, parent, responses):
+        super().__init__(parent)
+        self.setWindowTitle("Previous Generations")
+        self.resize(800, 500)
+
+        self.layout = QVBoxLayout(self)
+        splitter = QSplitter(Qt.Horizontal)
+        self.layout.addWidget(splitter)
+
+        self.response_list = QListWidget()
+        splitter.addWidget(self.response_list)
+        self.preview = QTextEdit()
+        self.preview.setReadOnly(True)
+        splitter.addWidget(self.preview)
+        splitter.setSizes([250, 550])
+
+        for generated, llm_name, text in responses:
+            item = QListWidgetItem(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(generated))} - {llm_name}")
+            item.setData(Qt.UserRole, text)
+            self.response_list.addItem(item)
+        self.response_list.currentItemChanged.connect(self.display_response)
+        self.response_list.itemDoubleClicked.connect(self.accept)
+
+        button_layout = QHBoxLayout()
+        use_button = QPushButton("Use")
+        use_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        button_layout.addWidget(use_button)
+        button_layout.addWidget(cancel_button)
+        self.layout.addLayout(button_layout)
+
+        self.response_list.setCurrentRow(0)
+
+    def display_response(self, current, previous):
+        self.preview.setPlainText(current.data(Qt.UserRole) if current else "")
+
+    def selected_text(self):
+        current = self.response_list.currentItem()
+        return current.data(Qt.UserRole) if current else None
@@ -0,0 +1,278 @@
+# src/httpsession.py
+
+import asyncio
+import contextlib
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Backends talk asynchronously when aiohttp is installed, see AsyncBackendSession
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+CONNECT_TIMEOUT = 5
+# Generations can legitimately take minutes, while streaming this is the longest gap between tokens
+READ_TIMEOUT = 600
+# Connection tests should fail fast so an unreachable backend doesn't hold anything up
+TEST_TIMEOUT = (2, 5)
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+# Statuses that mean the request wasn't processed, so it's safe to send again
+RETRY_STATUSES = (429, 502, 503, 504)
+
+ASYNC_AVAILABLE = aiohttp is not None
+# What an asynchronous request raises when it fails, like requests.RequestException for the blocking ones
+ASYNC_REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp is not None else ()
+
+class RequestCancelled(Exception):
+    pass
+
+# Handed to a request so it can be aborted from another thread. Cancelling closes the
+# response, which aborts a stream mid-read; a blocking request returns and is then discarded.
+# Callbacks can tell the backend to stop generating as well.
+class CancelToken:
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.responses = []
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            responses = self.responses
+            self.responses = []
+            callbacks = self.callbacks
+            self.callbacks = []
+        for response in responses:
+            response.close()
+        for callback in callbacks:
+            callback()
+
+    # callback is called once, on the cancelling thread, when the token is cancelled. Right away if it already is.
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.cancelled.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise RequestCancelled()
+
+    def register(self, response):
+        with self.lock:
+            self.responses.append(response)
+        if self.cancelled.is_set():
+            self.cancel()
+
+    def unregister(self, response):
+        with self.lock:
+            if response in self.responses:
+                self.responses.remove(response)
+
+
+# One pooled keep-alive session per backend, with timeouts and retries on every request
+class BackendSession:
+    def __init__(self, pool_size=4, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES):
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Read errors are not retried, the backend may already be generating
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Connection tests use their own session without retries so they fail fast
+        self.probe_session = requests.Session()
+        self.probe_session.mount('http://', HTTPAdapter(max_retries=0))
+        self.probe_session.mount('https://', HTTPAdapter(max_retries=0))
+        self.tokens = set()
+        self.lock = threading.Lock()
+
+    def request(self, method, url, cancel_token=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        token = cancel_token or CancelToken()
+        token.check()
+        with self.lock:
+            self.tokens.add(token)
+        streaming = False
+        try:
+            response = self.session.request(method, url, **kwargs)
+            if token.is_cancelled():
+                response.close()
+                raise RequestCancelled()
+            # Streamed responses stay cancellable until iter_lines is done with them
+            if kwargs.get('stream') and response.status_code == 200:
+                response.cancel_token = token
+                token.register(response)
+                streaming = True
+            return response
+        finally:
+            if not streaming:
+                with self.lock:
+                    self.tokens.discard(token)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def probe(self, url, **kwargs):
+        kwargs.setdefault('timeout', TEST_TIMEOUT)
+        return self.probe_session.get(url, **kwargs)
+
+    # Iterates the lines of a streamed response, stopping when its request is cancelled
+    def iter_lines(self, response):
+        token = response.cancel_token
+        response.encoding = 'utf-8'
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                token.check()
+                yield line
+        except (requests.RequestException, AttributeError, ValueError):
+            # A response closed by cancel() fails mid-read
+            token.check()
+            raise
+        finally:
+            token.unregister(response)
+            with self.lock:
+                self.tokens.discard(token)
+            response.close()
+
+    # Cancels every request currently running on this session
+    def cancel_all(self):
+        with self.lock:
+            tokens = list(self.tokens)
+        for token in tokens:
+            token.cancel()
+
+    def close(self):
+        self.cancel_all()
+        self.session.close()
+        self.probe_session.close()
+
+
+# The asyncio counterpart of BackendSession, for requests made from the event loop in asyncloop.py.
+# Requests are retried the same way, and cancelling their token cancels the coroutine waiting on them.
+# Responses are returned with their body read, except for streams, which are read with iter_lines.
+class AsyncBackendSession:
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        # aiohttp sessions belong to the loop they're created on, so this is created on first use.
+        # Its connections aren't capped, the executor's lanes already limit how many requests run at once.
+        self.session = None
+        # Tokens of the requests in flight, only touched on the loop's thread
+        self.tokens = set()
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=0),
+                                                 timeout=client_timeout(self.timeout))
+        return self.session
+
+    # While in this block, cancelling token cancels the asyncio task running it, wherever it's waiting,
+    # and the block raises RequestCancelled
+    @contextlib.contextmanager
+    def cancellable(self, token):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        callback = lambda: loop.call_soon_threadsafe(task.cancel)
+        token.add_callback(callback)
+        try:
+            yield
+        except asyncio.CancelledError:
+            if not token.is_cancelled():
+                raise
+            # The cancellation was ours and is handled here
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+            raise RequestCancelled()
+        finally:
+            token.remove_callback(callback)
+
+    async def request(self, method, url, cancel_token=None, stream=False, **kwargs):
+        if 'timeout' in kwargs:
+            kwargs['timeout'] = client_timeout(kwargs['timeout'])
+        token = cancel_token or CancelToken()
+        token.check()
+        self.tokens.add(token)
+        streaming = False
+        try:
+            with self.cancellable(token):
+                response = await self.send(method, url, kwargs)
+                if stream and response.status == 200:
+                    response.cancel_token = token
+                    streaming = True
+                else:
+                    await response.read()
+                return response
+        finally:
+            if not streaming:
+                self.tokens.discard(token)
+
+    async def send(self, method, url, kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.get_session().request(method, url, **kwargs)
+            except aiohttp.ClientConnectorError:
+                # Nothing was sent, so it's safe to try again
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                response.release()
+            await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    # Yields the lines of a streamed response, stopping when its request is cancelled
+    async def iter_lines(self, response):
+        token = response.cancel_token
+        try:
+            with self.cancellable(token):
+                async for line in response.content:
+                    token.check()
+                    yield line.decode('utf-8').rstrip('\r\n')
+        finally:
+            self.tokens.discard(token)
+            # Closes the connection unless the whole response was read
+            response.release()
+
+    # Cancels every request still running, then closes the connections
+    async def close(self):
+        for token in list(self.tokens):
+            token.cancel()
+        # Lets the cancelled requests stop before their connections go away
+        await asyncio.sleep(0)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+# (connect, read) timeouts as requests takes them, for aiohttp
+def client_timeout(timeout):
+    if isinstance(timeout, tuple):
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    return aiohttp.ClientTimeout(total=timeout)
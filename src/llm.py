@@ -1,117 +1,481 @@
-import requests
+import asyncio
 import json
-import openai
+import threading
+import time
 
-from src.llm_kobold import LLMKobold
-from src.llm_openai import LLMOpenAI
+from src.llm_base import LLMBase, STATUS_CHECKING, STATUS_ONLINE, STATUS_OFFLINE, GENERATION_ERROR
+from src.executor import COUNT_LANE, GENERATE_LANE, PRIORITY_INTERACTIVE, PRIORITY_VISIBLE, PRIORITY_BACKGROUND
+from src.tokencache import TokenCountCache
+from src.generationcache import GenerationCache
+from src.httpsession import CancelToken, RequestCancelled
+from src.telemetry import Telemetry, GENERATE, COUNT
+from src.prompt import PromptPlan
 
-from PyQt5.QtCore import QObject
+from PyQt5.QtCore import QObject, pyqtSignal
+
+# Token counts are cheap, so several can be in flight per backend by default
+DEFAULT_COUNT_CONCURRENCY = 4
+
+class LLMManager(QObject):
+    # Emitted with the LLM whenever a connection test finishes, from the testing thread
+    llmStatusChanged = pyqtSignal(object)
+    # Emitted with each telemetry record, from the thread that made the call
+    metricsRecorded = pyqtSignal(object)
 
-class LLMManager:
     def __init__(self):
+        super(LLMManager, self).__init__()
         self.llms = []
         self.token_count_llm_name = None
+        self.count_concurrency = DEFAULT_COUNT_CONCURRENCY
+        self.token_cache = TokenCountCache()
+        self.generation_cache = GenerationCache()
+        self.telemetry = Telemetry(listener=self.metricsRecorded.emit)
+        # Whether a prompt that was generated before gets the earlier response instead of a new generation
+        self.replay_generations = False
 
     def load_llm_config(self):
+        self.token_cache.load()
+        self.generation_cache.load()
         try:
             with open('llm_config.json', 'r') as f:
                 data = json.load(f)
                 for llm_data in data.get('llms', []):
                     llm = self.create_llm(llm_data)
-                    if llm and llm.test_connection():
+                    if llm:
                         self.llms.append(llm)
                 self.token_count_llm_name = data.get('token_count_llm_name', None)
+                self.count_concurrency = data.get('count_concurrency', DEFAULT_COUNT_CONCURRENCY)
+                self.replay_generations = data.get('replay_generations', False)
         except FileNotFoundError:
             pass  # No config file yet
+        self.check_connections()
+
+    # Every backend is tested on its own thread, so startup never waits for them.
+    # Results arrive through llmStatusChanged as each test finishes.
+    def check_connections(self, llms=None):
+        for llm in (self.llms if llms is None else llms):
+            llm.status = STATUS_CHECKING
+            threading.Thread(target=self.check_connection, args=(llm,), daemon=True).start()
+
+    def check_connection(self, llm):
+        try:
+            online = llm.test_connection()
+        except Exception:
+            online = False
+        llm.status = STATUS_ONLINE if online else STATUS_OFFLINE
+        self.llmStatusChanged.emit(llm)
 
     def create_llm(self, llm_data):
-        llm_type = llm_data.get('type', 'Kobold')
-        if llm_type == 'Kobold':
-            return LLMKobold(
-                llm_data['name'],
-                llm_data.get('address', ''),
-                llm_data.get('system_prompt', '')
-            )
-        elif llm_type == 'OpenAI':
-            return LLMOpenAI(
-                llm_data['name'],
-                llm_data.get('api_key', ''),
-                llm_data.get('system_prompt', ''),
-                llm_data.get('use_env_var', False)
-            )
-        return None
+        llm_data.setdefault('type', 'Kobold')
+        try:
+            return LLMBase.create_llm(llm_data)
+        except ValueError:
+            return None
 
     def save_llm_config(self):
         data = {
-            'llms': [
-                {
-                    'name': llm.name,
-                    'system_prompt': llm.system_prompt,
-                    'type': llm.__class__.__name__,
-                    'address': getattr(llm, 'address', ''),
-                    'api_key': getattr(llm, 'api_key', ''),
-                    'use_env_var': getattr(llm, 'use_env_var', False)
-                } for llm in self.llms
-            ],
-            'token_count_llm_name': self.token_count_llm_name
+            'llms': [llm.get_config() for llm in self.llms],
+            'token_count_llm_name': self.token_count_llm_name,
+            'count_concurrency': self.count_concurrency,
+            'replay_generations': self.replay_generations
         }
         with open('llm_config.json', 'w') as f:
             json.dump(data, f)
 
+    # Before exiting: the backends' connections are closed and metrics written out
+    def close(self):
+        for llm in self.llms:
+            llm.close()
+        self.telemetry.close()
 
+    def get_token_count_llm(self):
+        for llm in self.llms:
+            if llm.name == self.token_count_llm_name:
+                return llm
+        return None
+
+    # Number of tasks of the given lane that may run against a backend at the same time
+    def get_concurrency(self, llm, lane):
+        if llm is None:
+            return 1
+        if lane == COUNT_LANE:
+            return self.count_concurrency
+        return llm.max_concurrency
+
+
+# Counts for the same target replace each other, see TaskExecutor.addTask. The target is the source unless given.
 class CountTask(QObject):
-    def __init__(self, data, source, llm_backend):
+    lane = COUNT_LANE
+
+    def __init__(self, data, source, llm_backend=None, token_cache=None, priority=PRIORITY_VISIBLE, target=None):
         super(CountTask, self).__init__()
         self.data = data
         self.source = source
         self.llm_backend = llm_backend
+        self.token_cache = token_cache
+        self.priority = priority
+        self.target = target or source
+        self.superseded = False
+        self.telemetry = None
+        self.queued_at = None
+
+    # Answers the task from the cache when possible, returns whether it still needs to run
+    def lookupCache(self, token_cache):
+        count = token_cache.get(self.llm_backend, self.data)
+        if count is None:
+            return False
+        self.source.onTokensCounted(count)
+        return True
 
     def execute(self):
-        if self.llm_backend.type == 'Kobold':
-            tokenCountUrl = f"{self.llm_backend.address}/api/extra/tokencount"
-            headers = {'Content-Type': 'application/json'}
-            response = requests.post(tokenCountUrl, headers=headers, data=json.dumps({"prompt":self.data}))
-            if response.status_code == 200:
-                response_data = json.loads(response.text)
-                self.source.onTokensCounted(response_data["value"])
-            else:
-                self.source.onTokensCounted(-1)
-        elif self.llm_backend.type == 'OpenAI':
-            # Approximate token count for OpenAI models
-            count = len(self.data.split())
+        start = time.monotonic()
+        self.counted(start, self.count())
+
+    async def aexecute(self):
+        start = time.monotonic()
+        count = await self.llm_backend.acount_tokens(self.data) if self.llm_backend is not None else -1
+        self.counted(start, count)
+
+    def counted(self, start, count):
+        self.report(start, count, 1)
+        if self.token_cache is not None:
+            self.token_cache.put(self.llm_backend, self.data, count)
+        if not self.superseded:
             self.source.onTokensCounted(count)
 
+    def report(self, start, tokens, texts):
+        if self.telemetry is None or self.llm_backend is None:
+            return
+        self.telemetry.record(self.llm_backend, COUNT, queue_wait=start - (self.queued_at or start),
+                              latency=time.monotonic() - start, tokens=tokens, texts=texts)
+
+    def count(self):
+        if self.llm_backend is None:
+            return -1
+        return self.llm_backend.count_tokens(self.data)
+
+# Counts the paragraphs of a long text separately, so an edit only costs a count of the paragraphs it touched.
+# source.onParagraphsCounted(counts, overhead) receives a paragraph -> count dict and the backend's per-count overhead.
+class ParagraphCountTask(CountTask):
+    def __init__(self, paragraphs, source, llm_backend=None, token_cache=None, priority=PRIORITY_VISIBLE, target=None):
+        super(ParagraphCountTask, self).__init__(paragraphs, source, llm_backend, token_cache, priority, target)
+        self.counts = {}
+
+    def lookupCache(self, token_cache):
+        for paragraph in self.data:
+            count = token_cache.get(self.llm_backend, paragraph)
+            if count is not None:
+                self.counts[paragraph] = count
+        self.data = [paragraph for paragraph in self.data if paragraph not in self.counts]
+        if self.data or self.llm_backend is None or self.llm_backend.token_overhead is None:
+            return False
+        self.source.onParagraphsCounted(self.counts, self.llm_backend.token_overhead)
+        return True
+
+    def execute(self):
+        if self.llm_backend is None:
+            self.source.onTokensCounted(-1)
+            return
+        start = time.monotonic()
+        for paragraph in self.data:
+            if self.superseded:
+                return
+            if not self.paragraphCounted(paragraph, self.llm_backend.count_tokens(paragraph)):
+                return
+        self.report(start, sum(self.counts[paragraph] for paragraph in self.data), len(self.data))
+        if not self.superseded:
+            self.source.onParagraphsCounted(self.counts, self.llm_backend.get_token_overhead())
+
+    # Paragraphs are counted one after the other here too, so a superseded task stops early
+    async def aexecute(self):
+        if self.llm_backend is None:
+            self.source.onTokensCounted(-1)
+            return
+        start = time.monotonic()
+        for paragraph in self.data:
+            if self.superseded:
+                return
+            if not self.paragraphCounted(paragraph, await self.llm_backend.acount_tokens(paragraph)):
+                return
+        self.report(start, sum(self.counts[paragraph] for paragraph in self.data), len(self.data))
+        if not self.superseded:
+            self.source.onParagraphsCounted(self.counts, await self.llm_backend.aget_token_overhead())
+
+    # Returns whether counting can go on
+    def paragraphCounted(self, paragraph, count):
+        if count < 0:
+            self.source.onTokensCounted(-1)
+            return False
+        if self.token_cache is not None:
+            self.token_cache.put(self.llm_backend, paragraph, count)
+        self.counts[paragraph] = count
+        return True
+
+def is_generation_error(text):
+    return not text or text.startswith(GENERATION_ERROR) or ("\n\n" + GENERATION_ERROR) in text
+
+# While streaming, partial text is handed to the UI at most this often so the
+# Qt event loop doesn't get one repaint per token
+STREAM_FLUSH_INTERVAL = 0.1
+
+DEFAULT_MAX_LENGTH = 1024
+
+# data is either a finished prompt or a PromptPlan, which is fitted into the backend's context when the task runs.
+# Complete responses are recorded in generation_cache, and with replay a prompt that's in there already
+# gets its latest response back without generating. How the generation went is recorded in telemetry.
+# The executor sets all three from the LLM manager.
 class GenerateTask(QObject):
-    def __init__(self, data, source, llm_backend):
+    lane = GENERATE_LANE
+
+    def __init__(self, data, source, llm_backend, max_length=DEFAULT_MAX_LENGTH, generation_cache=None, replay=False,
+                 priority=PRIORITY_INTERACTIVE, telemetry=None):
         super(GenerateTask, self).__init__()
+        self.priority = priority
         self.data = data
         self.source = source
         self.llm_backend = llm_backend
+        self.max_length = max_length
+        self.generation_cache = generation_cache
+        self.replay = replay
+        self.prompt = None
+        self.prompt_tokens = None
+        self.cancel_token = CancelToken()
+        self.telemetry = telemetry
+        self.queued_at = None
+        self.started = None
+        self.first_token = None
+        # Streaming state: every chunk so far, those not yet handed to the source, and when that last happened
+        self.chunks = []
+        self.pending = []
+        self.last_flush = None
+        # See LLMBase.start_generation
+        self.tickets = []
+        self.overlapped = False
+        # The telemetry record of the generation, once it's done
+        self.record = None
+
+    # A task cancelled before it runs never does, a running one has its request aborted.
+    # Either way its source hears nothing more from it.
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def cancelled(self):
+        return self.cancel_token.is_cancelled()
+
+    def buildPrompt(self):
+        if isinstance(self.data, PromptPlan):
+            self.prompt = self.data.build(self.llm_backend, self.max_length)
+            self.prompt_tokens = self.data.prompt_tokens
+        else:
+            self.prompt = self.data
+        return self.prompt
+
+    # Builds the prompt and answers from the generation cache when replaying. Returns the prompt,
+    # or None when there's nothing left to do.
+    def begin(self):
+        if self.cancelled():
+            return None
+        self.started = time.monotonic()
+        prompt = self.buildPrompt()
+        if self.replay and self.generation_cache is not None:
+            cached = self.generation_cache.get(self.llm_backend, prompt, self.max_length)
+            if cached:
+                self.source.onResponseGenerated(cached[-1][1], False)
+                self.report(cached[-1][1], replayed=True)
+                return None
+        self.tickets = self.llm_backend.start_generation()
+        return prompt
+
+    # Returns whether another generation ran on the same server while this one did.
+    # Perf numbers the backend reports then can't be told apart from the other one's.
+    def endGeneration(self):
+        tickets, self.tickets = self.tickets, []
+        for ticket in tickets:
+            if ticket.end():
+                self.overlapped = True
+        return self.overlapped
 
     def execute(self):
-        if self.llm_backend.type == 'Kobold':
-            generateUrl = f"{self.llm_backend.address}/api/v1/generate"
-            headers = {'Content-Type': 'application/json'}
-            prompt = json.dumps({
-                "prompt": self.data,
-                "max_length": 1024
-            })
-            response = requests.post(generateUrl, headers=headers, data=prompt)
-            if response.status_code == 200:
-                response_data = json.loads(response.text)
-                self.source.onResponseGenerated(response_data["results"][0]["text"].strip())
-            else:
-                self.source.onResponseGenerated("Error generating response")
-        elif self.llm_backend.type == 'OpenAI':
-            openai.api_key = self.llm_backend.address  # In this context, address holds the API key
+        prompt = self.begin()
+        if prompt is None:
+            return
+        try:
+            self.run(prompt)
+        finally:
+            self.endGeneration()
+
+    def run(self, prompt):
+        if not self.llm_backend.stream:
+            try:
+                self.finish(self.llm_backend.generate(prompt, self.max_length, self.cancel_token))
+            except RequestCancelled:
+                self.finish(None)
+            return
+        self.chunks = []
+        try:
+            for token in self.llm_backend.generate_stream(prompt, self.max_length, self.cancel_token):
+                self.addChunk(token)
+        except RequestCancelled:
+            self.finish(None)
+            return
+        except Exception as e:
+            self.chunks.append(f"\n\n{GENERATION_ERROR}: {e}")
+        self.finish("".join(self.chunks).strip(), len(self.chunks))
+
+    # The same as execute, for backends that run on the event loop
+    async def aexecute(self):
+        loop = asyncio.get_running_loop()
+        # Building the prompt counts tokens, and the cache is read from disk
+        prompt = await loop.run_in_executor(None, self.begin)
+        if prompt is None:
+            return
+        try:
+            await self.arun(prompt)
+        finally:
+            self.endGeneration()
+
+    async def arun(self, prompt):
+        if not self.llm_backend.stream:
             try:
-                response = openai.Completion.create(
-                    engine="text-davinci-003",
-                    prompt=self.llm_backend.system_prompt + "\n\n" + self.data,
-                    max_tokens=1024
-                )
-                text = response.choices[0].text.strip()
-                self.source.onResponseGenerated(text)
-            except Exception as e:
-                self.source.onResponseGenerated(f"Error generating response: {e}")
+                response = await self.llm_backend.agenerate(prompt, self.max_length, self.cancel_token)
+            except RequestCancelled:
+                response = None
+            await self.afinish(response)
+            return
+        self.chunks = []
+        try:
+            async for token in self.llm_backend.astream(prompt, self.max_length, self.cancel_token):
+                self.addChunk(token)
+        except RequestCancelled:
+            await self.afinish(None)
+            return
+        except Exception as e:
+            self.chunks.append(f"\n\n{GENERATION_ERROR}: {e}")
+        await self.afinish("".join(self.chunks).strip(), len(self.chunks))
+
+    # source.onResponseGenerated(text, partial) receives newly streamed chunks with partial=True,
+    # followed by the complete response with partial=False
+    def addChunk(self, token):
+        if not self.chunks:
+            token = token.lstrip()
+            if not token:
+                return
+        self.chunks.append(token)
+        self.pending.append(token)
+        now = time.monotonic()
+        if self.first_token is None:
+            self.first_token = now
+        # The first token is shown immediately, after that updates are batched
+        if (self.last_flush is None or now - self.last_flush >= STREAM_FLUSH_INTERVAL) and not self.cancelled():
+            self.source.onResponseGenerated("".join(self.pending), True)
+            self.pending = []
+            self.last_flush = now
+
+    # response is None when the request was cancelled. chunks is how many pieces a stream arrived in.
+    def finish(self, response, chunks=None):
+        if not self.deliver(response):
+            return
+        self.report(response, chunks=chunks, perf=self.llm_backend.get_perf() if self.wantsPerf(response) else None)
+        self.store(response)
 
+    async def afinish(self, response, chunks=None):
+        if not self.deliver(response):
+            return
+        perf = await self.llm_backend.aget_perf() if self.wantsPerf(response) else None
+        self.report(response, chunks=chunks, perf=perf)
+        await asyncio.get_running_loop().run_in_executor(None, self.store, response)
+
+    # Hands the complete response to the source, returns whether it did
+    def deliver(self, response):
+        # A cancelled request may still have returned, with an error or whatever was generated until then
+        if response is None or self.cancelled():
+            self.report(response, cancelled=True)
+            return False
+        self.source.onResponseGenerated(response, False)
+        return True
+
+    def wantsPerf(self, response):
+        return self.telemetry is not None and not is_generation_error(response) and not any(ticket.overlapped for ticket in self.tickets)
+
+    def store(self, response):
+        if self.generation_cache is not None and not is_generation_error(response):
+            self.generation_cache.put(self.llm_backend, self.prompt, self.max_length, response)
+
+    # perf is what the backend reports on the generation, if anything. It's dropped when another generation
+    # overlapped this one, the record says so instead.
+    def report(self, response, cancelled=False, replayed=False, chunks=None, perf=None):
+        overlapped = self.endGeneration()
+        if self.telemetry is None:
+            return
+        if overlapped:
+            perf = None
+        end = time.monotonic()
+        error = not cancelled and is_generation_error(response)
+        # Kobold knows exactly, as do OpenAI servers that report usage. Kobold's streams send a token at a time,
+        # otherwise a local tokenizer may know
+        completion_tokens = None
+        if perf and perf.get('last_token_count'):
+            completion_tokens = perf['last_token_count']
+        elif chunks and self.llm_backend.streams_tokens:
+            completion_tokens = chunks
+        elif response and not error and not cancelled and not replayed:
+            completion_tokens = self.llm_backend.count_tokens_locally(response)
+        # The rate of generation itself, after the prompt was processed
+        if perf and perf.get('last_eval') and completion_tokens:
+            tokens_per_s = completion_tokens / perf['last_eval']
+        elif completion_tokens and end > (self.first_token or self.started):
+            tokens_per_s = completion_tokens / (end - (self.first_token or self.started))
+        else:
+            tokens_per_s = None
+        prompt_tokens = perf.get('last_input_count') if perf and perf.get('last_input_count') else self.prompt_tokens
+        self.record = self.telemetry.record(self.llm_backend, GENERATE,
+                                            queue_wait=self.started - (self.queued_at or self.started),
+                                            first_token=self.first_token - self.started if self.first_token is not None else None,
+                                            latency=end - self.started, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                            tokens_per_s=tokens_per_s, max_length=self.max_length,
+                                            trimmed=self.data.trimmed if isinstance(self.data, PromptPlan) else [],
+                                            error=error, cancelled=cancelled, replayed=replayed, perf=perf, overlapped=overlapped)
+
+# Sends just the stable prompt prefix and asks for a single token, so a backend that reuses
+# its KV cache for shared prefixes only has to process the new part of the next real prompt.
+# Real prompts that don't fit have their prefix trimmed, which a primed prefix wouldn't match,
+# so priming is skipped when that can happen with the same max_length as real generations.
+class PrimeCacheTask(QObject):
+    lane = GENERATE_LANE
+    priority = PRIORITY_BACKGROUND
+
+    def __init__(self, plan, llm_backend, max_length=DEFAULT_MAX_LENGTH):
+        super(PrimeCacheTask, self).__init__()
+        self.data = plan
+        self.llm_backend = llm_backend
+        self.max_length = max_length
+
+    # The prefix as real prompts start with it, or None when they may not
+    def prefix(self):
+        if not self.data.stable_prefix_fits(self.llm_backend, self.max_length):
+            return None
+        return self.data.render()
+
+    # Priming is a generation too, it changes what the backend reports on its last one
+    def execute(self):
+        prompt = self.prefix()
+        if prompt is None:
+            return
+        tickets = self.llm_backend.start_generation()
+        try:
+            self.llm_backend.generate(prompt, 1)
+        finally:
+            for ticket in tickets:
+                ticket.end()
+
+    async def aexecute(self):
+        # Counting the prefix may read the token cache from disk
+        prompt = await asyncio.get_running_loop().run_in_executor(None, self.prefix)
+        if prompt is None:
+            return
+        tickets = self.llm_backend.start_generation()
+        try:
+            await self.llm_backend.agenerate(prompt, 1)
+        finally:
+            for ticket in tickets:
+                ticket.end()
@@ -1,15 +1,213 @@
+import asyncio
+import concurrent.futures
+import threading
 from abc import ABC, abstractmethod
 
+from src.asyncloop import event_loop
+from src.tokenizer import load_tokenizer
+from src.httpsession import BackendSession, AsyncBackendSession
+
+# Connection status of a backend, tested in the background at startup
+STATUS_CHECKING = 'checking'
+STATUS_ONLINE = 'online'
+STATUS_OFFLINE = 'offline'
+
+# Keep-alive connections pooled per backend, on top of its concurrent generations for token counts
+SESSION_POOL_EXTRA = 8
+# How long closing the async session may hold up exiting
+ASYNC_CLOSE_TIMEOUT = 2
+
+# Backends return their errors as the generated text, starting with this
+GENERATION_ERROR = "Error generating response"
+
+# A server's statistics on "the last generation" only say something about a given generation when it had
+# the server to itself. Generations are tracked per address, so separately configured LLMs and pools
+# sharing a server see each other.
+class GenerationTicket:
+    __slots__ = ('tracker', 'overlapped')
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.overlapped = False
+
+    # Returns whether another generation ran on the server at some point since this one started
+    def end(self):
+        with self.tracker.lock:
+            self.tracker.running.discard(self)
+        return self.overlapped
+
+class GenerationTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+
+    def start(self):
+        ticket = GenerationTicket(self)
+        with self.lock:
+            if self.running:
+                ticket.overlapped = True
+                for other in self.running:
+                    other.overlapped = True
+            self.running.add(ticket)
+        return ticket
+
+_generation_trackers = {}
+_generation_trackers_lock = threading.Lock()
+
+def generation_tracker(address):
+    with _generation_trackers_lock:
+        return _generation_trackers.setdefault(address, GenerationTracker())
+
+
 class LLMBase(ABC):
-    def __init__(self, name, address, system_prompt):
+    # Whether the backend reuses its cache for a prompt prefix it has seen before
+    supports_prefix_cache = False
+    # Whether the async methods below talk to the backend natively. The executor then runs this
+    # backend's tasks on the shared event loop instead of on threads of their own.
+    supports_async = False
+    # Whether each piece generate_stream yields is exactly one token, so counting them counts the tokens
+    streams_tokens = False
+
+    def __init__(self, name, address, system_prompt, stream=True, max_concurrency=1, tokenizer_path='', max_context=0):
         self.name = name
         self.address = address
         self.system_prompt = system_prompt
+        self.stream = stream
+        # Number of generations that may run against this backend at the same time
+        self.max_concurrency = max_concurrency
+        # Optional vocabulary file for counting tokens locally instead of asking the backend
+        self.tokenizer_path = tokenizer_path
+        # Context length in tokens, 0 asks the backend where it can tell
+        self.max_context = max_context
+        self.status = STATUS_CHECKING
+        self.token_overhead = None
+        self.session, self.async_session = self.create_sessions()
 
+    # All backend I/O goes through the first session, or the async one from the event loop
+    def create_sessions(self):
+        pool_size = self.max_concurrency + SESSION_POOL_EXTRA
+        return BackendSession(pool_size=pool_size), AsyncBackendSession()
+
+    @property
+    def online(self):
+        return self.status == STATUS_ONLINE
+
+    # cancel_token is an optional httpsession.CancelToken for aborting the request from another thread
     @abstractmethod
-    def generate(self, prompt, max_length=1024):
+    def generate(self, prompt, max_length=1024, cancel_token=None):
         pass
 
+    # Yields the response text piece by piece as the backend produces it.
+    # Backends without a streaming endpoint yield the whole response at once.
+    def generate_stream(self, prompt, max_length=1024, cancel_token=None):
+        yield self.generate(prompt, max_length, cancel_token)
+
+    # The async versions of generate, generate_stream, count_tokens and get_perf, to be awaited on the
+    # event loop in asyncloop.py. Backends that don't implement them natively run the blocking
+    # versions on the loop's thread pool, which works the same but takes a thread per call.
+    async def agenerate(self, prompt, max_length=1024, cancel_token=None):
+        return await asyncio.get_running_loop().run_in_executor(None, self.generate, prompt, max_length, cancel_token)
+
+    async def astream(self, prompt, max_length=1024, cancel_token=None):
+        loop = asyncio.get_running_loop()
+        stream = self.generate_stream(prompt, max_length, cancel_token)
+        done = object()
+        try:
+            while True:
+                token = await loop.run_in_executor(None, next, stream, done)
+                if token is done:
+                    return
+                yield token
+        finally:
+            # Runs the stream's cleanup, closing a request that was cut short
+            await loop.run_in_executor(None, stream.close)
+
+    async def acount_tokens(self, text):
+        return await asyncio.get_running_loop().run_in_executor(None, self.count_tokens, text)
+
+    async def aget_perf(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_perf)
+
+    async def aget_token_overhead(self):
+        if self.token_overhead is None:
+            count = await self.acount_tokens("")
+            if count < 0:
+                return 0
+            self.token_overhead = count
+        return self.token_overhead
+
+    # Closes the async session's connections, from outside the event loop. Connections that don't close
+    # in time are left to the loop, which carries on closing them.
+    def close_async_session(self):
+        if self.async_session.session is not None:
+            try:
+                event_loop().run(self.async_session.close(), ASYNC_CLOSE_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                print(f"Closing the connections to {self.name} timed out")
+
+    # For a backend that's no longer used: requests still running are cancelled and the connections closed
+    def close(self):
+        self.session.close()
+        self.close_async_session()
+
+    # Whether counts come from the configured tokenizer file, which they don't when it can't be loaded
+    def has_local_tokenizer(self):
+        return bool(self.tokenizer_path) and load_tokenizer(self.tokenizer_path) is not None
+
+    # Whether count_tokens gives the model's own counts rather than an estimate
+    def counts_exactly(self):
+        return True
+
+    # Identifies the tokenizer behind this backend, used to key cached token counts
+    def identity(self):
+        if self.has_local_tokenizer():
+            return f"local|{self.tokenizer_path}"
+        return f"{self.get_type()}|{self.address}"
+
+    # Identifies what decides the text generated for a prompt, used to key cached generations.
+    # No sampler settings are sent with requests, so those are whatever the backend defaults to.
+    def generation_identity(self):
+        return f"{self.get_type()}|{self.address}|{self.system_prompt}"
+
+    # Returns None when no local tokenizer is configured or it can't be loaded
+    def count_tokens_locally(self, text):
+        if not self.tokenizer_path:
+            return None
+        tokenizer = load_tokenizer(self.tokenizer_path)
+        if tokenizer is None:
+            return None
+        try:
+            return tokenizer.count_tokens(text)
+        except Exception as e:
+            print(f"Local tokenizer failed: {e}")
+            return None
+
+    # Tokens every count includes regardless of the text, such as a BOS token.
+    # Subtracted when the counts of separately counted pieces are added up.
+    def get_token_overhead(self):
+        if self.token_overhead is None:
+            count = self.count_tokens("")
+            if count < 0:
+                return 0
+            self.token_overhead = count
+        return self.token_overhead
+
+    # The backend's own statistics on its last generation, for telemetry. None where it has none.
+    def get_perf(self):
+        return None
+
+    # The servers a generation of this backend may run on
+    def generation_addresses(self):
+        return [self.address]
+
+    # Called around every generation, whatever runs it. The tickets tell whether get_perf is about it, see GenerationTicket.
+    def start_generation(self):
+        return [generation_tracker(address).start() for address in self.generation_addresses()]
+
+    # Returns 0 when the context length is unknown, prompts are then sent untrimmed
+    def get_max_context(self):
+        return self.max_context
+
     @abstractmethod
     def count_tokens(self, text):
         pass
@@ -41,5 +239,8 @@ class LLMBase(ABC):
         elif llm_type == 'OpenAI':
             from src.llm_openai import LLMOpenAI
             return LLMOpenAI.from_config(config)
+        elif llm_type == 'Pool':
+            from src.llm_pool import LLMPool
+            return LLMPool.from_config(config)
         else:
             raise ValueError(f"Unknown LLM type: {llm_type}")
@@ -2,55 +2,255 @@
 
 import requests
 import json
+import threading
+import uuid
 from src.llm_base import LLMBase
+from src.httpsession import TEST_TIMEOUT, ASYNC_AVAILABLE, ASYNC_REQUEST_ERRORS, RequestCancelled
 
 class LLMKobold(LLMBase):
-    def __init__(self, name, address, system_prompt):
-        super().__init__(name, address, system_prompt)
+    # Context shifting and fast-forwarding reuse the KV cache for a shared prompt prefix
+    supports_prefix_cache = True
+    supports_async = ASYNC_AVAILABLE
+    streams_tokens = True
 
-    def generate(self, prompt, max_length=1024):
+    def __init__(self, name, address, system_prompt, stream=True, max_concurrency=1, tokenizer_path='', max_context=0):
+        super().__init__(name, address, system_prompt, stream, max_concurrency, tokenizer_path, max_context)
+        self.model = None
+        self.backend_max_context = None
+
+    def generate(self, prompt, max_length=1024, cancel_token=None):
         url = f"{self.address}/api/v1/generate"
         headers = {'Content-Type': 'application/json'}
         data = {
             "prompt": prompt,
             "max_length": max_length
         }
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        abort = self.abort_on_cancel(data, cancel_token)
+        try:
+            response = self.session.post(url, headers=headers, data=json.dumps(data), cancel_token=cancel_token)
+        except requests.RequestException as e:
+            return f"Error generating response: {e}"
+        finally:
+            if abort is not None:
+                cancel_token.remove_callback(abort)
         if response.status_code == 200:
             response_data = response.json()
             return response_data["results"][0]["text"].strip()
         else:
             return f"Error generating response: {response.status_code}"
 
+    # Kobold's SSE endpoint sends one "data: {"token": ...}" event per generated token
+    def generate_stream(self, prompt, max_length=1024, cancel_token=None):
+        url = f"{self.address}/api/extra/generate/stream"
+        headers = {'Content-Type': 'application/json'}
+        data = {
+            "prompt": prompt,
+            "max_length": max_length
+        }
+        abort = self.abort_on_cancel(data, cancel_token)
+        try:
+            try:
+                response = self.session.post(url, headers=headers, data=json.dumps(data), stream=True, cancel_token=cancel_token)
+            except requests.RequestException as e:
+                yield f"Error generating response: {e}"
+                return
+            if response.status_code != 200:
+                response.close()
+                yield f"Error generating response: {response.status_code}"
+                return
+            for line in self.session.iter_lines(response):
+                if not line or not line.startswith("data:"):
+                    continue
+                token = json.loads(line[len("data:"):]).get("token", "")
+                if token:
+                    yield token
+        finally:
+            if abort is not None:
+                cancel_token.remove_callback(abort)
+
+    # The same requests as generate and generate_stream, made from the event loop
+    async def agenerate(self, prompt, max_length=1024, cancel_token=None):
+        if not self.supports_async:
+            return await super().agenerate(prompt, max_length, cancel_token)
+        data = {
+            "prompt": prompt,
+            "max_length": max_length
+        }
+        abort = self.abort_on_cancel(data, cancel_token)
+        try:
+            response = await self.async_session.post(f"{self.address}/api/v1/generate", headers={'Content-Type': 'application/json'},
+                                                      data=json.dumps(data), cancel_token=cancel_token)
+        except ASYNC_REQUEST_ERRORS as e:
+            return f"Error generating response: {e}"
+        finally:
+            if abort is not None:
+                cancel_token.remove_callback(abort)
+        if response.status == 200:
+            response_data = await response.json(content_type=None)
+            return response_data["results"][0]["text"].strip()
+        else:
+            return f"Error generating response: {response.status}"
+
+    async def astream(self, prompt, max_length=1024, cancel_token=None):
+        if not self.supports_async:
+            async for token in super().astream(prompt, max_length, cancel_token):
+                yield token
+            return
+        data = {
+            "prompt": prompt,
+            "max_length": max_length
+        }
+        abort = self.abort_on_cancel(data, cancel_token)
+        try:
+            try:
+                response = await self.async_session.post(f"{self.address}/api/extra/generate/stream",
+                                                          headers={'Content-Type': 'application/json'},
+                                                          data=json.dumps(data), stream=True, cancel_token=cancel_token)
+            except ASYNC_REQUEST_ERRORS as e:
+                yield f"Error generating response: {e}"
+                return
+            if response.status != 200:
+                yield f"Error generating response: {response.status}"
+                return
+            async for line in self.async_session.iter_lines(response):
+                if not line or not line.startswith("data:"):
+                    continue
+                token = json.loads(line[len("data:"):]).get("token", "")
+                if token:
+                    yield token
+        finally:
+            if abort is not None:
+                cancel_token.remove_callback(abort)
+
+    # Closing the connection doesn't stop Kobold from generating, so a cancelled request also asks it to abort.
+    # The generation gets a key, so only that one is aborted where Kobold serves several users.
+    # Returns the callback registered with cancel_token, to be removed once the request is over.
+    def abort_on_cancel(self, data, cancel_token):
+        if cancel_token is None:
+            return None
+        data["genkey"] = "KCPP" + uuid.uuid4().hex[:8]
+        # Cancelling happens on the GUI thread, which shouldn't wait for the request
+        abort = lambda: threading.Thread(target=self.abort, args=(data["genkey"],), daemon=True).start()
+        cancel_token.add_callback(abort)
+        return abort
+
+    def abort(self, genkey):
+        try:
+            self.session.post(f"{self.address}/api/extra/abort", headers={'Content-Type': 'application/json'},
+                              data=json.dumps({"genkey": genkey}), timeout=TEST_TIMEOUT)
+        except requests.RequestException:
+            pass
+
+    # Includes how long the last prompt took to process and the last response to generate, and how many requests are waiting
+    def get_perf(self):
+        try:
+            response = self.session.get(f"{self.address}/api/extra/perf", timeout=TEST_TIMEOUT)
+            if response.status_code == 200:
+                return response.json()
+        # The session may be closing
+        except (requests.RequestException, RequestCancelled, ValueError):
+            pass
+        return None
+
+    async def aget_perf(self):
+        if not self.supports_async:
+            return await super().aget_perf()
+        try:
+            response = await self.async_session.get(f"{self.address}/api/extra/perf", timeout=TEST_TIMEOUT)
+            if response.status == 200:
+                return await response.json(content_type=None)
+        except (*ASYNC_REQUEST_ERRORS, ValueError):
+            pass
+        return None
+
+    # Prompts are planned on the GUI thread, so this only reads what test_connection fetched in the background
+    def get_max_context(self):
+        if self.max_context:
+            return self.max_context
+        return self.backend_max_context or 0
+
     def count_tokens(self, text):
+        count = self.count_tokens_locally(text)
+        if count is not None:
+            return count
         url = f"{self.address}/api/extra/tokencount"
         headers = {'Content-Type': 'application/json'}
         data = {"prompt": text}
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        try:
+            response = self.session.post(url, headers=headers, data=json.dumps(data))
+        except requests.RequestException:
+            return -1
         if response.status_code == 200:
             response_data = response.json()
             return response_data["value"]
         else:
             return -1
 
+    async def acount_tokens(self, text):
+        # Local tokenizers don't wait on anything, they're run on the thread pool to keep the loop free
+        if self.tokenizer_path or not self.supports_async:
+            return await super().acount_tokens(text)
+        try:
+            response = await self.async_session.post(f"{self.address}/api/extra/tokencount", headers={'Content-Type': 'application/json'},
+                                                      data=json.dumps({"prompt": text}))
+        except ASYNC_REQUEST_ERRORS:
+            return -1
+        if response.status == 200:
+            response_data = await response.json(content_type=None)
+            return response_data["value"]
+        else:
+            return -1
+
     def test_connection(self):
         try:
-            response = requests.get(f"{self.address}/api/v1/version")
-            return response.status_code == 200
+            response = self.session.probe(f"{self.address}/api/v1/version")
+            if response.status_code != 200:
+                return False
+            # The loaded model decides how text is tokenized
+            response = self.session.probe(f"{self.address}/api/v1/model")
+            if response.status_code == 200:
+                self.model = response.json().get("result")
+            # The model may have been reloaded with a different context size
+            self.backend_max_context = self.fetch_max_context()
+            return True
         except requests.RequestException:
             return False
 
+    # None when the backend doesn't say
+    def fetch_max_context(self):
+        try:
+            response = self.session.probe(f"{self.address}/api/v1/config/max_context_length")
+            if response.status_code == 200:
+                return int(response.json()["value"])
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        return None
+
+    def identity(self):
+        if self.has_local_tokenizer():
+            return super().identity()
+        return f"{super().identity()}|{self.model or ''}"
+
+    def generation_identity(self):
+        return f"{super().generation_identity()}|{self.model or ''}"
+
     def get_config(self):
         return {
             'name': self.name,
             'address': self.address,
             'system_prompt': self.system_prompt,
+            'stream': self.stream,
+            'max_concurrency': self.max_concurrency,
+            'tokenizer_path': self.tokenizer_path,
+            'max_context': self.max_context,
             'type': self.get_type()
         }
 
     @classmethod
     def from_config(cls, config):
-        return cls(config['name'], config['address'], config['system_prompt'])
+        return cls(config['name'], config.get('address', ''), config.get('system_prompt', ''),
+                   config.get('stream', True), config.get('max_concurrency', 1), config.get('tokenizer_path', ''),
+                   config.get('max_context', 0))
 
     @staticmethod
     def get_type():
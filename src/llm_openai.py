@@ -1,50 +1,181 @@
 # src/llm_openai.py
 
-import openai
+import json
 import os
+import requests
 from src.llm_base import LLMBase
+from src.httpsession import ASYNC_AVAILABLE, ASYNC_REQUEST_ERRORS, RequestCancelled
+
+# Talks to the OpenAI completions API, or any server that implements it
+DEFAULT_ADDRESS = "https://api.openai.com/v1"
+DEFAULT_MODEL = "text-davinci-003"
 
 class LLMOpenAI(LLMBase):
-    def __init__(self, name, address, api_key, system_prompt, use_env_var=False):
-        super().__init__(name, address, system_prompt)
+    supports_async = ASYNC_AVAILABLE
+
+    def __init__(self, name, address, api_key, system_prompt, use_env_var=False, stream=True, max_concurrency=1, tokenizer_path='',
+                 model=DEFAULT_MODEL, max_context=0):
+        super().__init__(name, address, system_prompt, stream, max_concurrency, tokenizer_path, max_context)
         self.api_key = api_key
         self.use_env_var = use_env_var
+        self.model = model
+        # The usage the server reported with the latest completion, which get_perf hands on
+        self.last_usage = None
+
+    def generate(self, prompt, max_length=1024, cancel_token=None):
+        self.last_usage = None
+        try:
+            response = self.session.post(self._url("/completions"), headers=self._headers(), cancel_token=cancel_token,
+                                         data=json.dumps(self._completion_request(prompt, max_length)))
+            if response.status_code != 200:
+                return f"Error generating response: {response.status_code} {response.text}"
+            data = response.json()
+            self.last_usage = data.get("usage")
+            return data["choices"][0]["text"].strip()
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            return f"Error generating response: {str(e)}"
+
+    # Streamed completions arrive as "data: {...}" events, terminated by "data: [DONE]"
+    def generate_stream(self, prompt, max_length=1024, cancel_token=None):
+        self.last_usage = None
+        data = self._completion_request(prompt, max_length)
+        data["stream"] = True
+        try:
+            response = self.session.post(self._url("/completions"), headers=self._headers(), data=json.dumps(data),
+                                         stream=True, cancel_token=cancel_token)
+        except requests.RequestException as e:
+            yield f"Error generating response: {str(e)}"
+            return
+        if response.status_code != 200:
+            yield f"Error generating response: {response.status_code} {response.text}"
+            response.close()
+            return
+        for line in self.session.iter_lines(response):
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            event = json.loads(payload)
+            # Some servers send the usage with the last event
+            if event.get("usage"):
+                self.last_usage = event["usage"]
+            choices = event.get("choices") or [{}]
+            text = choices[0].get("text", "")
+            if text:
+                yield text
 
-    def generate(self, prompt, max_length=1024):
+    # The same requests as generate and generate_stream, made from the event loop
+    async def agenerate(self, prompt, max_length=1024, cancel_token=None):
+        if not self.supports_async:
+            return await super().agenerate(prompt, max_length, cancel_token)
+        self.last_usage = None
         try:
-            self._set_api_key()
-            response = openai.Completion.create(
-                engine="text-davinci-003",
-                prompt=prompt,
-                max_tokens=max_length
-            )
-            return response.choices[0].text.strip()
+            response = await self.async_session.post(self._url("/completions"), headers=self._headers(), cancel_token=cancel_token,
+                                                      data=json.dumps(self._completion_request(prompt, max_length)))
+            if response.status != 200:
+                return f"Error generating response: {response.status} {await response.text()}"
+            data = await response.json(content_type=None)
+            self.last_usage = data.get("usage")
+            return data["choices"][0]["text"].strip()
+        except RequestCancelled:
+            raise
         except Exception as e:
             return f"Error generating response: {str(e)}"
 
+    async def astream(self, prompt, max_length=1024, cancel_token=None):
+        if not self.supports_async:
+            async for text in super().astream(prompt, max_length, cancel_token):
+                yield text
+            return
+        self.last_usage = None
+        data = self._completion_request(prompt, max_length)
+        data["stream"] = True
+        try:
+            response = await self.async_session.post(self._url("/completions"), headers=self._headers(), data=json.dumps(data),
+                                                      stream=True, cancel_token=cancel_token)
+        except ASYNC_REQUEST_ERRORS as e:
+            yield f"Error generating response: {str(e)}"
+            return
+        if response.status != 200:
+            yield f"Error generating response: {response.status} {await response.text()}"
+            return
+        async for line in self.async_session.iter_lines(response):
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            event = json.loads(payload)
+            # Some servers send the usage with the last event
+            if event.get("usage"):
+                self.last_usage = event["usage"]
+            choices = event.get("choices") or [{}]
+            text = choices[0].get("text", "")
+            if text:
+                yield text
+
     def count_tokens(self, text):
+        count = self.count_tokens_locally(text)
+        if count is not None:
+            return count
         try:
-            # Use an approximate count for now
+            # Without a local tokenizer only an approximate count is available
             return len(text.split())
         except Exception:
             return -1
 
+    # Counting only takes time with a local tokenizer, which is run on the thread pool to keep the loop free
+    async def acount_tokens(self, text):
+        if self.tokenizer_path:
+            return await super().acount_tokens(text)
+        return self.count_tokens(text)
+
+    # The token counts the server reported for the latest completion, named like Kobold's statistics. None when it reported none.
+    def get_perf(self):
+        usage = self.last_usage
+        if not usage:
+            return None
+        return {'last_token_count': usage.get('completion_tokens'), 'last_input_count': usage.get('prompt_tokens')}
+
+    # Whether counts are the model's own, without a local tokenizer count_tokens only estimates them
+    def counts_exactly(self):
+        return self.has_local_tokenizer()
+
     def test_connection(self):
         try:
-            self._set_api_key()
-            openai.Model.list()  # Attempt a simple API call to test connection
-            return True
+            response = self.session.probe(self._url("/models"), headers=self._headers())
+            return response.status_code == 200
         except Exception as e:
             print(f"Connection test failed: {e}")
             return False
 
-    def _set_api_key(self):
-        if self.use_env_var:
-            openai.api_key = os.getenv(self.api_key)
-        else:
-            openai.api_key = self.api_key
-        if self.address:
-            openai.api_base = self.address
+    def generation_identity(self):
+        return f"{super().generation_identity()}|{self.model}"
+
+    def _build_prompt(self, prompt):
+        if self.system_prompt:
+            return self.system_prompt + "\n\n" + prompt
+        return prompt
+
+    def _completion_request(self, prompt, max_length):
+        return {
+            "model": self.model,
+            "prompt": self._build_prompt(prompt),
+            "max_tokens": max_length
+        }
+
+    def _url(self, path):
+        return (self.address or DEFAULT_ADDRESS).rstrip('/') + path
+
+    def _headers(self):
+        api_key = os.getenv(self.api_key) if self.use_env_var else self.api_key
+        headers = {'Content-Type': 'application/json'}
+        if api_key:
+            headers['Authorization'] = f"Bearer {api_key}"
+        return headers
 
     def get_config(self):
         return {
@@ -53,12 +184,19 @@ class LLMOpenAI(LLMBase):
             'api_key': self.api_key,
             'system_prompt': self.system_prompt,
             'use_env_var': self.use_env_var,
+            'stream': self.stream,
+            'max_concurrency': self.max_concurrency,
+            'tokenizer_path': self.tokenizer_path,
+            'model': self.model,
+            'max_context': self.max_context,
             'type': self.get_type()
         }
 
     @classmethod
     def from_config(cls, config):
-        return cls(config['name'], config['address'], config['api_key'], config['system_prompt'], config.get('use_env_var', False))
+        return cls(config['name'], config.get('address', ''), config.get('api_key', ''), config.get('system_prompt', ''),
+                   config.get('use_env_var', False), config.get('stream', True), config.get('max_concurrency', 1),
+                   config.get('tokenizer_path', ''), config.get('model', DEFAULT_MODEL), config.get('max_context', 0))
 
     @staticmethod
     def get_type():
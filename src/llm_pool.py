@@ -0,0 +1,291 @@
+# src/llm_pool.py
+#
+# Several Kobold servers running the same model, used as one LLM. Every request goes to the
+# least busy member that's up, and a member that fails is left out for a while with the request
+# sent to another one instead. The pool's concurrency is its members' added up, so summaries
+# regenerated across it run on all of them at once.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.llm_base import LLMBase, GENERATION_ERROR, STATUS_ONLINE, STATUS_OFFLINE
+from src.llm_kobold import LLMKobold
+from src.httpsession import ASYNC_AVAILABLE
+
+# How long a member that failed is left out before it's tried again
+MEMBER_RETRY_DELAY = 30
+# Weight of the newest measurement in a member's recent latency
+LATENCY_SMOOTHING = 0.3
+
+class PoolMember:
+    def __init__(self, llm):
+        self.llm = llm
+        self.in_flight = 0
+        # Seconds until the member started answering, averaged over recent requests. None until measured.
+        self.latency = None
+        self.retry_at = 0
+
+    def healthy(self, now):
+        return now >= self.retry_at
+
+    # Members that are up come first, then the least busy, then the fastest lately.
+    # Unmeasured ones count as fast, so every member gets tried.
+    def load(self, now):
+        return (not self.healthy(now), self.in_flight, self.latency or 0)
+
+
+class LLMPool(LLMBase):
+    supports_async = ASYNC_AVAILABLE
+    streams_tokens = True
+
+    # max_concurrency is per member
+    def __init__(self, name, addresses, system_prompt, stream=True, max_concurrency=1, tokenizer_path='', max_context=0):
+        self.addresses = [address for address in addresses if address]
+        super().__init__(name, ", ".join(self.addresses), system_prompt, stream, max_concurrency * max(len(self.addresses), 1),
+                         tokenizer_path, max_context)
+        self.member_concurrency = max_concurrency
+        self.members = [PoolMember(LLMKobold(f"{name} ({address})", address, system_prompt, stream, max_concurrency,
+                                             tokenizer_path, max_context))
+                        for address in self.addresses]
+        self.lock = threading.Lock()
+        self.model = None
+        # The member that finished the latest generation, which get_perf asks
+        self.last_member = None
+
+    # Requests go through the members' sessions, the pool has none of its own
+    def create_sessions(self):
+        return None, None
+
+    # Picks the member for a request, leaving out the ones already tried for it. None when every member was.
+    def acquire(self, tried):
+        now = time.monotonic()
+        with self.lock:
+            candidates = [member for member in self.members if member not in tried]
+            if not candidates:
+                return None
+            member = min(candidates, key=lambda member: member.load(now))
+            member.in_flight += 1
+            tried.append(member)
+            return member
+
+    # first_response is how long the member took to start answering, None when it didn't.
+    # A member that didn't answer is left out for a while, unless the request was cancelled.
+    def release(self, member, first_response, cancel_token):
+        with self.lock:
+            member.in_flight -= 1
+            if first_response is not None:
+                member.retry_at = 0
+                member.llm.status = STATUS_ONLINE
+                if member.latency is None:
+                    member.latency = first_response
+                else:
+                    member.latency += LATENCY_SMOOTHING * (first_response - member.latency)
+            elif cancel_token is None or not cancel_token.is_cancelled():
+                member.retry_at = time.monotonic() + MEMBER_RETRY_DELAY
+
+    # Only failures the next member may not have are sent on, a cancelled request's result is returned as is
+    def should_fail_over(self, text, cancel_token):
+        if cancel_token is not None and cancel_token.is_cancelled():
+            return False
+        return text.startswith(GENERATION_ERROR)
+
+    def no_member(self, error):
+        return error or f"{GENERATION_ERROR}: no backend in {self.name} is available"
+
+    def generate(self, prompt, max_length=1024, cancel_token=None):
+        tried = []
+        text = None
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                return self.no_member(text)
+            start = time.monotonic()
+            text = None
+            try:
+                text = member.llm.generate(prompt, max_length, cancel_token)
+            finally:
+                answered = text is not None and not text.startswith(GENERATION_ERROR)
+                self.release(member, time.monotonic() - start if answered else None, cancel_token)
+            if not self.should_fail_over(text, cancel_token):
+                self.last_member = member
+                return text
+
+    # Fails over only while nothing has been streamed yet, text already handed on can't be taken back
+    def generate_stream(self, prompt, max_length=1024, cancel_token=None):
+        tried = []
+        error = None
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                yield self.no_member(error)
+                return
+            start = time.monotonic()
+            first_response = None
+            failed = False
+            try:
+                for token in member.llm.generate_stream(prompt, max_length, cancel_token):
+                    if first_response is None:
+                        if self.should_fail_over(token, cancel_token):
+                            error = token
+                            failed = True
+                            break
+                        first_response = time.monotonic() - start
+                    yield token
+            finally:
+                self.release(member, first_response, cancel_token)
+            if not failed:
+                self.last_member = member
+                return
+
+    async def agenerate(self, prompt, max_length=1024, cancel_token=None):
+        tried = []
+        text = None
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                return self.no_member(text)
+            start = time.monotonic()
+            text = None
+            try:
+                text = await member.llm.agenerate(prompt, max_length, cancel_token)
+            finally:
+                answered = text is not None and not text.startswith(GENERATION_ERROR)
+                self.release(member, time.monotonic() - start if answered else None, cancel_token)
+            if not self.should_fail_over(text, cancel_token):
+                self.last_member = member
+                return text
+
+    async def astream(self, prompt, max_length=1024, cancel_token=None):
+        tried = []
+        error = None
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                yield self.no_member(error)
+                return
+            start = time.monotonic()
+            first_response = None
+            failed = False
+            try:
+                async for token in member.llm.astream(prompt, max_length, cancel_token):
+                    if first_response is None:
+                        if self.should_fail_over(token, cancel_token):
+                            error = token
+                            failed = True
+                            break
+                        first_response = time.monotonic() - start
+                    yield token
+            finally:
+                self.release(member, first_response, cancel_token)
+            if not failed:
+                self.last_member = member
+                return
+
+    def count_tokens(self, text):
+        count = self.count_tokens_locally(text)
+        if count is not None:
+            return count
+        tried = []
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                return -1
+            start = time.monotonic()
+            count = -1
+            try:
+                count = member.llm.count_tokens(text)
+            finally:
+                self.release(member, time.monotonic() - start if count >= 0 else None, None)
+            if count >= 0:
+                return count
+
+    async def acount_tokens(self, text):
+        if self.tokenizer_path:
+            return await super().acount_tokens(text)
+        tried = []
+        while True:
+            member = self.acquire(tried)
+            if member is None:
+                return -1
+            start = time.monotonic()
+            count = -1
+            try:
+                count = await member.llm.acount_tokens(text)
+            finally:
+                self.release(member, time.monotonic() - start if count >= 0 else None, None)
+            if count >= 0:
+                return count
+
+    # Kobold's statistics on the latest generation, from the member that ran it. Only asked for when no other
+    # generation overlapped, otherwise last_member may already be another generation's.
+    def get_perf(self):
+        member = self.last_member
+        return member.llm.get_perf() if member is not None else None
+
+    async def aget_perf(self):
+        member = self.last_member
+        return await member.llm.aget_perf() if member is not None else None
+
+    # Any member may run a generation, so its statistics are only its own if none of them ran another
+    def generation_addresses(self):
+        return self.addresses
+
+    # The shortest context of the members, so a prompt fits whichever one gets it
+    def get_max_context(self):
+        if self.max_context:
+            return self.max_context
+        contexts = [member.llm.get_max_context() for member in self.members if member.llm.online]
+        contexts = [context for context in contexts if context]
+        return min(contexts) if contexts else 0
+
+    # The pool is online while any member is. Members are tested at the same time. The ones that
+    # answer are used again right away even if they failed recently, the others after a while.
+    def test_connection(self):
+        if not self.members:
+            return False
+        with ThreadPoolExecutor(max_workers=len(self.members)) as pool:
+            results = list(pool.map(lambda member: member.llm.test_connection(), self.members))
+        for member, online in zip(self.members, results):
+            member.llm.status = STATUS_ONLINE if online else STATUS_OFFLINE
+            member.retry_at = 0 if online else time.monotonic() + MEMBER_RETRY_DELAY
+        self.model = next((member.llm.model for member in self.members if member.llm.online), None)
+        return any(results)
+
+    def close_async_session(self):
+        for member in self.members:
+            member.llm.close_async_session()
+
+    def close(self):
+        for member in self.members:
+            member.llm.close()
+
+    def identity(self):
+        if self.has_local_tokenizer():
+            return super().identity()
+        return f"{super().identity()}|{self.model or ''}"
+
+    def generation_identity(self):
+        return f"{super().generation_identity()}|{self.model or ''}"
+
+    def get_config(self):
+        return {
+            'name': self.name,
+            'addresses': self.addresses,
+            'system_prompt': self.system_prompt,
+            'stream': self.stream,
+            'max_concurrency': self.member_concurrency,
+            'tokenizer_path': self.tokenizer_path,
+            'max_context': self.max_context,
+            'type': self.get_type()
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['name'], config.get('addresses', []), config.get('system_prompt', ''),
+                   config.get('stream', True), config.get('max_concurrency', 1), config.get('tokenizer_path', ''),
+                   config.get('max_context', 0))
+
+    @staticmethod
+    def get_type():
+        return 'Pool'
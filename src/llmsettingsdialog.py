@@ -1,19 +1,27 @@
 from PyQt5.QtWidgets import (
     QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QLineEdit, QWidget,
     QFileDialog, QMessageBox, QComboBox, QFormLayout, QCheckBox,
-    QListWidget, QListWidgetItem, QSplitter, QSizePolicy
+    QListWidget, QListWidgetItem, QSplitter, QSizePolicy, QSpinBox, QPlainTextEdit
 )
 from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, QSize
 from PyQt5.QtGui import QFont
 
 import json
 import os
-from src.llm_base import LLMBase
+from src.llm_base import LLMBase, STATUS_CHECKING, STATUS_ONLINE, STATUS_OFFLINE
+
+STATUS_TEXT = {
+    STATUS_CHECKING: "Checking...",
+    STATUS_ONLINE: "Online",
+    STATUS_OFFLINE: "Offline",
+}
 
 class LLMSettingsDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.storywriter = parent
+        # The LLMs that were added or changed, see accept
+        self.new_llms = []
         self.setWindowTitle("LLM Settings")
         self.resize(800, 600)
         self.layout = QVBoxLayout(self)
@@ -44,7 +52,7 @@ class LLMSettingsDialog(QDialog):
         button_layout = QHBoxLayout()
         self.add_button = QComboBox()
         self.add_button.addItem("Add LLM")
-        self.add_button.addItems(['Kobold', 'OpenAI'])
+        self.add_button.addItems(['Kobold', 'OpenAI', 'Pool'])
         self.add_button.currentIndexChanged.connect(self.add_llm)
         load_button = QPushButton("Load Config")
         load_button.clicked.connect(self.load_config)
@@ -62,8 +70,20 @@ class LLMSettingsDialog(QDialog):
         self.token_count_llm_combo.setToolTip("Select the LLM to use for counting tokens")
         token_layout.addWidget(QLabel("LLM used for counting tokens:"))
         token_layout.addWidget(self.token_count_llm_combo)
+        self.count_concurrency_spin = QSpinBox()
+        self.count_concurrency_spin.setRange(1, 64)
+        self.count_concurrency_spin.setValue(self.storywriter.llm_manager.count_concurrency)
+        self.count_concurrency_spin.setToolTip("How many token counts may run against an LLM at the same time")
+        token_layout.addWidget(QLabel("Concurrent counts:"))
+        token_layout.addWidget(self.count_concurrency_spin)
         self.layout.addLayout(token_layout)
 
+        self.replay_checkbox = QCheckBox("Reuse the earlier response when a prompt has been generated before")
+        self.replay_checkbox.setChecked(self.storywriter.llm_manager.replay_generations)
+        self.replay_checkbox.setToolTip("""Generating a prompt the same LLM has already generated returns its most recent response
+instantly instead of generating again. Earlier responses are always available through "Previous generations".""")
+        self.layout.addWidget(self.replay_checkbox)
+
         # Close button at the bottom
         close_button = QPushButton("Close")
         close_button.clicked.connect(self.accept)
@@ -75,8 +95,12 @@ class LLMSettingsDialog(QDialog):
         # Populate the list with existing LLMs
         for llm in self.storywriter.llm_manager.llms:
             self.add_llm_item(llm)
+        self.storywriter.llm_manager.llmStatusChanged.connect(self.on_llm_status_changed)
 
         self.update_token_count_llm_combo()
+        index = self.token_count_llm_combo.findText(self.storywriter.llm_manager.token_count_llm_name or '')
+        if index >= 0:
+            self.token_count_llm_combo.setCurrentIndex(index)
 
         # Connect selection change in llmListWidget
         self.llmListWidget.currentItemChanged.connect(self.on_llm_selected)
@@ -91,10 +115,18 @@ class LLMSettingsDialog(QDialog):
         llm_data = llm.get_config()
         item.setData(Qt.UserRole, llm_data)
         # Set the display text with advanced formatting
-        self.update_list_item_text(item, llm_data['name'], "Not tested")
+        self.update_list_item_text(item, llm_data['name'], STATUS_TEXT[llm.status])
         self.llmListWidget.addItem(item)
         self.update_token_count_llm_combo()
 
+    # Startup connection checks may still be finishing while the dialog is open
+    def on_llm_status_changed(self, llm):
+        for index in range(self.llmListWidget.count()):
+            item = self.llmListWidget.item(index)
+            llm_data = item.data(Qt.UserRole)
+            if llm_data['name'] == llm.name:
+                self.update_list_item_text(item, llm_data['name'], STATUS_TEXT[llm.status])
+
     def update_list_item_text(self, item, name, status):
         # Create a multi-line text with name and status
         item.setText(f"{name}\n{status}")
@@ -105,7 +137,9 @@ class LLMSettingsDialog(QDialog):
         # Set size hint to accommodate two lines
         item.setSizeHint(QSize(item.sizeHint().width(), 40))
 
+    # Qt hands out copies of item data, so the edits are written back before another LLM is shown
     def on_llm_selected(self, current, previous):
+        self.store_current_llm_data(previous)
         if current:
             llm_data = current.data(Qt.UserRole)
             self.current_llm_data = llm_data
@@ -115,6 +149,11 @@ class LLMSettingsDialog(QDialog):
             self.current_llm_data = None
             self.clear_edit_widget()
 
+    def store_current_llm_data(self, item=None):
+        item = item or self.llmListWidget.currentItem()
+        if item is not None and self.current_llm_data is not None:
+            item.setData(Qt.UserRole, self.current_llm_data)
+
     def update_edit_widget(self):
         # Clear existing widgets
         self.clear_edit_widget()
@@ -134,10 +173,19 @@ class LLMSettingsDialog(QDialog):
         self.type_label = QLabel(llm_type)
         self.editLayout.addRow("Type:", self.type_label)
 
-        # Address field
-        self.address_edit = QLineEdit(llm_data.get('address', ''))
-        self.address_edit.textChanged.connect(self.on_address_changed)
-        self.editLayout.addRow("Address:", self.address_edit)
+        # Address field, a pool has one per member
+        if llm_type == 'Pool':
+            self.addresses_edit = QPlainTextEdit("\n".join(llm_data.get('addresses', [])))
+            self.addresses_edit.setPlaceholderText("One Kobold address per line")
+            self.addresses_edit.setToolTip("Kobold servers running the same model. Each request goes to the least busy one,\n"
+                                           "and to another one when it fails.")
+            self.addresses_edit.setMaximumHeight(100)
+            self.addresses_edit.textChanged.connect(self.on_addresses_changed)
+            self.editLayout.addRow("Addresses:", self.addresses_edit)
+        else:
+            self.address_edit = QLineEdit(llm_data.get('address', ''))
+            self.address_edit.textChanged.connect(self.on_address_changed)
+            self.editLayout.addRow("Address:", self.address_edit)
 
         # System prompt field
         self.system_prompt_edit = QLineEdit(llm_data.get('system_prompt', ''))
@@ -155,6 +203,55 @@ class LLMSettingsDialog(QDialog):
             self.use_env_var_checkbox.stateChanged.connect(self.on_use_env_var_changed)
             self.editLayout.addRow("", self.use_env_var_checkbox)
 
+            self.model_edit = QLineEdit(llm_data.get('model', 'text-davinci-003'))
+            self.model_edit.textChanged.connect(self.on_model_changed)
+            self.editLayout.addRow("Model:", self.model_edit)
+
+        self.stream_checkbox = QCheckBox("Stream responses as they are generated")
+        self.stream_checkbox.setChecked(llm_data.get('stream', True))
+        self.stream_checkbox.stateChanged.connect(self.on_stream_changed)
+        self.editLayout.addRow("", self.stream_checkbox)
+
+        # Wrapped in a widget so clear_edit_widget removes it along with the other rows
+        tokenizer_widget = QWidget()
+        tokenizer_layout = QHBoxLayout(tokenizer_widget)
+        tokenizer_layout.setContentsMargins(0, 0, 0, 0)
+        self.tokenizer_path_edit = QLineEdit(llm_data.get('tokenizer_path', ''))
+        self.tokenizer_path_edit.setPlaceholderText("Count tokens with the backend")
+        self.tokenizer_path_edit.setToolTip("Optional tokenizer.json, .tiktoken or SentencePiece .model file for counting tokens locally.\n"
+                                            "Counting then works without a round trip to the backend, even while it's unreachable.")
+        self.tokenizer_path_edit.textChanged.connect(self.on_tokenizer_path_changed)
+        tokenizer_browse_button = QPushButton("Browse...")
+        tokenizer_browse_button.clicked.connect(self.browse_tokenizer_path)
+        tokenizer_layout.addWidget(self.tokenizer_path_edit)
+        tokenizer_layout.addWidget(tokenizer_browse_button)
+        self.editLayout.addRow("Tokenizer File:", tokenizer_widget)
+
+        self.max_context_spin = QSpinBox()
+        self.max_context_spin.setRange(0, 1048576)
+        self.max_context_spin.setSpecialValueText("Ask the backend")
+        self.max_context_spin.setValue(llm_data.get('max_context', 0))
+        self.max_context_spin.setToolTip("Context length in tokens that prompts are fitted into.\n"
+                                         "Kobold reports its own, other backends send prompts untrimmed unless this is set.")
+        self.max_context_spin.valueChanged.connect(self.on_max_context_changed)
+        self.editLayout.addRow("Context Length:", self.max_context_spin)
+
+        self.max_concurrency_spin = QSpinBox()
+        self.max_concurrency_spin.setRange(1, 64)
+        self.max_concurrency_spin.setValue(llm_data.get('max_concurrency', 1))
+        if llm_type == 'Pool':
+            self.max_concurrency_spin.setToolTip("How many generations may run against each member at the same time")
+        else:
+            self.max_concurrency_spin.setToolTip("How many generations may run against this LLM at the same time")
+        self.max_concurrency_spin.valueChanged.connect(self.on_max_concurrency_changed)
+        self.editLayout.addRow("Concurrent generations:", self.max_concurrency_spin)
+
+        # How the backend has been doing lately, from the calls measured this session
+        performance_label = QLabel(self.storywriter.llm_manager.telemetry.summary(llm_data['name']))
+        performance_label.setWordWrap(True)
+        performance_label.setToolTip("Every call is also recorded in metrics.jsonl")
+        self.editLayout.addRow("Performance:", performance_label)
+
         # Test connection button and status label
         self.test_button = QPushButton("Test Connection")
         self.test_button.clicked.connect(self.test_connection)
@@ -187,6 +284,11 @@ class LLMSettingsDialog(QDialog):
         if self.current_llm_data:
             self.current_llm_data['address'] = text
 
+    def on_addresses_changed(self):
+        if self.current_llm_data:
+            lines = self.addresses_edit.toPlainText().splitlines()
+            self.current_llm_data['addresses'] = [line.strip() for line in lines if line.strip()]
+
     def on_system_prompt_changed(self, text):
         if self.current_llm_data:
             self.current_llm_data['system_prompt'] = text
@@ -199,6 +301,32 @@ class LLMSettingsDialog(QDialog):
         if self.current_llm_data:
             self.current_llm_data['use_env_var'] = bool(state)
 
+    def on_model_changed(self, text):
+        if self.current_llm_data:
+            self.current_llm_data['model'] = text
+
+    def on_stream_changed(self, state):
+        if self.current_llm_data:
+            self.current_llm_data['stream'] = bool(state)
+
+    def on_tokenizer_path_changed(self, text):
+        if self.current_llm_data:
+            self.current_llm_data['tokenizer_path'] = text
+
+    def browse_tokenizer_path(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Tokenizer File", "",
+                                                   "Tokenizer files (*.json *.tiktoken *.model);;All files (*)")
+        if file_path:
+            self.tokenizer_path_edit.setText(file_path)
+
+    def on_max_context_changed(self, value):
+        if self.current_llm_data:
+            self.current_llm_data['max_context'] = value
+
+    def on_max_concurrency_changed(self, value):
+        if self.current_llm_data:
+            self.current_llm_data['max_concurrency'] = value
+
     def remove_current_llm(self):
         item = self.llmListWidget.currentItem()
         if item:
@@ -252,7 +380,13 @@ class LLMSettingsDialog(QDialog):
             'api_key': '',
             'system_prompt': 'You are a helpful assistant.',
             'use_env_var': False,
+            'stream': True,
+            'max_concurrency': 1,
+            'tokenizer_path': '',
+            'max_context': 0,
         }
+        if llm_type == 'Pool':
+            llm_data['addresses'] = []
         # Create a QListWidgetItem
         item = QListWidgetItem()
         item.setData(Qt.UserRole, llm_data)
@@ -283,8 +417,8 @@ class LLMSettingsDialog(QDialog):
         with open(file_path, 'r') as f:
             data = json.load(f)
         # Clear existing LLMs
-        self.llmListWidget.clear()
         self.current_llm_data = None
+        self.llmListWidget.clear()
         self.clear_edit_widget()
         # Load LLMs
         for llm_data in data.get('llms', []):
@@ -294,6 +428,8 @@ class LLMSettingsDialog(QDialog):
             self.llmListWidget.addItem(item)
         self.update_token_count_llm_combo()
         # Set token counting LLM
+        self.count_concurrency_spin.setValue(data.get('count_concurrency', self.count_concurrency_spin.value()))
+        self.replay_checkbox.setChecked(data.get('replay_generations', self.replay_checkbox.isChecked()))
         token_count_llm_name = data.get('token_count_llm_name', '')
         index = self.token_count_llm_combo.findText(token_count_llm_name)
         if index >= 0:
@@ -306,6 +442,7 @@ class LLMSettingsDialog(QDialog):
         file_path, _ = file_dialog.getSaveFileName()
         if not file_path:
             return
+        self.store_current_llm_data()
         data = {}
         llms_data = []
         for index in range(self.llmListWidget.count()):
@@ -314,22 +451,44 @@ class LLMSettingsDialog(QDialog):
             llms_data.append(llm_data)
         data['llms'] = llms_data
         data['token_count_llm_name'] = self.token_count_llm_combo.currentText()
+        data['count_concurrency'] = self.count_concurrency_spin.value()
+        data['replay_generations'] = self.replay_checkbox.isChecked()
         with open(file_path, 'w') as f:
             json.dump(data, f)
 
     def accept(self):
-        # Update the llm_manager's LLMs
+        self.store_current_llm_data()
+        # Update the llm_manager's LLMs. Unchanged ones are kept, so their running generations go on.
+        previous = list(self.storywriter.llm_manager.llms)
         self.storywriter.llm_manager.llms = []
+        self.new_llms = []
         for index in range(self.llmListWidget.count()):
             item = self.llmListWidget.item(index)
             llm_data = item.data(Qt.UserRole)
             # Create LLM instance from llm_data
             llm = LLMBase.create_llm(llm_data)
             if llm:
+                unchanged = next((old for old in previous if old.get_config() == llm.get_config()), None)
+                if unchanged is not None:
+                    previous.remove(unchanged)
+                    llm.close()
+                    llm = unchanged
+                else:
+                    self.new_llms.append(llm)
                 self.storywriter.llm_manager.llms.append(llm)
+        # The connection pools of replaced and removed LLMs are closed
+        for llm in previous:
+            llm.close()
         self.storywriter.llm_manager.token_count_llm_name = self.token_count_llm_combo.currentText()
+        self.storywriter.llm_manager.count_concurrency = self.count_concurrency_spin.value()
+        self.storywriter.llm_manager.replay_generations = self.replay_checkbox.isChecked()
+        self.storywriter.llm_manager.llmStatusChanged.disconnect(self.on_llm_status_changed)
         super().accept()
 
+    def reject(self):
+        self.storywriter.llm_manager.llmStatusChanged.disconnect(self.on_llm_status_changed)
+        super().reject()
+
 class TestConnectionWorker(QObject):
     finished = pyqtSignal(bool)
     progress = pyqtSignal(str)
@@ -341,29 +500,17 @@ class TestConnectionWorker(QObject):
     def run(self):
         self.progress.emit("Connecting...")
 
+        llm = None
         try:
-            llm_type = self.llm_data['type']
-            if llm_type == 'OpenAI':
-                from src.llm_openai import LLMOpenAI
-                llm = LLMOpenAI(
-                    self.llm_data['name'],
-                    self.llm_data['address'],
-                    self.llm_data['api_key'],
-                    self.llm_data['system_prompt'],
-                    self.llm_data['use_env_var']
-                )
-            elif llm_type == 'Kobold':
-                from src.llm_kobold import LLMKobold
-                llm = LLMKobold(
-                    self.llm_data['name'],
-                    self.llm_data['address'],
-                    self.llm_data['system_prompt']
-                )
-            # Add other LLM types if needed
+            llm = LLMBase.create_llm(self.llm_data)
             success = llm.test_connection()
         except Exception as e:
             self.progress.emit(f"Connection failed: {str(e)}")
             success = False
+        finally:
+            # The LLM was only made for the test, its sessions aren't needed anymore
+            if llm is not None:
+                llm.close()
 
         self.progress.emit("Finishing up...")
         self.finished.emit(success)
@@ -0,0 +1,80 @@
+# src/objectindex.py
+#
+# Finds the story objects a piece of text refers to, by name or alias, without scanning every
+# object: names are indexed by their first word and the text is read word by word. Objects that
+# share a tag with a referenced object are its neighbours.
+
+import re
+
+WORD = re.compile(r"\w+(?:['’]\w+)*")
+# Tags shared by more objects than this (like "character") say too little to pull in neighbours
+MAX_TAG_FANOUT = 8
+
+def words(text):
+    result = []
+    for word in WORD.findall(text.lower()):
+        if word.endswith(("'s", "’s")):
+            word = word[:-2]
+        result.append(word)
+    return result
+
+def split_list(text):
+    return [item.strip() for item in text.split(',') if item.strip()]
+
+
+class StoryObjectIndex:
+    def __init__(self, objects=()):
+        # First word of a name or alias -> [(all its words, object)]
+        self.phrases = {}
+        # Tag -> objects with that tag
+        self.tags = {}
+        # Object -> (its phrases, its tags), so it can be taken out again
+        self.entries = {}
+        for obj in objects:
+            self.update(obj)
+
+    # (Re)indexes an object after it was added or edited
+    def update(self, obj):
+        self.remove(obj)
+        phrases = []
+        for name in [obj.name] + split_list(obj.aliases):
+            phrase = tuple(words(name))
+            if phrase:
+                phrases.append(phrase)
+                self.phrases.setdefault(phrase[0], []).append((phrase, obj))
+        tags = {tag.lower() for tag in split_list(obj.tags)}
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(obj)
+        self.entries[obj] = (phrases, tags)
+
+    def remove(self, obj):
+        entry = self.entries.pop(obj, None)
+        if entry is None:
+            return
+        phrases, tags = entry
+        for phrase in phrases:
+            matches = [match for match in self.phrases[phrase[0]] if match[1] is not obj]
+            if matches:
+                self.phrases[phrase[0]] = matches
+            else:
+                del self.phrases[phrase[0]]
+        for tag in tags:
+            self.tags[tag].discard(obj)
+            if not self.tags[tag]:
+                del self.tags[tag]
+
+    # Returns the objects the texts mention by name or alias, and the objects sharing a tag with those
+    def find(self, *texts):
+        referenced = set()
+        for text in texts:
+            text_words = words(text)
+            for i, word in enumerate(text_words):
+                for phrase, obj in self.phrases.get(word, ()):
+                    if tuple(text_words[i:i + len(phrase)]) == phrase:
+                        referenced.add(obj)
+        neighbours = set()
+        for obj in referenced:
+            for tag in self.entries[obj][1]:
+                if len(self.tags[tag]) <= MAX_TAG_FANOUT:
+                    neighbours.update(self.tags[tag])
+        return referenced, neighbours - referenced
@@ -0,0 +1,316 @@
+# src/prompt.py
+#
+# Prompts are planned as a list of sections, and only put together once the backend that
+# will run them is known, so they can be fitted into that backend's context window.
+
+import hashlib
+
+# How a section is shortened when the prompt doesn't fit
+TRIM_NONE = 'none'              # always included in full
+TRIM_DROP_OLDEST = 'oldest'     # items are dropped from the front, oldest first
+TRIM_KEEP_END = 'keep_end'      # text is cut from the front, keeping what's closest to the new scene
+TRIM_KEEP_START = 'keep_start'  # text is cut from the end
+
+# Classic keeps sections in the order they were added. Stable puts the sections marked stable
+# (title, background, genre, closed chapter summaries) first and keeps them byte-identical
+# between prompts, so backends that reuse their KV cache for a shared prefix only process the rest.
+LAYOUT_CLASSIC = 'classic'
+LAYOUT_STABLE = 'stable'
+# In the stable layout the prefix is fitted into this share of the prompt budget on its own,
+# so what the volatile sections need never changes it
+STABLE_PREFIX_SHARE = 0.5
+
+# Sections are shortened in this order until the prompt fits, each one as far as it goes
+DEFAULT_TRIM_ORDER = ['earlier_passages', 'chapter_summaries', 'scene_summaries', 'story_objects', 'previous_scene', 'background', 'chapter_text']
+
+# Used when no token count for a piece of text is known, deliberately on the high side
+CHARS_PER_TOKEN = 3.5
+# Leeway for estimated counts and the tokens added where sections are joined
+SAFETY_MARGIN = 0.05
+MIN_SAFETY_TOKENS = 32
+
+class PromptSection:
+    def __init__(self, name, items, heading='', item_prefix='', trim=TRIM_NONE, tokens=None, stable=False):
+        self.name = name
+        self.stable = stable
+        self.heading = heading
+        self.item_prefix = item_prefix
+        self.trim = trim
+        # Token counts of the items that are already known, None where unknown
+        self.items = list(items)
+        self.tokens = list(tokens) if tokens is not None else [None] * len(self.items)
+
+    def render(self):
+        if not self.items:
+            return ''
+        return self.heading + ''.join(self.item_prefix + item for item in self.items)
+
+    def copy(self):
+        return PromptSection(self.name, self.items, self.heading, self.item_prefix, self.trim, self.tokens, self.stable)
+
+
+class PromptPlan:
+    def __init__(self, sections=None, trim_order=None, token_cache=None, count_llm=None, layout=LAYOUT_CLASSIC):
+        self.sections = sections or []
+        self.trim_order = trim_order or DEFAULT_TRIM_ORDER
+        self.layout = layout
+        self.token_cache = token_cache
+        self.count_llm = count_llm
+        self.trimmed = []
+        # Estimated tokens of the last prompt built to fit a context, None when it wasn't fitted
+        self.prompt_tokens = None
+
+    def add(self, name, items, **kwargs):
+        if isinstance(items, str):
+            items = [items]
+        self.sections.append(PromptSection(name, items, **kwargs))
+
+    def render(self, sections=None):
+        return ''.join(section.render() for section in (self.ordered_sections() if sections is None else sections))
+
+    def ordered_sections(self):
+        if self.layout != LAYOUT_STABLE:
+            return list(self.sections)
+        return [section for section in self.sections if section.stable] + [section for section in self.sections if not section.stable]
+
+    # Just the stable prefix, as sent to prime a backend's cache
+    def stable_prefix(self):
+        return PromptPlan([section for section in self.sections if section.stable], self.trim_order,
+                          self.token_cache, self.count_llm, self.layout)
+
+    # Counting is only used for planning, so cached and local counts are used and anything else is estimated
+    def count(self, llm, text):
+        if self.token_cache is not None:
+            for counter in (llm, self.count_llm):
+                count = self.token_cache.get(counter, text)
+                if count is not None:
+                    return count
+        if llm is not None:
+            count = llm.count_tokens_locally(text)
+            if count is not None:
+                return count
+        return int(len(text) / CHARS_PER_TOKEN) + 1
+
+    # Puts the prompt together so that it and max_length generated tokens fit into the backend's context.
+    # Sections are shortened in trim_order, the names of the ones that were shortened end up in self.trimmed.
+    # The plan itself is left as it is, so it can be built again for another backend.
+    def build(self, llm, max_length):
+        self.trimmed = []
+        self.prompt_tokens = None
+        budget = self.budget(llm, max_length)
+        if budget is None:
+            return self.render()
+        sections = self.counted(self.ordered_sections(), llm)
+        # A prompt that fits is sent whole in either layout
+        if self.layout == LAYOUT_STABLE and self.total_tokens(sections, llm) > budget:
+            # The prefix is fitted first against a fixed budget, then the volatile tail gets what's left
+            stable = [section for section in sections if section.stable]
+            self.trim(stable, int(budget * STABLE_PREFIX_SHARE), llm)
+            volatile_budget = budget - self.total_tokens(stable, llm)
+            volatile = [section for section in sections if not section.stable]
+            total = self.trim(volatile, volatile_budget, llm)
+            if total > volatile_budget:
+                self.trim(stable, budget - total, llm)
+        else:
+            self.trim(sections, budget, llm)
+        self.prompt_tokens = self.total_tokens(sections, llm)
+        return self.render(sections)
+
+    # Tokens left for the prompt in llm's context, None when its context isn't known
+    def budget(self, llm, max_length):
+        max_context = llm.get_max_context() if llm is not None else 0
+        if not max_context:
+            return None
+        return max_context - max_length - max(MIN_SAFETY_TOKENS, int(max_context * SAFETY_MARGIN))
+
+    # Copies of sections with the tokens of every item filled in
+    def counted(self, sections, llm):
+        sections = [section.copy() for section in sections]
+        for section in sections:
+            # Items are counted on their own so cached counts of the texts they come from can be used
+            prefix_tokens = self.count(llm, section.item_prefix) if section.item_prefix else 0
+            section.tokens = [(count if count is not None else self.count(llm, item)) + prefix_tokens
+                              for item, count in zip(section.items, section.tokens)]
+        return sections
+
+    # Whether build leaves the stable sections whole for llm, however long the rest of the prompt gets.
+    # That's when they fit into their share of the budget, unless the rest can't be made to fit even then.
+    def stable_prefix_fits(self, llm, max_length):
+        budget = self.budget(llm, max_length)
+        if budget is None:
+            return True
+        stable = self.counted([section for section in self.sections if section.stable], llm)
+        return self.total_tokens(stable, llm) <= int(budget * STABLE_PREFIX_SHARE)
+
+    # Shortens sections in trim_order until they fit the budget, returns their total tokens
+    def trim(self, sections, budget, llm):
+        total = self.total_tokens(sections, llm)
+        for name in self.trim_order:
+            if total <= budget:
+                break
+            for section in sections:
+                if section.name != name or section.trim == TRIM_NONE:
+                    continue
+                before = total
+                total = self.trim_section(section, total, budget, llm)
+                if total < before and section.name not in self.trimmed:
+                    self.trimmed.append(section.name)
+        return total
+
+    def total_tokens(self, sections, llm):
+        total = 0
+        for section in sections:
+            if section.items:
+                total += sum(section.tokens) + (self.count(llm, section.heading) if section.heading else 0)
+        return total
+
+    def trim_section(self, section, total, budget, llm):
+        if section.trim == TRIM_DROP_OLDEST:
+            while section.items and total > budget:
+                total -= section.tokens.pop(0)
+                section.items.pop(0)
+                if not section.items and section.heading:
+                    total -= self.count(llm, section.heading)
+            return total
+        # Text sections are a single item that is cut down to the tokens left over, assuming an even density
+        while section.items and total > budget:
+            text = section.items[0]
+            tokens = section.tokens[0]
+            keep = tokens - (total - budget)
+            if keep <= 0 or len(text) == 0:
+                total -= tokens
+                section.items = []
+                section.tokens = []
+                if section.heading:
+                    total -= self.count(llm, section.heading)
+                break
+            chars = int(len(text) * keep / tokens)
+            text = text[len(text) - chars:] if section.trim == TRIM_KEEP_END else text[:chars]
+            text = self.cut_at_paragraph(text, section.trim)
+            section.items = [text]
+            section.tokens = [min(keep, self.count(llm, text))]
+            total += section.tokens[0] - tokens
+        return total
+
+    # Prefers to cut at a paragraph break, or at least a word break, instead of mid-word
+    @staticmethod
+    def cut_at_paragraph(text, trim):
+        for separator in ('\n', ' '):
+            if trim == TRIM_KEEP_END:
+                index = text.find(separator)
+                if 0 <= index < len(text) // 2:
+                    return text[index + 1:]
+            else:
+                index = text.rfind(separator)
+                if index > len(text) // 2:
+                    return text[:index]
+        return text
+
+
+# Prompts for a story model (see storymodel.py). Only the model is read, so these can run
+# without any widgets. Token counts the model already knows are passed on to the plan.
+
+def new_prompt_plan(story, token_cache=None, count_llm=None):
+    # Retrieved passages are extras, so they go first when a trim order from before they existed doesn't mention them
+    trim_order = story.prompt_trim_order
+    if 'earlier_passages' not in trim_order:
+        trim_order = ['earlier_passages'] + trim_order
+    return PromptPlan(trim_order=trim_order, token_cache=token_cache, count_llm=count_llm, layout=story.prompt_layout)
+
+def known_tokens(count):
+    return count if count >= 0 else None
+
+# The sections every scene prompt starts with, up to the summaries of the chapters before chapter_index.
+# They're marked stable so the stable layout keeps them byte-identical between prompts. The classic layout
+# has the story objects mentioned in object_texts after the genre, the stable one leaves them to add_scene_prompt.
+def add_story_prefix(plan, story, chapter_index, object_texts=()):
+    plan.add('header', "{{[INPUT]}}\nYou are to take the role of an author writing a story. The story is titled \"" + story.title + "\".",
+             stable=True)
+    if len(story.summary) > 0:
+        plan.add('background', story.summary, heading="\n\nGeneral background information: ", trim=TRIM_KEEP_START, stable=True)
+    if len(story.genre) > 0:
+        plan.add('genre', "\n\nGenre: " + story.genre, stable=True)
+    if object_texts and plan.layout != LAYOUT_STABLE:
+        add_story_objects(plan, story, *object_texts)
+    chapters = story.chapters[:chapter_index + 1]
+    plan.add('chapter_summaries', [chapter.summary for chapter in chapters],
+             tokens=[known_tokens(chapter.summary_tokens) for chapter in chapters],
+             heading="\n\nThe story so far has had the following major events happen:", item_prefix="\n\n",
+             trim=TRIM_DROP_OLDEST, stable=True)
+    return plan
+
+# Only the story objects the texts mention are included, with their long description, along with
+# the objects sharing a tag with those, with their short description. Which objects these are changes
+# from scene to scene, so they're not part of the stable prefix. Neighbours come first so they're trimmed first.
+def add_story_objects(plan, story, *texts):
+    referenced, neighbours = story.object_index.find(*texts)
+    if not referenced:
+        return
+    items = [f"{obj.name}: {obj.short_desc}" for obj in story.story_objects if obj in neighbours]
+    items += [f"{obj.name}: {obj.long_desc or obj.short_desc}" for obj in story.story_objects if obj in referenced]
+    plan.add('story_objects', items, heading="\n\nStory Objects:", item_prefix="\n- ", trim=TRIM_DROP_OLDEST)
+
+# Passages from the chapters before chapter_index that match the query, the best match last so it's
+# trimmed last and ends up closest to the instruction
+def add_earlier_passages(plan, story, chapter_index, query):
+    if story.retrieved_passages <= 0 or chapter_index == 0:
+        return
+    chapter_titles = {scene.id: chapter.title for chapter in story.chapters[:chapter_index] for scene in chapter.scenes}
+    story.scene_index.refresh(story)
+    passages = story.scene_index.search(query, chapter_titles, story.retrieved_passages)
+    if passages:
+        plan.add('earlier_passages', [f"From \"{chapter_titles[passage.scene_id]}\": {passage.text}" for passage in reversed(passages)],
+                 heading="\n\nThese passages from earlier in the story may be relevant:", item_prefix="\n\n", trim=TRIM_DROP_OLDEST)
+
+def add_scene_prompt(plan, story, chapter_index, scene_index):
+    chapter = story.chapters[chapter_index]
+    scene = chapter.scenes[scene_index]
+    previous_text = chapter.scenes[scene_index - 1].text if scene_index > 0 else ''
+    add_story_prefix(plan, story, chapter_index, (scene.summary, previous_text))
+    plan.add('chapter_title', "\n\nThe current chapter is titled \"" + chapter.title + "\"")
+    if plan.layout == LAYOUT_STABLE:
+        add_story_objects(plan, story, scene.summary, previous_text)
+    previous_summary = chapter.scenes[scene_index - 1].summary if scene_index > 0 else ''
+    add_earlier_passages(plan, story, chapter_index, scene.summary + "\n" + previous_summary)
+    if scene_index > 1:
+        earlier = chapter.scenes[:scene_index - 1]
+        plan.add('scene_summaries', [other.summary for other in earlier], tokens=[known_tokens(other.summary_tokens) for other in earlier],
+                 heading="\n\nThe following scenes have already happened in this chapter:", item_prefix="\n", trim=TRIM_DROP_OLDEST)
+    if scene_index > 0:
+        previous = chapter.scenes[scene_index - 1]
+        plan.add('previous_scene', previous.text, tokens=[known_tokens(previous.text_tokens)],
+                 heading="\n\nThe most recent scene before this one was:\n\n", trim=TRIM_KEEP_END)
+    plan.add('instruction', "\n\nYou are now writing the next scene in which the following occurs: " + scene.summary
+             + "\n\n" + story.scene_generation_prompt + "\n{{[OUTPUT]}}")
+    return plan
+
+# The prompt for summarizing the text of the chapter at chapter_index
+def add_chapter_summary_prompt(plan, story, chapter_index):
+    if plan.layout == LAYOUT_STABLE:
+        # Shares its prefix with the prompts for the scenes of the chapter being summarized
+        add_story_prefix(plan, story, chapter_index)
+    else:
+        plan.add('header', "{{[INPUT]}}\nYou are to take the role of an author writing a story. The story is titled \"" + story.title + "\".")
+        if len(story.summary) > 0:
+            plan.add('background', story.summary, heading="\nGeneral background information: ", trim=TRIM_KEEP_START)
+        if len(story.genre) > 0:
+            plan.add('genre', "\n\nGenre: " + story.genre)
+    scenes = story.chapters[chapter_index].scenes
+    plan.add('chapter_text', [scene.text for scene in scenes], tokens=[known_tokens(scene.text_tokens) for scene in scenes],
+             heading="\n\nThe most recent chapter of the story is:", item_prefix="\n\n", trim=TRIM_DROP_OLDEST)
+    plan.add('instruction', "\n\n" + story.chapter_summary_prompt + "\n{{[OUTPUT]}}")
+    return plan
+
+# Identifies everything add_chapter_summary_prompt puts into the prompt for the chapter at chapter_index, so a
+# summary generated from it is only current while none of that changes. In the stable layout that includes
+# the summaries of the chapters up to it.
+def chapter_summary_source_hash(story, chapter_index):
+    parts = [story.title, story.summary, story.genre, story.chapter_summary_prompt, story.prompt_layout]
+    if story.prompt_layout == LAYOUT_STABLE:
+        parts += [chapter.summary for chapter in story.chapters[:chapter_index + 1]]
+    parts.append(story.chapters[chapter_index].text_hash())
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
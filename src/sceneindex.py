@@ -0,0 +1,160 @@
+# src/sceneindex.py
+#
+# Finds passages from earlier scenes that are relevant to the scene being written, so plot threads
+# from many chapters ago can come back into its prompt. Scene texts are split into passages of a
+# few paragraphs, which are ranked together with the scene summaries against a query with BM25.
+# The index is brought up to date before each search, and only scenes that changed are read again.
+# Passages only remember where they are in their scene, so texts that are still on disk stay there
+# and only the passages that are found get read.
+
+import math
+import re
+
+from src.objectindex import words
+
+# Passages are built from paragraphs, or the sentences of long paragraphs, until they reach this many words
+PASSAGE_WORDS = 150
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# The usual BM25 parameters: how quickly repeated terms stop adding to a score, and how much longer
+# passages are penalized for containing more terms
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Words too common to say anything about which passage is relevant
+STOPWORDS = frozenset("""
+a about after again all also an and any are as at be been before being but by can could did do does
+down for from had has have he her here hers him his how i if in into is it its just me more most my
+no not now of off on once only or other our out over own said same she so some such than that the their
+them then there these they this those through to too under up upon very was we were what when where
+which while who whom why will with would you your
+""".split())
+
+def terms(text):
+    return [word for word in words(text) if word not in STOPWORDS]
+
+PARAGRAPH = re.compile(r"[^\n]*\S[^\n]*")
+
+# Returns the (start, end) of each passage in text. Long paragraphs are split at sentence ends, short ones are grouped.
+def split_passages(text):
+    pieces = []
+    for paragraph in PARAGRAPH.finditer(text):
+        start, end = paragraph.span()
+        sentences = []
+        for match in SENTENCE_END.finditer(text, start, end):
+            sentences.append((start, match.start()))
+            start = match.end()
+        sentences.append((start, end))
+        pieces.extend(group(text, sentences))
+    return group(text, pieces)
+
+def group(text, pieces):
+    groups = []
+    first = None
+    length = 0
+    for start, end in pieces:
+        if first is None:
+            first = start
+        length += len(text[start:end].split())
+        if length >= PASSAGE_WORDS:
+            groups.append((first, end))
+            first = None
+            length = 0
+    if first is not None:
+        groups.append((first, pieces[-1][1]))
+    return groups
+
+
+# A piece of a scene's text, or its summary when start is None
+class Passage:
+    __slots__ = ('scene', 'start', 'end', 'length')
+
+    def __init__(self, scene, start, end, length):
+        self.scene = scene
+        self.start = start
+        self.end = end
+        self.length = length
+
+    @property
+    def scene_id(self):
+        return self.scene.id
+
+    # Only valid while the scene is as it was indexed, which refresh makes sure of before every search
+    @property
+    def text(self):
+        if self.start is None:
+            return self.scene.summary
+        return self.scene.read_text()[self.start:self.end].strip()
+
+
+class SceneIndex:
+    def __init__(self):
+        # Scene id -> (the scene's snapshot when it was indexed, its passages)
+        self.scenes = {}
+        # Term -> {passage: how often the term occurs in it}
+        self.postings = {}
+        self.total_length = 0
+        self.passage_count = 0
+
+    # Indexes new and changed scenes of the story and forgets deleted ones
+    def refresh(self, story):
+        current = set()
+        for chapter in story.chapters:
+            for scene in chapter.scenes:
+                current.add(scene.id)
+                snapshot = scene.snapshot()
+                entry = self.scenes.get(scene.id)
+                if entry is None or entry[0] != snapshot:
+                    self.remove(scene.id)
+                    self.add(scene, snapshot)
+        for scene_id in [scene_id for scene_id in self.scenes if scene_id not in current]:
+            self.remove(scene_id)
+
+    def add(self, scene, snapshot):
+        passages = []
+        # read_text leaves texts that are still on disk there
+        text = scene.read_text()
+        for start, end in [(None, None)] + split_passages(text):
+            counts = {}
+            for term in terms(scene.summary if start is None else text[start:end]):
+                counts[term] = counts.get(term, 0) + 1
+            if not counts:
+                continue
+            passage = Passage(scene, start, end, sum(counts.values()))
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[passage] = count
+            self.total_length += passage.length
+            self.passage_count += 1
+            passages.append((passage, counts))
+        self.scenes[scene.id] = (snapshot, passages)
+
+    def remove(self, scene_id):
+        entry = self.scenes.pop(scene_id, None)
+        if entry is None:
+            return
+        for passage, counts in entry[1]:
+            for term in counts:
+                postings = self.postings[term]
+                del postings[passage]
+                if not postings:
+                    del self.postings[term]
+            self.total_length -= passage.length
+            self.passage_count -= 1
+
+    # Returns up to limit passages from the scenes in scene_ids, the best match first
+    def search(self, query, scene_ids, limit):
+        if not self.passage_count or limit <= 0:
+            return []
+        average_length = self.total_length / self.passage_count
+        scores = {}
+        for term in set(terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (self.passage_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage, count in postings.items():
+                if passage.scene_id not in scene_ids:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * passage.length / average_length)
+                scores[passage] = scores.get(passage, 0) + idf * count * (BM25_K1 + 1) / (count + norm)
+        return sorted(scores, key=scores.get, reverse=True)[:limit]
@@ -1,4 +1,6 @@
-from PyQt5.QtWidgets import QDialog, QHBoxLayout, QVBoxLayout, QFormLayout, QPushButton, QTextEdit, QLineEdit
+from PyQt5.QtWidgets import QDialog, QHBoxLayout, QVBoxLayout, QFormLayout, QPushButton, QTextEdit, QLineEdit, QComboBox, QCheckBox, QSpinBox
+
+from src.prompt import LAYOUT_CLASSIC, LAYOUT_STABLE
 
 from src.tokenizedtextedit import TokenizedTextEdit
 
@@ -12,18 +14,18 @@ class SettingsDialog(QDialog):
         form_layout = QFormLayout()
 
         # Title input
-        self.title = QLineEdit(self.storywriter.storytitle)
+        self.title = QLineEdit(self.storywriter.story.title)
         form_layout.addRow("Title", self.title)
         self.title.setToolTip("The title of the story. This is also currently used as the filename when saving or exporting the story.")
 
         # Genre input
-        self.genre = QLineEdit()
+        self.genre = QLineEdit(self.storywriter.story.genre)
         form_layout.addRow("Genre", self.genre)
         self.genre.setToolTip("Specify the genre of your story.")
 
         # Summary input
         self.summary = TokenizedTextEdit(parent.global_worker)
-        self.summary.setText(self.storywriter.summary)
+        self.summary.setText(self.storywriter.story.summary)
         form_layout.addRow("Background\nInformation", self.summary)
         self.summary.setToolTip("Background information is always added at the top of prompts sent to the LLM.")
 
@@ -35,6 +37,29 @@ class SettingsDialog(QDialog):
         self.scene_generation_prompt.setPlaceholderText("Enter prompt for scene generation")
         form_layout.addRow("Scene Generation Prompt:", self.scene_generation_prompt)
 
+        self.prompt_trim_order = QLineEdit()
+        self.prompt_trim_order.setToolTip("""When a prompt doesn't fit into the LLM's context, these sections are shortened in this order until it does.
+Sections: earlier_passages, chapter_summaries, scene_summaries, story_objects, previous_scene, background, chapter_text
+earlier_passages is shortened first when it's left out.""")
+        form_layout.addRow("Prompt Trimming Order:", self.prompt_trim_order)
+
+        self.prompt_layout = QComboBox()
+        self.prompt_layout.addItem("Classic", LAYOUT_CLASSIC)
+        self.prompt_layout.addItem("Stable prefix", LAYOUT_STABLE)
+        self.prompt_layout.setToolTip("""Stable prefix keeps the title, background, genre and earlier chapter summaries identical
+at the start of every prompt, so Kobold can reuse its cache for them and only process the rest.""")
+        form_layout.addRow("Prompt Layout:", self.prompt_layout)
+
+        self.prime_cache = QCheckBox("Send the stable prefix to Kobold when a story is loaded")
+        self.prime_cache.setToolTip("The first scene generation after loading then only has to process the new part of its prompt.")
+        form_layout.addRow("", self.prime_cache)
+
+        self.retrieved_passages = QSpinBox()
+        self.retrieved_passages.setRange(0, 20)
+        self.retrieved_passages.setToolTip("""How many passages from earlier chapters that share the most words with the scene being written
+are added to its prompt. They're the first thing left out when the prompt doesn't fit. 0 turns this off.""")
+        form_layout.addRow("Earlier Passages:", self.retrieved_passages)
+
         self.layout.addLayout(form_layout)
 
         button_layout = QHBoxLayout()
@@ -48,9 +73,9 @@ class SettingsDialog(QDialog):
         self.layout.addLayout(button_layout)
 
     def accept(self):
-        self.storywriter.storytitle = self.title.text()
-        self.storywriter.summary = self.summary.toPlainText()
-        self.storywriter.genre = self.genre
+        self.storywriter.story.title = self.title.text()
+        self.storywriter.story.summary = self.summary.toPlainText()
+        self.storywriter.story.genre = self.genre.text()
         super().accept()
 
     def get_chapter_summary_prompt(self):
@@ -65,3 +90,29 @@ class SettingsDialog(QDialog):
     def set_scene_generation_prompt(self, prompt):
         self.scene_generation_prompt.setPlainText(prompt)
 
+
+    def get_prompt_trim_order(self):
+        return [name.strip() for name in self.prompt_trim_order.text().split(',') if name.strip()]
+
+    def set_prompt_trim_order(self, order):
+        self.prompt_trim_order.setText(", ".join(order))
+
+    def get_prompt_layout(self):
+        return self.prompt_layout.currentData()
+
+    def set_prompt_layout(self, layout):
+        index = self.prompt_layout.findData(layout)
+        if index >= 0:
+            self.prompt_layout.setCurrentIndex(index)
+
+    def get_prime_cache(self):
+        return self.prime_cache.isChecked()
+
+    def set_prime_cache(self, prime_cache):
+        self.prime_cache.setChecked(prime_cache)
+
+    def get_retrieved_passages(self):
+        return self.retrieved_passages.value()
+
+    def set_retrieved_passages(self, count):
+        self.retrieved_passages.setValue(count)
@@ -0,0 +1,150 @@
+# src/storyjournal.py
+#
+# Saves a story incrementally: only the scenes, chapters and settings that changed since the last
+# save are appended to a journal next to the story file, and the journal is folded back into the
+# story file once it has grown large. load_story in storymodel.py replays the journal.
+
+import json
+import os
+import threading
+
+from src.executor import SAVE_LANE
+from src.fileutil import atomic_write
+from src.storymodel import journal_path, new_id, write_story_data
+
+# The journal is compacted into the story file once it is this large, or this share of the story file's size
+COMPACT_MIN_BYTES = 256 * 1024
+COMPACT_RATIO = 0.5
+
+class StoryJournal:
+    # loaded means the story was just loaded from path, so the file there is its current revision.
+    # Otherwise the first save writes the whole story.
+    def __init__(self, story, path, loaded=False):
+        self.story = story
+        self.path = path
+        self.journal_path = journal_path(path)
+        self.saved = {}
+        # Stories from before revisions existed get one full save first
+        self.full_save_needed = not loaded or story.revision is None
+        # Batches waiting to be written, in order, see write_pending
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.journal_revision = self.read_revision() if loaded else None
+        if loaded:
+            self.collect()
+
+    # Returns the revision an existing journal was written for. A last line cut off by a crash is removed,
+    # so new entries don't get appended to it.
+    def read_revision(self):
+        try:
+            with open(self.journal_path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    f.truncate(end)
+            return json.loads(data[:data.find(b'\n')].decode('utf-8')).get('revision')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Compares the story with what was last saved and returns journal entries for the differences.
+    # Runs on the thread that edits the story; only references to the story's strings are taken.
+    def collect(self):
+        changes = []
+        saved = {}
+        story = self.story
+
+        settings = story.settings_dict()
+        if settings != self.saved.get('story'):
+            changes.append({'op': 'story', 'data': settings})
+        saved['story'] = settings
+
+        structure = story.structure()
+        if structure != self.saved.get('structure'):
+            changes.append({'op': 'structure', 'chapters': structure})
+        saved['structure'] = structure
+
+        for chapter in story.chapters:
+            snapshot = chapter.snapshot()
+            if snapshot != self.saved.get(chapter.id):
+                changes.append({'op': 'chapter', 'id': chapter.id, 'data': chapter.fields_dict()})
+            saved[chapter.id] = snapshot
+            for scene in chapter.scenes:
+                snapshot = scene.snapshot()
+                if snapshot != self.saved.get(scene.id):
+                    changes.append({'op': 'scene', 'id': scene.id, 'data': scene.to_dict()})
+                saved[scene.id] = snapshot
+        # Deleted chapters and scenes drop out here
+        self.saved = saved
+        return changes
+
+    # Queues what changed since the last save, or the whole story when the journal should be compacted.
+    # Returns whether anything needs writing, write_pending then does the writing.
+    def save(self):
+        changes = self.collect()
+        if self.full_save_needed or self.compaction_due():
+            self.full_save_needed = False
+            self.story.revision = new_id()
+            self.queue(('full', self.story.revision, self.story.to_dict()))
+            return True
+        if not changes:
+            return False
+        self.queue(('changes', self.story.revision, changes))
+        return True
+
+    # Saves and writes on the calling thread, for when the program is about to exit
+    def flush(self):
+        self.save()
+        self.write_pending()
+
+    def queue(self, item):
+        with self.pending_lock:
+            self.pending.append(item)
+
+    def compaction_due(self):
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except OSError:
+            return False
+        try:
+            story_size = os.path.getsize(self.path)
+        except OSError:
+            return True
+        return journal_size > max(COMPACT_MIN_BYTES, story_size * COMPACT_RATIO)
+
+    # Writes everything queued so far, in the order it was queued, whichever thread calls it
+    def write_pending(self):
+        with self.write_lock:
+            with self.pending_lock:
+                items = self.pending
+                self.pending = []
+            for kind, revision, data in items:
+                if kind == 'full':
+                    write_story_data(data, self.path)
+                    self.journal_revision = None
+                else:
+                    self.append(revision, data)
+
+    def append(self, revision, changes):
+        lines = ''.join(json.dumps(change) + '\n' for change in changes)
+        if self.journal_revision != revision:
+            # A journal left over from another revision is replaced
+            atomic_write(self.journal_path, json.dumps({'revision': revision}) + '\n' + lines)
+            self.journal_revision = revision
+            return
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# Runs a journal's queued writes on the executor's save lane, off the GUI thread
+class SaveTask:
+    lane = SAVE_LANE
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.llm_backend = None
+
+    def execute(self):
+        self.journal.write_pending()
@@ -0,0 +1,348 @@
+# src/storymodel.py
+#
+# The story itself, independent of any widgets. The Scene and Chapter widgets in storywriter.py
+# are views bound to these objects, so prompt building, saving and exporting only need the model
+# and can run without a QApplication or off the GUI thread.
+
+import hashlib
+import json
+import os
+import uuid
+
+from src.fileutil import atomic_write
+from src.objectindex import StoryObjectIndex
+from src.sceneindex import SceneIndex
+from src.prompt import DEFAULT_TRIM_ORDER, LAYOUT_CLASSIC, chapter_summary_source_hash
+from src.storypack import is_pack_path, is_pack_file, pack_story_data, read_pack_index, text_digest
+
+DEFAULT_CHAPTER_SUMMARY_PROMPT = "Please summarize this chapter in 200 words or less, focusing on the information that's important for writing future scenes in this story."
+DEFAULT_SCENE_GENERATION_PROMPT = "Please write out this scene."
+DEFAULT_RETRIEVED_PASSAGES = 3
+
+# Changes since the last full save are appended here, see storyjournal.py
+JOURNAL_SUFFIX = '.journal'
+
+# Token counts of -1 are unknown and get counted when the text is shown
+
+# Chapters and scenes keep their id for as long as they exist, so journal entries can refer to them
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+# Tags and aliases are comma-separated. Prompts include an object when its name or an alias
+# is mentioned, and objects sharing a tag with it, see objectindex.py.
+class StoryObject:
+    __slots__ = ('name', 'tags', 'short_desc', 'long_desc', 'aliases')
+
+    def __init__(self, name='', tags='', short_desc='', long_desc='', aliases=''):
+        self.name = name
+        self.tags = tags
+        self.short_desc = short_desc
+        self.long_desc = long_desc
+        self.aliases = aliases
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'aliases': self.aliases,
+            'tags': self.tags,
+            'short_desc': self.short_desc,
+            'long_desc': self.long_desc
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('name', ''), data.get('tags', ''), data.get('short_desc', ''), data.get('long_desc', ''),
+                   data.get('aliases', ''))
+
+
+class StoryScene:
+    __slots__ = ('id', 'summary', 'summary_tokens', '_text', 'text_source', 'text_tokens', '_text_hash')
+
+    def __init__(self, summary='', text='', summary_tokens=-1, text_tokens=-1, id=None, text_source=None):
+        self.id = id or new_id()
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        # Scenes loaded from a pack file read their text from text_source the first time it's needed.
+        # The source is kept until the text is changed, so the journal can tell an unchanged text by it.
+        self._text = text if text_source is None else None
+        self.text_source = text_source
+        self.text_tokens = text_tokens
+        # (text, its text_digest) for the text the digest was last taken of
+        self._text_hash = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.text_source.read()
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+        self.text_source = None
+
+    # The text, without keeping it in memory if it hasn't been loaded yet
+    def read_text(self):
+        return self._text if self._text is not None else self.text_source.read()
+
+    # Identifies the text. Texts still on disk are hashed in the pack's index, or hashed once without being kept.
+    def text_hash(self):
+        if self.text_source is not None:
+            if self.text_source.text_hash is None:
+                self.text_source.text_hash = text_digest(self.read_text())
+            return self.text_source.text_hash
+        if self._text_hash is None or self._text_hash[0] is not self._text:
+            self._text_hash = (self._text, text_digest(self._text))
+        return self._text_hash[1]
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'summary': self.summary,
+            'summaryTokens': self.summary_tokens,
+            'text': self.text,
+            'textTokens': self.text_tokens
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('summary', ''), data.get('text', ''),
+                   int(data.get('summaryTokens', -1)), int(data.get('textTokens', -1)), data.get('id'), data.get('textSource'))
+
+    def apply_dict(self, data):
+        self.summary = data.get('summary', self.summary)
+        self.summary_tokens = int(data.get('summaryTokens', self.summary_tokens))
+        if 'text' in data:
+            self.text = data['text']
+        self.text_tokens = int(data.get('textTokens', self.text_tokens))
+
+    # What the journal compares to find changed scenes. Unchanged strings are the same objects, so this is cheap.
+    def snapshot(self):
+        return (self.summary, self.summary_tokens, self._text if self.text_source is None else self.text_source, self.text_tokens)
+
+
+class StoryChapter:
+    __slots__ = ('id', 'title', 'summary', 'summary_tokens', 'summary_source_hash', 'scenes')
+
+    def __init__(self, title='', summary='', summary_tokens=-1, scenes=None, summary_source_hash='', id=None):
+        self.id = id or new_id()
+        self.title = title
+        # The summary of the previous chapter, see the README
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        # chapter_summary_source_hash() of the previous chapter when its summary was generated, see prompt.py.
+        # Empty for summaries that were written by hand.
+        self.summary_source_hash = summary_source_hash
+        self.scenes = scenes if scenes is not None else []
+
+    # Identifies the scene texts a summary of this chapter is generated from
+    def text_hash(self):
+        digest = hashlib.sha1()
+        for scene in self.scenes:
+            digest.update(scene.text_hash().encode('ascii'))
+        return digest.hexdigest()
+
+    def to_dict(self):
+        data = self.fields_dict()
+        data['scenes'] = [scene.to_dict() for scene in self.scenes]
+        return data
+
+    # Everything but the scenes
+    def fields_dict(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'summary': self.summary,
+            'summaryTokens': self.summary_tokens,
+            'summarySourceHash': self.summary_source_hash
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('title', ''), data.get('summary', ''), int(data.get('summaryTokens', -1)),
+                   [StoryScene.from_dict(scene) for scene in data.get('scenes', [])], data.get('summarySourceHash', ''),
+                   data.get('id'))
+
+    def apply_dict(self, data):
+        self.title = data.get('title', self.title)
+        self.summary = data.get('summary', self.summary)
+        self.summary_tokens = int(data.get('summaryTokens', self.summary_tokens))
+        self.summary_source_hash = data.get('summarySourceHash', self.summary_source_hash)
+
+    def snapshot(self):
+        return (self.title, self.summary, self.summary_tokens, self.summary_source_hash)
+
+
+class Story:
+    __slots__ = ('title', 'summary', 'genre', 'chapter_summary_prompt', 'scene_generation_prompt',
+                 'prompt_trim_order', 'prompt_layout', 'prime_cache', 'retrieved_passages', 'story_objects', 'object_index',
+                 'scene_index', 'chapters', 'revision')
+
+    def __init__(self):
+        # Changes with every full save, a journal only applies to the revision it was written for
+        self.revision = None
+        self.title = ""
+        # Background information, always at the top of prompts
+        self.summary = ""
+        self.genre = ""
+        self.chapter_summary_prompt = DEFAULT_CHAPTER_SUMMARY_PROMPT
+        self.scene_generation_prompt = DEFAULT_SCENE_GENERATION_PROMPT
+        # Which prompt sections are shortened first when a prompt doesn't fit the LLM's context
+        self.prompt_trim_order = list(DEFAULT_TRIM_ORDER)
+        self.prompt_layout = LAYOUT_CLASSIC
+        self.prime_cache = False
+        # How many passages from earlier chapters that match the scene being written go into its prompt
+        self.retrieved_passages = DEFAULT_RETRIEVED_PASSAGES
+        self.story_objects = []
+        # Kept up to date by whoever edits story_objects
+        self.object_index = StoryObjectIndex()
+        # Brought up to date whenever it's searched
+        self.scene_index = SceneIndex()
+        self.chapters = []
+
+    def to_dict(self):
+        data = self.settings_dict()
+        data['revision'] = self.revision
+        data['chapters'] = [chapter.to_dict() for chapter in self.chapters]
+        return data
+
+    # Everything but the chapters
+    def settings_dict(self):
+        return {
+            'title': self.title,
+            'chapter_summary_prompt': self.chapter_summary_prompt,
+            'scene_generation_prompt': self.scene_generation_prompt,
+            'summary': self.summary,
+            'genre': self.genre,
+            'prompt_trim_order': self.prompt_trim_order,
+            'prompt_layout': self.prompt_layout,
+            'prime_cache': self.prime_cache,
+            'retrieved_passages': self.retrieved_passages,
+            'story_objects': [obj.to_dict() for obj in self.story_objects]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        story = cls()
+        story.apply_settings(data)
+        story.revision = data.get('revision')
+        story.chapters = [StoryChapter.from_dict(chapter) for chapter in data.get('chapters', [])]
+        return story
+
+    def apply_settings(self, data):
+        self.title = data.get('title', self.title)
+        self.chapter_summary_prompt = data.get('chapter_summary_prompt', self.chapter_summary_prompt)
+        self.scene_generation_prompt = data.get('scene_generation_prompt', self.scene_generation_prompt)
+        self.summary = data.get('summary', self.summary)
+        self.genre = data.get('genre', self.genre)
+        self.prompt_trim_order = data.get('prompt_trim_order', self.prompt_trim_order)
+        self.prompt_layout = data.get('prompt_layout', self.prompt_layout)
+        self.prime_cache = data.get('prime_cache', self.prime_cache)
+        self.retrieved_passages = int(data.get('retrieved_passages', self.retrieved_passages))
+        if 'story_objects' in data:
+            self.story_objects = [StoryObject.from_dict(obj) for obj in data['story_objects']]
+            self.object_index = StoryObjectIndex(self.story_objects)
+
+    # The chapter and scene ids in story order
+    def structure(self):
+        return tuple((chapter.id, tuple(scene.id for scene in chapter.scenes)) for chapter in self.chapters)
+
+    # Replays one journal entry, as written by StoryJournal
+    def apply_change(self, change):
+        op = change.get('op')
+        if op == 'story':
+            self.apply_settings(change['data'])
+        elif op == 'structure':
+            # Chapters and scenes are moved to their new places, new ones start out empty
+            chapters = {chapter.id: chapter for chapter in self.chapters}
+            scenes = {scene.id: scene for chapter in self.chapters for scene in chapter.scenes}
+            self.chapters = []
+            for chapter_id, scene_ids in change['chapters']:
+                chapter = chapters.get(chapter_id) or StoryChapter(id=chapter_id)
+                chapter.scenes = [scenes.get(scene_id) or StoryScene(id=scene_id) for scene_id in scene_ids]
+                self.chapters.append(chapter)
+        elif op == 'chapter':
+            for chapter in self.chapters:
+                if chapter.id == change['id']:
+                    chapter.apply_dict(change['data'])
+                    break
+        elif op == 'scene':
+            for chapter in self.chapters:
+                for scene in chapter.scenes:
+                    if scene.id == change['id']:
+                        scene.apply_dict(change['data'])
+                        return
+
+    # Applies the journal written since this revision was saved. A journal for another revision is
+    # left over from before a full save and ignored, as is a last line that was cut off by a crash.
+    def apply_journal(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                header = f.readline()
+                try:
+                    if json.loads(header).get('revision') != self.revision:
+                        return
+                except ValueError:
+                    return
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        break
+                    self.apply_change(change)
+        except FileNotFoundError:
+            pass
+
+    # Returns (chapter index, scene index) of a scene in this story
+    def scene_position(self, scene):
+        for chapter_index, chapter in enumerate(self.chapters):
+            for scene_index, other in enumerate(chapter.scenes):
+                if other is scene:
+                    return chapter_index, scene_index
+        raise ValueError("Scene is not part of this story")
+
+    # Whether chapter_index has a summary generated from what the prompt for the chapter before it is now
+    def summary_is_current(self, chapter_index):
+        chapter = self.chapters[chapter_index]
+        return bool(chapter.summary.strip()) and chapter.summary_source_hash == chapter_summary_source_hash(self, chapter_index - 1)
+
+    # Summaries written by hand, or kept from before summaries were tracked, which regenerating leaves alone
+    def summary_is_handwritten(self, chapter_index):
+        chapter = self.chapters[chapter_index]
+        return bool(chapter.summary.strip()) and not chapter.summary_source_hash
+
+    def chapter_index(self, chapter):
+        for index, other in enumerate(self.chapters):
+            if other is chapter:
+                return index
+        raise ValueError("Chapter is not part of this story")
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+# Loads a story in either format, pack files are recognized by their content
+def load_story(path):
+    if is_pack_file(path):
+        story = Story.from_dict(read_pack_index(path))
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            story = Story.from_dict(json.load(f))
+    story.apply_journal(journal_path(path))
+    return story
+
+# A full save starts a new revision, which makes any journal of the previous one obsolete
+def save_story(story, path):
+    story.revision = new_id()
+    write_story_data(story.to_dict(), path)
+
+# Writes Story.to_dict() data in the format the file extension asks for
+def write_story_data(data, path):
+    if is_pack_path(path):
+        atomic_write(path, pack_story_data(data), 'wb')
+    else:
+        atomic_write(path, json.dumps(data))
+    try:
+        os.remove(journal_path(path))
+    except FileNotFoundError:
+        pass
@@ -6,6 +6,7 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtCore import Qt
 
+from src.storymodel import StoryObject
 from src.tokenizedtextedit import TokenizedTextEdit
 
 class StoryObjectDialog(QDialog):
@@ -27,12 +28,15 @@ class StoryObjectDialog(QDialog):
         self.details_widget.setLayout(self.details_layout)
 
         self.name_edit = QLineEdit()
+        self.aliases_edit = QLineEdit()
         self.tags_edit = QLineEdit()
         self.short_desc_edit = TokenizedTextEdit(self.storywriter.global_worker)
         self.long_desc_edit = TokenizedTextEdit(self.storywriter.global_worker)
 
         self.details_layout.addWidget(QLabel("Name:"))
         self.details_layout.addWidget(self.name_edit)
+        self.details_layout.addWidget(QLabel("Aliases (comma-separated):"))
+        self.details_layout.addWidget(self.aliases_edit)
         self.details_layout.addWidget(QLabel("Tags (comma-separated):"))
         self.details_layout.addWidget(self.tags_edit)
         self.details_layout.addWidget(QLabel("Short Description:"))
@@ -64,8 +68,8 @@ class StoryObjectDialog(QDialog):
 
     def load_objects(self):
         self.object_list.clear()
-        for obj in self.storywriter.story_objects:
-            item = QListWidgetItem(obj['name'])
+        for obj in self.storywriter.story.story_objects:
+            item = QListWidgetItem(obj.name)
             item.setData(Qt.UserRole, obj)
             self.object_list.addItem(item)
 
@@ -74,14 +78,11 @@ class StoryObjectDialog(QDialog):
         if not name:
             QMessageBox.warning(self, "Error", "Name cannot be empty.")
             return
-        obj = {
-            'name': name,
-            'tags': self.tags_edit.text(),
-            'short_desc': self.short_desc_edit.toPlainText(),
-            'long_desc': self.long_desc_edit.toPlainText()
-        }
-        self.storywriter.story_objects.append(obj)
-        item = QListWidgetItem(obj['name'])
+        obj = StoryObject(name, self.tags_edit.text(), self.short_desc_edit.toPlainText(), self.long_desc_edit.toPlainText(),
+                          self.aliases_edit.text())
+        self.storywriter.story.story_objects.append(obj)
+        self.storywriter.story.object_index.update(obj)
+        item = QListWidgetItem(obj.name)
         item.setData(Qt.UserRole, obj)
         self.object_list.addItem(item)
         self.clear_fields()
@@ -92,11 +93,13 @@ class StoryObjectDialog(QDialog):
             QMessageBox.warning(self, "Error", "No object selected.")
             return
         obj = current_item.data(Qt.UserRole)
-        obj['name'] = self.name_edit.text()
-        obj['tags'] = self.tags_edit.text()
-        obj['short_desc'] = self.short_desc_edit.toPlainText()
-        obj['long_desc'] = self.long_desc_edit.toPlainText()
-        current_item.setText(obj['name'])
+        obj.name = self.name_edit.text()
+        obj.tags = self.tags_edit.text()
+        obj.short_desc = self.short_desc_edit.toPlainText()
+        obj.long_desc = self.long_desc_edit.toPlainText()
+        obj.aliases = self.aliases_edit.text()
+        self.storywriter.story.object_index.update(obj)
+        current_item.setText(obj.name)
         self.clear_fields()
 
     def remove_object(self):
@@ -105,22 +108,25 @@ class StoryObjectDialog(QDialog):
             QMessageBox.warning(self, "Error", "No object selected.")
             return
         obj = current_item.data(Qt.UserRole)
-        self.storywriter.story_objects.remove(obj)
+        self.storywriter.story.story_objects.remove(obj)
+        self.storywriter.story.object_index.remove(obj)
         self.object_list.takeItem(self.object_list.row(current_item))
         self.clear_fields()
 
     def display_object(self, current, previous):
         if current:
             obj = current.data(Qt.UserRole)
-            self.name_edit.setText(obj['name'])
-            self.tags_edit.setText(obj['tags'])
-            self.short_desc_edit.setPlainText(obj['short_desc'])
-            self.long_desc_edit.setPlainText(obj['long_desc'])
+            self.name_edit.setText(obj.name)
+            self.aliases_edit.setText(obj.aliases)
+            self.tags_edit.setText(obj.tags)
+            self.short_desc_edit.setPlainText(obj.short_desc)
+            self.long_desc_edit.setPlainText(obj.long_desc)
         else:
             self.clear_fields()
 
     def clear_fields(self):
         self.name_edit.clear()
+        self.aliases_edit.clear()
         self.tags_edit.clear()
         self.short_desc_edit.setPlainText("")
         self.long_desc_edit.setPlainText("")
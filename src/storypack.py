@@ -0,0 +1,89 @@
+# src/storypack.py
+#
+# A compact story file: a fixed header, a JSON index with everything but the scene texts,
+# then each scene's text as its own zlib blob. Opening a story only reads the index, scene
+# texts are read and decompressed when they're first needed. The index holds exactly what
+# the JSON format holds, with each scene's "text" replaced by "textBlob": [offset, length]
+# and "textHash", so a text can be told apart from another without reading it.
+
+import hashlib
+import json
+import struct
+import zlib
+
+PACK_SUFFIX = '.story'
+MAGIC = b'STWPACK1'
+# Magic, then the length of the JSON index that follows
+HEADER = struct.Struct('<8sI')
+COMPRESSION_LEVEL = 6
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def is_pack_path(path):
+    return path.lower().endswith(PACK_SUFFIX)
+
+def is_pack_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# Turns story data in the JSON format (Story.to_dict) into the bytes of a pack file
+def pack_story_data(data):
+    blobs = []
+    offset = 0
+    index = dict(data)
+    index['chapters'] = []
+    for chapter in data.get('chapters', []):
+        chapter = dict(chapter)
+        scenes = []
+        for scene in chapter.get('scenes', []):
+            scene = dict(scene)
+            text = scene.pop('text', '')
+            blob = zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)
+            scene['textBlob'] = [offset, len(blob)]
+            scene['textHash'] = text_digest(text)
+            offset += len(blob)
+            blobs.append(blob)
+            scenes.append(scene)
+        chapter['scenes'] = scenes
+        index['chapters'].append(chapter)
+    index_bytes = json.dumps(index).encode('utf-8')
+    return HEADER.pack(MAGIC, len(index_bytes)) + index_bytes + b''.join(blobs)
+
+# Returns the index of a pack file, with a PackedText in place of each scene's textBlob
+def read_pack_index(path):
+    with open(path, 'rb') as f:
+        magic, length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a story pack")
+        index = json.loads(f.read(length).decode('utf-8'))
+    base = HEADER.size + length
+    for chapter in index.get('chapters', []):
+        for scene in chapter.get('scenes', []):
+            offset, size = scene.pop('textBlob')
+            # Packs written before texts were hashed get theirs when first asked for
+            scene['textSource'] = PackedText(path, base + offset, size, scene.pop('textHash', None))
+    return index
+
+# The full JSON-format data of a pack file, every scene text included
+def unpack_story_data(path):
+    index = read_pack_index(path)
+    for chapter in index.get('chapters', []):
+        for scene in chapter.get('scenes', []):
+            scene['text'] = scene.pop('textSource').read()
+    return index
+
+
+class PackedText:
+    __slots__ = ('path', 'offset', 'length', 'text_hash')
+
+    def __init__(self, path, offset, length, text_hash=None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.text_hash = text_hash
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return zlib.decompress(f.read(self.length)).decode('utf-8')
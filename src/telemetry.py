@@ -0,0 +1,124 @@
+# src/telemetry.py
+#
+# Measures the calls made to backends: how long a task waited in its lane, how long until the first
+# generated text arrived, how long the call took in total, prompt and completion tokens and tokens per
+# second. The latest records of every backend are kept for the status bar and the LLM settings, and
+# all of them are appended to a JSONL file that's rotated once it grows large, so endpoints can be
+# compared and slowdowns spotted over time.
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+METRICS_FILE = 'metrics.jsonl'
+METRICS_MAX_BYTES = 1024 * 1024
+# metrics.jsonl.1 and so on, oldest last
+METRICS_BACKUPS = 3
+# Averages are taken over this many recent calls of a backend
+RECENT_RECORDS = 20
+
+GENERATE = 'generate'
+COUNT = 'count'
+
+class Telemetry:
+    # path None keeps records in memory only. listener is called with every record, on the thread that made it.
+    def __init__(self, path=METRICS_FILE, listener=None):
+        self.path = path
+        self.listener = listener
+        # (backend name, kind) -> its latest records
+        self.recent = {}
+        self.lock = threading.Lock()
+        self.handler = None
+
+    def record(self, llm, kind, **fields):
+        record = {'time': round(time.time(), 3), 'backend': llm.name, 'type': llm.get_type(), 'kind': kind}
+        record.update({name: round(value, 3) if isinstance(value, float) else value for name, value in fields.items()})
+        with self.lock:
+            self.recent.setdefault((llm.name, kind), deque(maxlen=RECENT_RECORDS)).append(record)
+            self.write(record)
+        if self.listener is not None:
+            self.listener(record)
+        return record
+
+    def write(self, record):
+        if self.path is None:
+            return
+        try:
+            if self.handler is None:
+                self.handler = RotatingFileHandler(self.path, maxBytes=METRICS_MAX_BYTES, backupCount=METRICS_BACKUPS,
+                                                   encoding='utf-8', delay=True)
+            self.handler.emit(logging.makeLogRecord({'msg': json.dumps(record)}))
+        except OSError as e:
+            print(f"Can't write metrics: {e}")
+
+    def records(self, backend, kind=GENERATE):
+        with self.lock:
+            return list(self.recent.get((backend, kind), ()))
+
+    # A few lines on how a backend has been doing lately, for the LLM settings
+    def summary(self, backend):
+        lines = []
+        generations = self.records(backend, GENERATE)
+        completed = [record for record in generations if not record.get('error') and not record.get('cancelled')]
+        if completed:
+            lines.append(f"Last {len(completed)} generations, on average: " + describe_averages(completed))
+        failed = sum(1 for record in generations if record.get('error'))
+        if failed:
+            lines.append(f"{failed} of the last {len(generations)} generations failed")
+        perf = next((record['perf'] for record in reversed(generations) if record.get('perf')), None)
+        if perf:
+            lines.append("Backend reports: " + describe_perf(perf))
+        counts = self.records(backend, COUNT)
+        if counts:
+            lines.append(f"Token counts take {mean(record['latency'] for record in counts):.2f}s, "
+                         f"waiting {mean(record['queue_wait'] for record in counts):.2f}s to start")
+        return "\n".join(lines) or "No calls measured yet"
+
+    def close(self):
+        with self.lock:
+            if self.handler is not None:
+                self.handler.close()
+                self.handler = None
+
+
+def mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else 0.0
+
+# One generation, for the status bar
+def describe(record):
+    if record.get('cancelled'):
+        return f"{record['backend']}: cancelled after {record['latency']:.1f}s"
+    if record.get('error'):
+        return f"{record['backend']}: failed after {record['latency']:.1f}s"
+    if record.get('replayed'):
+        return f"{record['backend']}: replayed an earlier response"
+    text = f"{record['backend']}: "
+    if record.get('tokens_per_s'):
+        text += f"{record['tokens_per_s']:.1f} tokens/s, "
+    if record.get('first_token') is not None:
+        text += f"first text after {record['first_token']:.1f}s, "
+    return text + f"{record['latency']:.1f}s total, {record['queue_wait']:.1f}s queued"
+
+def describe_averages(records):
+    return (f"{mean(record.get('tokens_per_s') for record in records):.1f} tokens/s, "
+            f"first text after {mean(record.get('first_token') for record in records):.1f}s, "
+            f"{mean(record['latency'] for record in records):.1f}s total, "
+            f"{mean(record['queue_wait'] for record in records):.1f}s queued, "
+            f"{mean(record.get('prompt_tokens') for record in records):.0f} prompt tokens")
+
+# Kobold's /api/extra/perf, on its last generation
+def describe_perf(perf):
+    parts = []
+    if perf.get('last_process'):
+        parts.append(f"prompt processed in {perf['last_process']:.1f}s")
+    if perf.get('last_eval'):
+        parts.append(f"generated in {perf['last_eval']:.1f}s")
+    if perf.get('last_token_count'):
+        parts.append(f"{perf['last_token_count']} tokens")
+    if perf.get('queue'):
+        parts.append(f"{perf['queue']} waiting")
+    return ", ".join(parts) or json.dumps(perf)
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from src.fileutil import atomic_write
+
+TOKEN_CACHE_FILE = 'token_cache.json'
+DEFAULT_MAX_ENTRIES = 50000
+# The cache is written to disk after this many new counts, and on exit
+SAVE_EVERY = 200
+
+# Token counts keyed by (backend identity, hash of the text), evicted least recently used first
+class TokenCountCache:
+    def __init__(self, path=TOKEN_CACHE_FILE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.unsaved = 0
+
+    @staticmethod
+    def make_key(llm, text):
+        digest = hashlib.sha1()
+        digest.update(llm.identity().encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, llm, text):
+        if llm is None:
+            return None
+        key = self.make_key(llm, text)
+        with self.lock:
+            count = self.entries.get(key)
+            if count is not None:
+                self.entries.move_to_end(key)
+            return count
+
+    def put(self, llm, text, count):
+        if llm is None or count < 0:
+            return
+        key = self.make_key(llm, text)
+        with self.lock:
+            self.entries[key] = count
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.unsaved += 1
+            save = self.unsaved >= SAVE_EVERY
+        if save:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        with self.lock:
+            self.entries = OrderedDict((key, count) for key, count in data.get('entries', []))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if self.unsaved == 0:
+                    return
+                # Entries are stored oldest first so the LRU order survives a restart
+                data = json.dumps({'version': 1, 'entries': list(self.entries.items())})
+                self.unsaved = 0
+            atomic_write(self.path, data)
@@ -1,8 +1,25 @@
-from PyQt5.QtWidgets import QWidget, QLabel, QVBoxLayout, QTextEdit
-from PyQt5.QtCore import QObject, QThread, pyqtSlot
-from PyQt5.QtGui import QFocusEvent
+import re
 
-from src.llm import CountTask
+from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout, QTextEdit
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QFocusEvent, QTextCursor
+
+from src.llm import CountTask, ParagraphCountTask
+from src.executor import PRIORITY_VISIBLE, PRIORITY_BACKGROUND
+
+# Edits to texts longer than this are counted paragraph by paragraph
+PARAGRAPH_COUNT_THRESHOLD = 2000
+# When more than this share of the paragraphs has no count yet, the whole text is counted in one request instead
+WHOLE_COUNT_SHARE = 0.5
+# Adding up paragraph counts is an approximation, tokens can merge where paragraphs meet and counts spread
+# over paragraphs are estimates. After this many sums the whole text is counted again to stay accurate.
+RESYNC_INTERVAL = 10
+# Counting waits until typing has paused for this long (ms)
+COUNT_DEBOUNCE_INTERVAL = 750
+
+# Paragraphs keep their trailing newlines, so joining them gives back the original text
+def splitParagraphs(text):
+    return [paragraph for paragraph in re.findall(r'[^\n]*\n*', text) if paragraph]
 
 class CustomTextEdit(QTextEdit):
     def __init__(self, parent=None):
@@ -17,7 +34,24 @@ class CustomTextEdit(QTextEdit):
         self.CustomTextEdit_oldText = self.toPlainText()
         super().focusInEvent(event)
 
+# The source of one count task of a TokenizedTextEdit. Results carry the text that was counted and
+# the edit's binding at the time, so ones that arrive after it was rebound to another object are dropped.
+class TokenCountRequest:
+    def __init__(self, edit, text):
+        self.edit = edit
+        self.text = text
+        self.bindGeneration = edit.bindGeneration
+
+    # Called from worker threads, the edit is updated through its signals
+    def onTokensCounted(self, count):
+        self.edit.tokensCounted.emit(count, self.bindGeneration, self.text)
+
+    def onParagraphsCounted(self, counts, overhead):
+        self.edit.paragraphsCounted.emit(counts, overhead, self.bindGeneration)
+
 class TokenizedTextEdit(QWidget):
+    tokensCounted = pyqtSignal(int, int, str)
+    paragraphsCounted = pyqtSignal(dict, int, int)
     def __init__(self, worker):
         super().__init__()
         self.worker = worker
@@ -25,19 +59,89 @@ class TokenizedTextEdit(QWidget):
         self.setLayout(self.layout)
         self.tokenCountLabel = QLabel()
         self.tokenCount = 0
+        self.streaming = False
+        self.settingText = False
+        # Token counts of the paragraphs of the current text, see updateTokens
+        self.paragraphTokens = {}
+        self.tokenOverhead = 0
+        # Paragraph sums shown since the whole text was last counted
+        self.paragraphSums = 0
+        # The story model object and attribute this edit shows, see bind
+        self.boundObject = None
+        self.boundAttr = None
+        # Goes up whenever the edit is bound or unbound, counts started before are dropped
+        self.bindGeneration = 0
         self.textEdit = CustomTextEdit(self)
         self.textEdit.setMinimumHeight(100)
         self.layout.addWidget(self.textEdit)
         self.layout.addWidget(self.tokenCountLabel)
+        self.tokensCounted.connect(self.setCountedTokens)
+        self.paragraphsCounted.connect(self.setParagraphTokens)
+
+        self.countTimer = QTimer(self)
+        self.countTimer.setSingleShot(True)
+        self.countTimer.setInterval(COUNT_DEBOUNCE_INTERVAL)
+        self.countTimer.timeout.connect(self.updateTokens)
+        self.textEdit.textChanged.connect(self.onTextChanged)
+
+    # Shows an attribute of a story model object and writes edits back to it. The text's token
+    # count is kept in the attribute of the same name with "_tokens" appended.
+    def bind(self, obj, attr):
+        self.invalidateCounts()
+        self.boundObject = obj
+        self.boundAttr = attr
+        self.setPlainTextAndTokens(getattr(obj, attr), getattr(obj, attr + '_tokens'))
+
+    def unbind(self):
+        self.commitText()
+        self.countTimer.stop()
+        self.invalidateCounts()
+        self.boundObject = None
+        self.boundAttr = None
+
+    # Counts still on their way are for the text of the previous binding
+    def invalidateCounts(self):
+        self.bindGeneration += 1
+        self.worker.supersede(self)
+        self.paragraphTokens = {}
+
+    # Typed text reaches the model with the debounced count, or when focus leaves the edit
+    def commitText(self):
+        if self.boundObject is None:
+            return
+        text = self.textEdit.toPlainText()
+        if getattr(self.boundObject, self.boundAttr) != text:
+            setattr(self.boundObject, self.boundAttr, text)
+            setattr(self.boundObject, self.boundAttr + '_tokens', -1)
+
+    # Makes sure text that's still being typed is in the model, before it's saved or used in a prompt
+    @staticmethod
+    def commitFocused():
+        widget = QApplication.focusWidget()
+        if isinstance(widget, CustomTextEdit) and isinstance(widget.parent, TokenizedTextEdit):
+            widget.parent.commitText()
+
+    def onTextChanged(self):
+        # Only edits made by the user are counted while typing
+        if not self.settingText and not self.streaming:
+            self.countTimer.start()
+
+    def setEditorText(self, text, plain=True):
+        self.settingText = True
+        if plain:
+            self.textEdit.setPlainText(text)
+        else:
+            self.textEdit.setText(text)
+        self.settingText = False
 
     def setText(self, text):
         if self.textEdit.toPlainText() != text:
-            self.textEdit.setText(text)
+            self.setEditorText(text, False)
             self.updateTokens()
 
     def setPlainText(self, text):
         if self.textEdit.toPlainText() != text:
-            self.textEdit.setPlainText(text)
+            self.setEditorText(text)
             self.updateTokens()
 
     def setPlaceholderText(self, text):
@@ -52,18 +156,104 @@ class TokenizedTextEdit(QWidget):
     # Bypass token counting when we already know it or it's not relevant
     # A negative token count triggers an update anyway
     def setPlainTextAndTokens(self, text, tokens):
-        self.textEdit.setPlainText(text)
+        self.setEditorText(text)
         if tokens < 0:
             self.updateTokens()
         else:
-            self.onTokensCounted(tokens)
+            self.countTimer.stop()
+            self.commitText()
+            self.seedParagraphTokens(text, tokens)
+            self.setTokenCount(tokens)
 
-    def onTokensCounted(self, count):
+    # Streamed generations append chunks as they arrive, the first chunk replaces the "Generating..." text.
+    # Tokens are only counted once the complete response is in.
+    def appendStreamedText(self, chunk):
+        if not self.streaming:
+            self.streaming = True
+            self.setEditorText("")
+            self.tokenCountLabel.setText("Generating...")
+        cursor = self.textEdit.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(chunk)
+
+    def finishStreamedText(self, text):
+        self.streaming = False
+        if self.textEdit.toPlainText() != text:
+            self.setEditorText(text)
+        self.updateTokens()
+
+    # Ends a generation that was cancelled. What was streamed so far is kept, otherwise the text from before is put back.
+    def cancelStreamedText(self, text, tokens):
+        if self.streaming:
+            self.finishStreamedText(self.textEdit.toPlainText())
+        else:
+            self.setPlainTextAndTokens(text, tokens)
+
+    # Counts of text that has changed since are dropped, the new text's count is on its way
+    def setCountedTokens(self, count, bindGeneration, text):
+        if bindGeneration == self.bindGeneration and text == self.textEdit.toPlainText():
+            self.seedParagraphTokens(text, count)
+            self.setTokenCount(count)
+
+    # Spreads the count of a whole long text over its paragraphs by length, so a later edit only needs
+    # the paragraphs it touched counted
+    def seedParagraphTokens(self, text, count):
+        if count < 0 or len(text) <= PARAGRAPH_COUNT_THRESHOLD:
+            return
+        paragraphs = splitParagraphs(text)
+        tokens = count + self.tokenOverhead * (len(paragraphs) - 1)
+        self.paragraphTokens = {paragraph: round(tokens * len(paragraph) / len(text)) for paragraph in paragraphs}
+        self.paragraphSums = 0
+
+    def setTokenCount(self, count):
         self.tokenCount = count
+        if self.boundObject is not None and count >= 0 and getattr(self.boundObject, self.boundAttr) == self.textEdit.toPlainText():
+            setattr(self.boundObject, self.boundAttr + '_tokens', count)
         self.tokenCountLabel.setText("Tokens: " + str(self.tokenCount))
 
+    def setParagraphTokens(self, counts, overhead, bindGeneration):
+        if bindGeneration != self.bindGeneration:
+            return
+        self.paragraphTokens.update(counts)
+        self.tokenOverhead = overhead
+        self.sumParagraphTokens(splitParagraphs(self.textEdit.toPlainText()))
+
+    # Adds up the paragraph counts, returns False if some paragraphs haven't been counted yet.
+    # Every separate count includes the backend's fixed overhead, which the whole text only pays once.
+    def sumParagraphTokens(self, paragraphs):
+        if any(paragraph not in self.paragraphTokens for paragraph in paragraphs):
+            return False
+        total = sum(self.paragraphTokens[paragraph] for paragraph in paragraphs)
+        total -= self.tokenOverhead * (len(paragraphs) - 1)
+        # Only the counts of the current text are kept, the token cache remembers older ones
+        self.paragraphTokens = {paragraph: self.paragraphTokens[paragraph] for paragraph in paragraphs}
+        self.paragraphSums += 1
+        self.setTokenCount(max(total, 0))
+        return True
+
+    # Counts for edits that aren't shown wait until what's on screen has been counted
     @pyqtSlot()
     def updateTokens(self):
+        self.countTimer.stop()
+        self.commitText()
+        text = self.textEdit.toPlainText()
+        priority = PRIORITY_VISIBLE if self.isVisible() else PRIORITY_BACKGROUND
+        if len(text) <= PARAGRAPH_COUNT_THRESHOLD:
+            self.tokenCountLabel.setText("Counting tokens...")
+            task = CountTask(text, TokenCountRequest(self, text), priority=priority, target=self)
+            self.worker.addTask(task)
+            return
+        paragraphs = splitParagraphs(text)
+        resync = self.paragraphSums >= RESYNC_INTERVAL
+        if not resync and self.sumParagraphTokens(paragraphs):
+            return
         self.tokenCountLabel.setText("Counting tokens...")
-        task = CountTask(self.textEdit.toPlainText(), self)
+        unique = list(dict.fromkeys(paragraphs))
+        changed = [paragraph for paragraph in unique if paragraph not in self.paragraphTokens]
+        # A text seen for the first time takes one request rather than one per paragraph
+        if resync or len(changed) > WHOLE_COUNT_SHARE * len(unique):
+            task = CountTask(text, TokenCountRequest(self, text), priority=priority, target=self)
+            self.worker.addTask(task)
+            return
+        task = ParagraphCountTask(changed, TokenCountRequest(self, text), priority=priority, target=self)
         self.worker.addTask(task)
@@ -0,0 +1,340 @@
+# src/tokenizer.py
+#
+# Local tokenizers for exact token counts without a round trip to a backend.
+# Supported vocabulary files:
+#   tokenizer.json  - HuggingFace BPE tokenizers, both byte-level (GPT-2, Llama 3, ...)
+#                     and SentencePiece-style (Llama 2, Mistral, ...)
+#   *.tiktoken      - OpenAI rank files (cl100k_base, o200k_base, ...)
+#   *.model         - SentencePiece models, needs the sentencepiece package
+# When the optional tokenizers package is installed it is used for tokenizer.json files.
+# Without it, tokenizer.json files whose normalizer has steps BPETokenizer doesn't know aren't loaded,
+# as their counts could be off.
+
+import base64
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# Close approximation of the GPT-2 pre-tokenizer for the re module, which lacks \p{L} and \p{N}
+FALLBACK_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+"""
+GPT2_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+CL100K_PATTERN = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+
+SPIECE_UNDERLINE = "▁"
+
+# Words repeat a lot in prose, so the BPE result of each one is remembered
+WORD_CACHE_SIZE = 100000
+# Tokenizer files are checked for changes at most this often (seconds)
+TOKENIZER_RECHECK_INTERVAL = 10
+
+def compile_pattern(pattern):
+    if regex is not None:
+        try:
+            return regex.compile(pattern)
+        except regex.error:
+            pass
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return re.compile(FALLBACK_PATTERN)
+
+def bytes_to_unicode():
+    # The printable stand-in characters byte-level BPE vocabularies use for raw bytes
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+BYTE_ENCODER = bytes_to_unicode()
+
+
+# The normalizer steps of tokenizer.json files, as functions from text to text
+def normalizer_step(step):
+    kind = step.get('type')
+    if kind in ('NFC', 'NFD', 'NFKC', 'NFKD'):
+        return lambda text: unicodedata.normalize(kind, text)
+    if kind == 'Lowercase':
+        return str.lower
+    if kind == 'Prepend':
+        prepend = step.get('prepend', '')
+        return lambda text: prepend + text if text else text
+    if kind == 'Replace':
+        pattern = step.get('pattern', {})
+        content = step.get('content', '')
+        if 'String' in pattern:
+            return lambda text: text.replace(pattern['String'], content)
+        if 'Regex' in pattern:
+            compiled = compile_pattern(pattern['Regex'])
+            return lambda text: compiled.sub(lambda match: content, text)
+    if kind == 'Strip':
+        left = step.get('strip_left', True)
+        right = step.get('strip_right', True)
+        def strip(text):
+            if left:
+                text = text.lstrip()
+            if right:
+                text = text.rstrip()
+            return text
+        return strip
+    if kind == 'StripAccents':
+        return lambda text: ''.join(c for c in text if not unicodedata.combining(c))
+    raise ValueError(f"Unsupported normalizer: {kind}")
+
+
+class BPETokenizer:
+    def __init__(self, vocab, merges, byte_level=True, pattern=None, prepend_space=True,
+                 byte_fallback=False, ignore_merges=False, normalizers=(), added_tokens=()):
+        self.vocab = vocab
+        self.ranks = {pair: rank for rank, pair in enumerate(merges)}
+        self.byte_level = byte_level
+        self.pattern = compile_pattern(pattern or (GPT2_PATTERN if regex is not None else FALLBACK_PATTERN))
+        self.prepend_space = prepend_space
+        self.byte_fallback = byte_fallback
+        self.ignore_merges = ignore_merges
+        self.normalizers = list(normalizers)
+        # Added tokens are matched in the text as it is, before anything else, and are a token each.
+        # Longer ones go first so one that contains another wins.
+        added_tokens = sorted((token for token in added_tokens if token), key=len, reverse=True)
+        self.added = re.compile('|'.join(re.escape(token) for token in added_tokens)) if added_tokens else None
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_hf_json(cls, data):
+        model = data.get('model') or {}
+        if model.get('type', 'BPE') != 'BPE':
+            raise ValueError(f"Unsupported tokenizer model: {model.get('type')}")
+        merges = [tuple(m.split(' ', 1)) if isinstance(m, str) else tuple(m) for m in model.get('merges', [])]
+        normalizers = [normalizer_step(step) for step in cls.flatten(data.get('normalizer'))]
+        steps = cls.flatten(data.get('pre_tokenizer'))
+        byte_level = any(step.get('type') == 'ByteLevel' for step in steps)
+        pattern = None
+        prepend_space = False
+        for step in steps:
+            if step.get('type') == 'Split' and 'Regex' in step.get('pattern', {}):
+                pattern = step['pattern']['Regex']
+            elif step.get('type') == 'Metaspace':
+                prepend_space = step.get('prepend_scheme', 'always') != 'never' and step.get('add_prefix_space', True)
+            elif step.get('type') == 'ByteLevel' and step.get('add_prefix_space'):
+                prepend_space = True
+        return cls(model.get('vocab', {}), merges, byte_level=byte_level, pattern=pattern,
+                   prepend_space=prepend_space, byte_fallback=model.get('byte_fallback', False),
+                   ignore_merges=model.get('ignore_merges', False), normalizers=normalizers,
+                   added_tokens=[token.get('content', '') for token in data.get('added_tokens') or []])
+
+    @staticmethod
+    def flatten(step):
+        if not step:
+            return []
+        if step.get('type') == 'Sequence':
+            steps = []
+            for inner in step.get('normalizers', step.get('pretokenizers', [])):
+                steps.extend(BPETokenizer.flatten(inner))
+            return steps
+        return [step]
+
+    def words(self, text):
+        if self.byte_level:
+            if self.prepend_space and text and not text.startswith(' '):
+                text = ' ' + text
+            for word in self.pattern.findall(text):
+                yield ''.join(BYTE_ENCODER[b] for b in word.encode('utf-8'))
+        else:
+            # SentencePiece-style: spaces become "▁" and pieces never span one
+            text = text.replace(' ', SPIECE_UNDERLINE)
+            if self.prepend_space and text:
+                text = SPIECE_UNDERLINE + text
+            start = 0
+            for i in range(1, len(text)):
+                if text[i] == SPIECE_UNDERLINE and text[i - 1] != SPIECE_UNDERLINE:
+                    yield text[start:i]
+                    start = i
+            if text:
+                yield text[start:]
+
+    def word_token_count(self, word):
+        count = self.cache.get(word)
+        if count is not None:
+            return count
+        if self.ignore_merges and word in self.vocab:
+            count = 1
+        else:
+            count = sum(self.symbol_token_count(symbol) for symbol in self.bpe(word))
+        with self.lock:
+            if len(self.cache) >= WORD_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[word] = count
+        return count
+
+    def symbol_token_count(self, symbol):
+        if symbol in self.vocab or self.byte_level:
+            return 1
+        # Characters missing from the vocabulary fall back to one token per UTF-8 byte, or a single unknown token
+        return len(symbol.encode('utf-8')) if self.byte_fallback else 1
+
+    def bpe(self, word):
+        symbols = list(word)
+        ranks = self.ranks
+        while len(symbols) > 1:
+            best = None
+            best_rank = None
+            for i in range(len(symbols) - 1):
+                rank = ranks.get((symbols[i], symbols[i + 1]))
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best = i
+                    best_rank = rank
+            if best is None:
+                break
+            symbols[best:best + 2] = [symbols[best] + symbols[best + 1]]
+        return symbols
+
+    def count_tokens(self, text):
+        if self.added is None:
+            return self.count_piece(text)
+        count = 0
+        start = 0
+        for match in self.added.finditer(text):
+            count += self.count_piece(text[start:match.start()]) + 1
+            start = match.end()
+        return count + self.count_piece(text[start:])
+
+    # Text without added tokens in it
+    def count_piece(self, text):
+        for normalize in self.normalizers:
+            text = normalize(text)
+        return sum(self.word_token_count(word) for word in self.words(text))
+
+
+# tiktoken rank files list every token as base64 bytes with its rank, merges follow from the ranks
+class TiktokenTokenizer:
+    def __init__(self, ranks, pattern=CL100K_PATTERN):
+        self.ranks = ranks
+        self.pattern = compile_pattern(pattern)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        ranks = {}
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    token, rank = line.split()
+                    ranks[base64.b64decode(token)] = int(rank)
+        return cls(ranks)
+
+    def word_token_count(self, word):
+        count = self.cache.get(word)
+        if count is not None:
+            return count
+        data = word.encode('utf-8')
+        if data in self.ranks:
+            count = 1
+        else:
+            parts = [bytes([b]) for b in data]
+            while len(parts) > 1:
+                best = None
+                best_rank = None
+                for i in range(len(parts) - 1):
+                    rank = self.ranks.get(parts[i] + parts[i + 1])
+                    if rank is not None and (best_rank is None or rank < best_rank):
+                        best = i
+                        best_rank = rank
+                if best is None:
+                    break
+                parts[best:best + 2] = [parts[best] + parts[best + 1]]
+            count = len(parts)
+        with self.lock:
+            if len(self.cache) >= WORD_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[word] = count
+        return count
+
+    def count_tokens(self, text):
+        return sum(self.word_token_count(word) for word in self.pattern.findall(text))
+
+
+class HFTokenizer:
+    def __init__(self, path):
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(path)
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+class SentencePieceTokenizer:
+    def __init__(self, path):
+        import sentencepiece
+        self.processor = sentencepiece.SentencePieceProcessor(model_file=path)
+
+    def count_tokens(self, text):
+        return len(self.processor.encode(text))
+
+
+# A tokenizer file as it was last loaded. tokenizer is None when it couldn't be.
+class LoadedTokenizer:
+    __slots__ = ('tokenizer', 'mtime', 'checked_at')
+
+    def __init__(self, tokenizer, mtime, checked_at):
+        self.tokenizer = tokenizer
+        self.mtime = mtime
+        self.checked_at = checked_at
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+# Loaded tokenizers are shared between every backend that points at the same file, and loaded again when
+# it changes. Returns None when the file can't be loaded, which is reported once rather than on every count.
+def load_tokenizer(path):
+    key = os.path.abspath(path)
+    now = time.monotonic()
+    with _tokenizers_lock:
+        loaded = _tokenizers.get(key)
+        if loaded is not None and now - loaded.checked_at < TOKENIZER_RECHECK_INTERVAL:
+            return loaded.tokenizer
+        mtime = file_mtime(path)
+        if loaded is not None and loaded.mtime == mtime:
+            loaded.checked_at = now
+            return loaded.tokenizer
+        tokenizer = None
+        if mtime is None:
+            print(f"Tokenizer file {path} not found, token counts are asked from the backend")
+        else:
+            try:
+                tokenizer = _load_tokenizer(path)
+            except Exception as e:
+                print(f"Couldn't load tokenizer {path}, token counts are asked from the backend: {e}")
+        _tokenizers[key] = LoadedTokenizer(tokenizer, mtime, now)
+        return tokenizer
+
+def _load_tokenizer(path):
+    if path.endswith('.model'):
+        return SentencePieceTokenizer(path)
+    if path.endswith('.tiktoken'):
+        return TiktokenTokenizer.from_file(path)
+    try:
+        return HFTokenizer(path)
+    except ImportError:
+        pass
+    with open(path, 'r', encoding='utf-8') as f:
+        return BPETokenizer.from_hf_json(json.load(f))
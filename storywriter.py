@@ -1,18 +1,24 @@
-import json
 import re
 import sys
 import traceback
 
-from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QMenuBar, QAction, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QFormLayout, QGridLayout, QFileDialog, QFrame, QScrollArea, QSizePolicy, QMessageBox, QComboBox, QToolButton, QMenu
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot, Qt
+from PyQt5.QtWidgets import QApplication, QWidget, QMainWindow, QMenuBar, QAction, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QFormLayout, QGridLayout, QFileDialog, QFrame, QScrollArea, QSizePolicy, QMessageBox, QComboBox, QToolButton, QMenu, QWIDGETSIZE_MAX
+from PyQt5.QtCore import QTimer, QPoint, pyqtSignal, Qt
 from PyQt5.QtGui import QFocusEvent
-import queue
 
-from src.llm import CountTask, GenerateTask, LLMManager
+from src.llm import CountTask, GenerateTask, PrimeCacheTask, LLMManager, DEFAULT_MAX_LENGTH, is_generation_error
+from src.executor import TaskExecutor, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from src.prompt import LAYOUT_STABLE, new_prompt_plan, add_story_prefix, add_scene_prompt, add_chapter_summary_prompt, chapter_summary_source_hash
+from src.storymodel import Story, StoryChapter, StoryScene, load_story
+from src.export import EXPORT_WRITERS, ExportTask, snapshot_story
+from src.storyjournal import StoryJournal, SaveTask
+from src.storypack import PACK_SUFFIX
 from src.settingsdialog import SettingsDialog
 from src.tokenizedtextedit import TokenizedTextEdit
 from src.llmsettingsdialog import LLMSettingsDialog
 from src.storyobjectdialog import StoryObjectDialog
+from src.telemetry import GENERATE, describe
+from src.generationhistorydialog import GenerationHistoryDialog
 
 def excepthook(exc_type, exc_value, exc_tb):
     tb = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
@@ -25,48 +31,74 @@ sys.excepthook = excepthook
 app = QApplication([])
 
 exportedStylesheet = "background-color: rgb(252, 245, 229);"
+placeholderStylesheet = "color: gray; border: 1px dashed lightgray;"
 
+# Scene editors only exist for scenes within this many viewport heights of what's on screen
+VISIBLE_MARGIN = 1.0
+# Height of a scene's placeholder until it has been shown in an editor
+SCENE_PLACEHOLDER_HEIGHT = 260
+# Height of a chapter's placeholder until it has been shown, on top of that of its scenes
+CHAPTER_PLACEHOLDER_HEIGHT = 220
+# Scrolling is followed this long after it stops (ms)
+VISIBLE_UPDATE_DELAY = 30
+STORY_FILE_FILTER = "Stories (*.story *.json);;Compact story (*.story);;JSON story (*.json);;All files (*)"
+# Changes are saved to the story's journal this often (ms), once the story has a file
+AUTOSAVE_INTERVAL = 30000
 
-####################################
-## API access
-
-class Worker(QObject):
-    finished = pyqtSignal()
-
-    def __init__(self):
-        super(Worker, self).__init__()
-        self.tasks = queue.Queue()
-
-    @pyqtSlot(QObject)
-    def addTask(self, task):
-        self.tasks.put(task)
-        if not global_thread.isRunning():
-            global_thread.start()
-
-    @pyqtSlot()
-    def processNextTask(self):
-        if not self.tasks.empty():
-            task = self.tasks.get()
-            task.execute()
-            self.processNextTask()
-        else:
-            self.finished.emit()
-
-# Global worker and thread
-global_thread = QThread()
 
 #####################################
 ## UI
 
+# Fills a "Generate" dropdown with an entry per configured LLM. Backends that are still
+# being checked or are unreachable are listed with their status but can't be picked.
+# Below them are entries to stop a running generation and to see what was generated for the same prompt before.
+def populateGenerateMenu(menu, llm_manager, generate, showPrevious, stop):
+    menu.clear()
+    for llm in llm_manager.llms:
+        action = QAction(f'Generate with {llm.name}', menu)
+        if not llm.online:
+            action.setText(f'Generate with {llm.name} ({llm.status})')
+            action.setEnabled(False)
+        action.triggered.connect(lambda checked, llm=llm: generate(llm))
+        menu.addAction(action)
+    menu.addSeparator()
+    action = QAction('Stop generating', menu)
+    action.triggered.connect(lambda checked: stop())
+    menu.addAction(action)
+    action = QAction('Previous generations...', menu)
+    action.triggered.connect(lambda checked: showPrevious())
+    menu.addAction(action)
+
+# The source of a widget's GenerateTask. Responses reach the widget's signal along with the job, so the
+# widget can drop those of a job it has cancelled or replaced, which may still be on their way.
+class GenerationJob:
+    def __init__(self, plan, llm, signal, previous, priority=PRIORITY_INTERACTIVE):
+        self.signal = signal
+        # What the widget showed before, put back if the job is cancelled before anything arrives
+        self.previous = previous
+        self.task = GenerateTask(plan, self, llm, priority=priority)
+
+    def onResponseGenerated(self, response, partial):
+        self.signal.emit(self, response, partial) # PyQt can't handle updates to the UI from other threads, need to route it through a signal
+
+    def cancel(self):
+        self.task.cancel()
+
+# Scenes and chapters are views of the story model, edits are written back to it as they're made.
+# Scene editors and chapter views are recycled as the story is scrolled, see SceneSlot and ChapterSlot.
 class Scene(QWidget):
-    sceneTextResponseReady = pyqtSignal(str)
-    def __init__(self, parentChapter, sceneData=None):
+    sceneTextResponseReady = pyqtSignal(object, str, bool)
+    def __init__(self, storyWriter):
         super().__init__()
-        self.parentChapter = parentChapter
-        self.global_worker = self.parentChapter.parentStory.global_worker
+        self.storyWriter = storyWriter
+        self.parentChapter = None
+        self.slot = None
+        self.model = None
+        # The running GenerationJob, if any
+        self.job = None
+        self.global_worker = storyWriter.global_worker
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
-        self.parentChapter.scenesLayout.addWidget(self)
 
         self.textLayout = QGridLayout()
         self.summary = TokenizedTextEdit(self.global_worker)
@@ -118,83 +150,80 @@ It is also used when generating later scenes in this chapter as part of the summ
         self.generate_menu = QMenu()
 
         # Add LLM options
-        for llm in self.parentChapter.parentStory.llm_manager.llms:
-            action = QAction(f'Generate with {llm.name}', self)
-            action.triggered.connect(lambda checked, llm=llm: self.generateScene(llm))
-            self.generate_menu.addAction(action)
+        populateGenerateMenu(self.generate_menu, storyWriter.llm_manager, self.generateScene, self.showPreviousGenerations,
+                             self.cancelGeneration)
 
         self.generate_button.setMenu(self.generate_menu)
         self.textLayout.addWidget(self.generate_button, 0, 1, alignment=Qt.AlignLeft)
 
-        if sceneData:
-            self.summary.setPlainTextAndTokens(sceneData["summary"], int(sceneData.get("summaryTokens", -1)))
-            self.text.setPlainTextAndTokens(sceneData["text"], int(sceneData.get("textTokens", -1)))
+    def bind(self, chapter, slot, model):
+        self.parentChapter = chapter
+        self.slot = slot
+        self.model = model
+        self.summary.bind(model, 'summary')
+        self.text.bind(model, 'text')
+
+    def unbind(self):
+        self.summary.unbind()
+        self.text.unbind()
+        self.parentChapter = None
+        self.slot = None
+        self.model = None
+
+    # Editors that are generating or being typed in stay with their scene
+    def busy(self):
+        focused = QApplication.focusWidget()
+        return self.job is not None or (focused is not None and self.isAncestorOf(focused))
 
     def deleteScene(self):
-        self.parentChapter.scenesLayout.removeWidget(self)
-        self.parentChapter.parentStory.update()
-        self.deleteLater()
-        return
+        self.parentChapter.removeScene(self.model)
 
     def generateScene(self, llm):
-        chapter = self.parentChapter
-        story = chapter.parentStory
-        chapter_index = None
-        scene_index = None
-        for i in range(story.chapterLayout.count()):
-            if story.chapterLayout.itemAt(i).widget() == chapter:
-                chapter_index= i
-                break
-        for i in range(chapter.scenesLayout.count()):
-            if chapter.scenesLayout.itemAt(i).widget() == self:
-                scene_index = i
-                break
-
-        prompt = "{{[INPUT]}}\nYou are to take the role of an author writing a story. The story is titled \"" + story.title.text() + "\"."
-        if len(story.summary.toPlainText()) > 0:
-            prompt = prompt + "\n\nGeneral background information: " + story.summary.toPlainText()
-        if len(story.genre.text()) > 0:
-            prompt = prompt + "\n\nGenre: " + story.genre.text()
-        # Include story objects in the prompt
-        if story.story_objects:
-            prompt += "\n\nStory Objects:"
-            for obj in story.story_objects:
-                prompt += f"\n- {obj['name']}: {obj['short_desc']}"
-
-        prompt = prompt + "\n\nThe story so far has had the following major events happen:"
-        for c in range(chapter_index + 1):
-            chapter = story.chapterLayout.itemAt(c).widget()
-            prompt = prompt + "\n\n" + chapter.summary.toPlainText()
-        prompt = prompt + "\n\nThe current chapter is titled \"" + chapter.title.text() + "\""
-        if scene_index > 1:
-            prompt = prompt + "\n\nThe following scenes have already happened in this chapter:"
-            for s in range(scene_index-1):
-                prompt = prompt + "\n" + chapter.scenesLayout.itemAt(s).widget().summary.toPlainText()
-        if scene_index > 0:
-            prompt = prompt +"\n\nThe most recent scene before this one was:\n\n" + chapter.scenesLayout.itemAt(scene_index-1).widget().text.toPlainText()
-
-        prompt = prompt + "\n\nYou are now writing the next scene in which the following occurs: " + self.summary.toPlainText() \
-                     + "\n\n" + story.scene_generation_prompt + "\n{{[OUTPUT]}}"
-
-        print(prompt)
-
-        task = GenerateTask(prompt, self, llm)
-        self.global_worker.addTask(task)
+        story = self.storyWriter
+        TokenizedTextEdit.commitFocused()
+        chapter_index, scene_index = story.story.scene_position(self.model)
+
+        # The prompt is planned here and fitted into the LLM's context once the task runs
+        plan = add_scene_prompt(story.newPromptPlan(), story.story, chapter_index, scene_index)
+
+        # Generating again replaces a generation that's still running
+        self.cancelGeneration()
+        self.job = GenerationJob(plan, llm, self.sceneTextResponseReady, (self.model.text, self.model.text_tokens))
+        self.global_worker.addTask(self.job.task)
         self.text.setPlainTextAndTokens("Generating...", 0)
 
-    def onResponseGenerated(self, response):
-        self.sceneTextResponseReady.emit(response) # PyQt can't handle updates to the UI from other threads, need to route it through a signal
-    def updateText(self, response):
-        self.text.setPlainText(response)
+    def cancelGeneration(self):
+        job = self.job
+        if job is None:
+            return
+        self.job = None
+        job.cancel()
+        self.text.cancelStreamedText(*job.previous)
+
+    def showPreviousGenerations(self):
+        story = self.storyWriter
+        TokenizedTextEdit.commitFocused()
+        chapter_index, scene_index = story.story.scene_position(self.model)
+        text = story.choosePreviousGeneration(add_scene_prompt(story.newPromptPlan(), story.story, chapter_index, scene_index))
+        if text is not None and self.job is None:
+            self.text.setPlainText(text)
+
+    def updateText(self, job, response, partial):
+        if job is not self.job:
+            return
+        if partial:
+            self.text.appendStreamedText(response)
+        else:
+            self.text.finishStreamedText(response)
+            self.job = None
+            # It may have been scrolled out of view meanwhile
+            self.storyWriter.scheduleVisibleUpdate()
 
     def moveScene(self, up):
         chapter = self.parentChapter
-        scene_index = None
-        scene_count = chapter.scenesLayout.count()
-        for i in range(scene_count):
-            if chapter.scenesLayout.itemAt(i).widget() == self:
-                scene_index = i
-                break
+        scenes = chapter.model.scenes
+        scene_index = scenes.index(self.model)
+        scene_count = len(scenes)
         target = scene_index
         if up:
             target = target - 1
@@ -204,6 +233,7 @@ It is also used when generating later scenes in this chapter as part of the summ
             return
         if scene_index > target:
             scene_index, target = target, scene_index
+        scenes[scene_index], scenes[target] = scenes[target], scenes[scene_index]
         layout = chapter.scenesLayout
         widget1 = layout.itemAt(scene_index).widget()
         widget2 = layout.itemAt(target).widget()
@@ -212,27 +242,102 @@ It is also used when generating later scenes in this chapter as part of the summ
         layout.insertWidget(scene_index, widget2)
         layout.insertWidget(target, widget1)
         chapter.update()
+        self.storyWriter.scheduleVisibleUpdate()
 
     def moveSceneUp(self):
         self.moveScene(True)
     def moveSceneDown(self):
         self.moveScene(False)
 
+# Holds a scene's place in its chapter. Only slots near the visible part of the story get an editor,
+# the others show a one-line placeholder at the height their editor last had, so scrolling doesn't jump.
+class SceneSlot(QWidget):
+    def __init__(self, chapter, model):
+        super().__init__()
+        self.chapter = chapter
+        self.model = model
+        self.editor = None
+        self.editorHeight = SCENE_PLACEHOLDER_HEIGHT
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(self.layout)
+        self.placeholder = QLabel()
+        self.placeholder.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.placeholder.setWordWrap(True)
+        self.placeholder.setStyleSheet(placeholderStylesheet)
+        self.layout.addWidget(self.placeholder)
+        self.showPlaceholder()
+
+    def showPlaceholder(self):
+        summary = self.model.summary.strip().split('\n', 1)[0][:200] or "(no summary)"
+        tokens = f" - {self.model.text_tokens} tokens" if self.model.text_tokens > 0 else ""
+        self.placeholder.setText(f"Scene: {summary}{tokens}")
+        self.placeholder.show()
+        self.setFixedHeight(self.editorHeight)
+
+    def attach(self, editor):
+        self.editor = editor
+        self.placeholder.hide()
+        self.setMinimumHeight(0)
+        self.setMaximumHeight(QWIDGETSIZE_MAX)
+        editor.setParent(self)
+        self.layout.addWidget(editor)
+        editor.bind(self.chapter, self, self.model)
+        editor.show()
+
+    def detach(self):
+        editor = self.editor
+        self.editor = None
+        self.editorHeight = max(editor.height(), 1)
+        self.layout.removeWidget(editor)
+        editor.unbind()
+        self.showPlaceholder()
+        return editor
+
+# Scene editors and chapter views not attached to a slot wait here to be reused
+class WidgetPool:
+    def __init__(self, create):
+        self.create = create
+        # Every widget, attached or not
+        self.widgets = []
+        self.idle = []
+        self.parking = QWidget()
+
+    def acquire(self):
+        if self.idle:
+            return self.idle.pop()
+        widget = self.create()
+        self.widgets.append(widget)
+        return widget
+
+    def release(self, widget):
+        widget.hide()
+        widget.setParent(self.parking)
+        self.idle.append(widget)
+
+    # For widgets deleted along with their slot
+    def discard(self, widget):
+        self.widgets.remove(widget)
+
+# A chapter's title, the summary of the chapter before it and the slots of its scenes. Views are recycled
+# between chapters like scene editors, the scene slots are only made while a chapter is in view.
 class Chapter(QFrame):
-    chapterSummaryTextResponseReady = pyqtSignal(str)
-    def __init__(self, parentStory, chapterData=None):
+    def __init__(self, parentStory):
         super().__init__()
+        self.parentStory = parentStory
+        self.slot = None
+        self.model = None
         self.setFrameShape(QFrame.Box)
         self.setLineWidth(1)
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
-        self.parentStory = parentStory
 
         title = QFormLayout()
 
         self.title = QLineEdit()
         self.title.setPlaceholderText('Chapter Title')
         self.title.setStyleSheet(exportedStylesheet)
+        self.title.textChanged.connect(self.setTitle)
         title.addRow('Chapter Title:', self.title)
 
         self.layout.addLayout(title)
@@ -245,15 +350,13 @@ class Chapter(QFrame):
         generate_previous_button = QToolButton()
         generate_previous_button.setText('Generate')
         generate_previous_button.setPopupMode(QToolButton.InstantPopup)
-        generate_menu = QMenu()
+        self.generate_menu = QMenu()
 
         # Add LLM options
-        for llm in self.parentStory.llm_manager.llms:
-            action = QAction(f'Generate with {llm.name}', self)
-            action.triggered.connect(lambda checked, llm=llm: self.generateSummary(llm))
-            generate_menu.addAction(action)
+        populateGenerateMenu(self.generate_menu, self.parentStory.llm_manager, self.generateSummary, self.showPreviousGenerations,
+                             self.cancelGeneration)
 
-        generate_previous_button.setMenu(generate_menu)
+        generate_previous_button.setMenu(self.generate_menu)
 
         summaryContainer = QWidget()
         summaryContainerLayout = QGridLayout()
@@ -266,7 +369,6 @@ class Chapter(QFrame):
 Adding a summary of the "previous chapter" to the first chapter can be useful to provide background information that may not be relevant later in the story,
 such as a description of how the characters got into the initial situation they first find themselves in.
 You can use the AI to automatically generate a summary of the previous chapter's text, but it's good to review and edit it to ensure it focuses on what you consider important.""")
-        self.chapterSummaryTextResponseReady.connect(self.updateSummaryText)
 
         self.layout.addWidget(summaryContainer)
 
@@ -288,87 +390,295 @@ You can use the AI to automatically generate a summary of the previous chapter's
 
         self.layout.addLayout(buttons)
 
-        if chapterData:
-            self.title.setText(chapterData["title"])
-            self.summary.setPlainTextAndTokens(chapterData["summary"], int(chapterData.get("summaryTokens", -1)))
-            for sceneData in chapterData["scenes"]:
-                Scene(self, sceneData)
-
-        self.parentStory.chapterLayout.addWidget(self)
-        self.parentStory.scrollContent.adjustSize()
+    def bind(self, slot, model):
+        self.slot = slot
+        self.model = model
+        self.title.setText(model.title)
+        self.summary.bind(model, 'summary')
+        for scene in model.scenes:
+            self.scenesLayout.addWidget(SceneSlot(self, scene))
+
+    # Editors of the chapter's scenes go back to the pool, the ones still busy are deleted with their slots
+    def unbind(self):
+        for slot in self.slots():
+            if slot.editor is not None:
+                self.parentStory.releaseSlot(slot, True)
+            self.scenesLayout.removeWidget(slot)
+            slot.deleteLater()
+        self.summary.unbind()
+        self.slot = None
+        self.model = None
+
+    # Views of chapters whose summary is being generated, or with a busy scene editor or the focus, stay with their chapter
+    def busy(self):
+        focused = QApplication.focusWidget()
+        if self.slot.job is not None or (focused is not None and self.isAncestorOf(focused)):
+            return True
+        return any(slot.editor is not None and slot.editor.busy() for slot in self.slots())
+
+    def setTitle(self, title):
+        if self.model is not None:
+            self.model.title = title
+
+    def slots(self):
+        return [self.scenesLayout.itemAt(i).widget() for i in range(self.scenesLayout.count())]
+
+    # Before the chapter is deleted, its scenes' generations are of no use anymore
+    def cancelSceneGenerations(self):
+        for slot in self.slots():
+            if slot.editor is not None:
+                slot.editor.cancelGeneration()
 
     def deleteChapter(self):
-        parentLayout = self.parentStory.chapterLayout
-        parentLayout.removeWidget(self)
-        self.deleteLater()
-        self.parentStory.update()
+        self.slot.deleteChapter()
 
     def addScene(self):
-        Scene(self)
+        scene = StoryScene()
+        self.model.scenes.append(scene)
+        self.scenesLayout.addWidget(SceneSlot(self, scene))
+        self.parentStory.scheduleVisibleUpdate()
+
+    def removeScene(self, scene):
+        index = self.model.scenes.index(scene)
+        slot = self.scenesLayout.itemAt(index).widget()
+        if slot.editor is not None:
+            slot.editor.cancelGeneration()
+            self.parentStory.releaseSlot(slot, True)
+        self.scenesLayout.removeWidget(slot)
+        slot.deleteLater()
+        del self.model.scenes[index]
+        self.parentStory.update()
+        self.parentStory.scheduleVisibleUpdate()
 
     def generateSummary(self, llm):
-        chapter = self
-        story = chapter.parentStory
-        chapter_index = None
-        for i in range(story.chapterLayout.count()):
-            if story.chapterLayout.itemAt(i).widget() == chapter:
-                chapter_index = i
-                break
-        if chapter_index == 0:
-            return
+        self.parentStory.summaryRegeneration.discard(self.slot)
+        self.slot.generateSummary(llm)
+
+    def cancelGeneration(self):
+        self.slot.cancelGeneration()
 
-        chapter_index = chapter_index - 1
+    def showPreviousGenerations(self):
+        self.slot.showPreviousGenerations()
 
-        print("chapter index " + str(chapter_index))
+# Holds a chapter's place in the story, the way SceneSlot does for scenes. Only chapters near the visible part
+# of the story get a view, the others show a placeholder. The chapter's summary is generated here rather than
+# in its view, so the summaries of chapters that aren't shown can be regenerated without making views for them.
+class ChapterSlot(QWidget):
+    chapterSummaryTextResponseReady = pyqtSignal(object, str, bool)
+    def __init__(self, storyWriter, model):
+        super().__init__()
+        self.storyWriter = storyWriter
+        self.model = model
+        self.view = None
+        # Unknown until the chapter has been shown, see showPlaceholder
+        self.viewHeight = None
+        self.pendingSourceHash = ''
+        self.job = None
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(self.layout)
+        self.placeholder = QLabel()
+        self.placeholder.setAlignment(Qt.AlignTop | Qt.AlignLeft)
+        self.placeholder.setStyleSheet(placeholderStylesheet)
+        self.layout.addWidget(self.placeholder)
+        self.chapterSummaryTextResponseReady.connect(self.updateSummaryText)
+        self.showPlaceholder()
+
+    def showPlaceholder(self):
+        title = self.model.title.strip() or "(untitled)"
+        self.placeholder.setText(f"Chapter: {title} - {len(self.model.scenes)} scenes")
+        self.placeholder.show()
+        height = self.viewHeight
+        if height is None:
+            height = CHAPTER_PLACEHOLDER_HEIGHT + SCENE_PLACEHOLDER_HEIGHT * len(self.model.scenes)
+        self.setFixedHeight(height)
+
+    def attach(self, view):
+        self.view = view
+        self.placeholder.hide()
+        self.setMinimumHeight(0)
+        self.setMaximumHeight(QWIDGETSIZE_MAX)
+        view.setParent(self)
+        self.layout.addWidget(view)
+        view.bind(self, self.model)
+        view.show()
+
+    def detach(self):
+        view = self.view
+        self.view = None
+        self.viewHeight = max(view.height(), 1)
+        self.layout.removeWidget(view)
+        view.unbind()
+        self.showPlaceholder()
+        return view
+
+    # Ends everything running for the chapter before it's taken out of the story
+    def dispose(self):
+        self.cancelGeneration()
+        self.storyWriter.summaryRegeneration.discard(self)
+        if self.view is not None:
+            self.view.cancelSceneGenerations()
+            self.storyWriter.chapterPool.release(self.detach())
+        self.deleteLater()
 
-        prompt = "{{[INPUT]}}\nYou are to take the role of an author writing a story. The story is titled \"" + story.title.text() + "\"."
-        if len(story.summary.toPlainText()) > 0:
-            prompt = prompt + "\nGeneral background information: " + story.summary.toPlainText()
-        if len(story.genre.text()) > 0:
-            prompt = prompt + "\n\nGenre: " + story.genre.text()
-        prompt = prompt + "\n\nThe most recent chapter of the story is:"
-        scenesLayout = story.chapterLayout.itemAt(chapter_index).widget().scenesLayout
-        for i in range(scenesLayout.count()):
-            prompt = prompt + "\n\n" + scenesLayout.itemAt(i).widget().text.toPlainText()
+    def deleteChapter(self):
+        story = self.storyWriter
+        self.dispose()
+        story.story.chapters.remove(self.model)
+        story.chapterLayout.removeWidget(self)
+        story.update()
+        story.scheduleVisibleUpdate()
+
+    # Shows the summary in the chapter's view, or puts it in the model while it has none
+    def setSummary(self, text, tokens):
+        if self.view is not None:
+            self.view.summary.setPlainTextAndTokens(text, tokens)
+        else:
+            self.model.summary = text
+            self.model.summary_tokens = tokens
 
-        prompt = prompt + "\n\n" + story.chapter_summary_prompt + "\n{{[OUTPUT]}}"
+    def generateSummary(self, llm, priority=PRIORITY_INTERACTIVE):
+        story = self.storyWriter
+        TokenizedTextEdit.commitFocused()
+        chapter_index = story.story.chapter_index(self.model)
+        if chapter_index == 0:
+            return
 
-        print(prompt)
+        # Generating again replaces a generation that's still running
+        self.cancelGeneration()
 
-        task = GenerateTask(prompt, self, llm)
-        self.parentStory.global_worker.addTask(task)
-        self.summary.setPlainTextAndTokens("Generating...", 0)
+        # This chapter's summary field holds the summary of the chapter before it
+        plan = add_chapter_summary_prompt(story.newPromptPlan(), story.story, chapter_index - 1)
+        # Remembered once the summary is in, so unchanged chapters can be skipped when regenerating
+        self.pendingSourceHash = chapter_summary_source_hash(story.story, chapter_index - 1)
+        previous = (self.model.summary, self.model.summary_tokens, self.model.summary_source_hash)
+        self.model.summary_source_hash = ''
 
-    def onResponseGenerated(self, response):
-        self.chapterSummaryTextResponseReady.emit(response)
+        self.job = GenerationJob(plan, llm, self.chapterSummaryTextResponseReady, previous, priority)
+        story.global_worker.addTask(self.job.task)
+        self.setSummary("Generating...", 0)
 
-    def updateSummaryText(self, response):
-        self.summary.setPlainText(response)
+    # Nothing is streamed into a chapter without a view, so the summary from before is put back as is
+    def cancelGeneration(self):
+        job = self.job
+        if job is None:
+            return
+        self.job = None
+        job.cancel()
+        self.storyWriter.summaryEnded(self)
+        summary, tokens, source_hash = job.previous
+        if self.view is not None:
+            self.view.summary.cancelStreamedText(summary, tokens)
+        else:
+            self.setSummary(summary, tokens)
+        if self.model.summary == summary:
+            self.model.summary_source_hash = source_hash
+
+    def showPreviousGenerations(self):
+        story = self.storyWriter
+        TokenizedTextEdit.commitFocused()
+        chapter_index = story.story.chapter_index(self.model)
+        if chapter_index == 0:
+            return
+        text = story.choosePreviousGeneration(add_chapter_summary_prompt(story.newPromptPlan(), story.story, chapter_index - 1))
+        if text is not None and self.job is None:
+            self.setSummary(text, -1)
+            # It was generated from the current prompt, or it would have been for a different one
+            self.model.summary_source_hash = chapter_summary_source_hash(story.story, chapter_index - 1)
+
+    # A chapter that gets a view while its summary is generated shows the rest of the stream
+    def updateSummaryText(self, job, response, partial):
+        if job is not self.job:
+            return
+        if self.view is not None:
+            if partial:
+                self.view.summary.appendStreamedText(response)
+                return
+            self.view.summary.finishStreamedText(response)
+        elif partial:
+            return
+        else:
+            self.setSummary(response, -1)
+        self.job = None
+        if not is_generation_error(response):
+            self.model.summary_source_hash = self.pendingSourceHash
+        self.storyWriter.summaryEnded(self)
+        # It may have been scrolled out of view meanwhile
+        self.storyWriter.scheduleVisibleUpdate()
+
+
+# Hands the chapters whose summaries are being regenerated to the online backends as they have room for them,
+# so the faster ones end up doing more. In the stable layout a summary's prompt includes the summaries before
+# it, so those are regenerated one after another, in order.
+class SummaryRegeneration:
+    def __init__(self, storyWriter, slots=(), llms=()):
+        self.storyWriter = storyWriter
+        self.pending = list(slots)
+        self.llms = list(llms)
+        # Slot -> the LLM generating its summary
+        self.running = {}
+        self.sequential = storyWriter.story.prompt_layout == LAYOUT_STABLE
+
+    def load(self, llm):
+        return sum(1 for other in self.running.values() if other is llm)
+
+    def fill(self):
+        for llm in self.llms:
+            while self.pending and llm.online and self.load(llm) < max(llm.max_concurrency, 1):
+                if self.sequential and self.running:
+                    return
+                slot = self.pending.pop(0)
+                self.running[slot] = llm
+                # Scenes generated meanwhile go first
+                slot.generateSummary(llm, PRIORITY_BACKGROUND)
+
+    def ended(self, slot):
+        if self.running.pop(slot, None) is not None:
+            self.fill()
+
+    # For chapters deleted meanwhile, or generated on their own
+    def discard(self, slot):
+        if slot in self.pending:
+            self.pending.remove(slot)
+        if self.running.pop(slot, None) is not None:
+            self.fill()
+
+    def cancel(self):
+        self.pending = []
+        self.running = {}
 
 
 def sanitize_filename(filename):
     return re.sub(r'(?u)[^-\w.]', '_', filename)
 
 class StoryWriter(QMainWindow):
+    exportProgress = pyqtSignal(int, int)
+    exportFinished = pyqtSignal(str, str)
     def __init__(self):
         super().__init__()
 
         self.setWindowTitle('Story Writer')
         self.resize(800, 600)
 
-        self.storytitle = ""
-        self.summary = ""
-
-        # Worker thread
-        self.global_worker = Worker()
-        self.global_worker.moveToThread(global_thread)
-        global_thread.started.connect(self.global_worker.processNextTask)
-        self.global_worker.finished.connect(global_thread.quit)
+        # The story being edited, the chapter and scene widgets are views of it
+        self.story = Story()
+        # Set once the story has been saved or loaded, edits are then journaled to that file
+        self.journal = None
 
-        # LLM Manager
+        # LLM Manager, backends are checked in the background and show up in the menus as they come online
         self.llm_manager = LLMManager()
+        self.llmStatusLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.llmStatusLabel)
+        self.llm_manager.llmStatusChanged.connect(self.updateLLMStatus)
+        # How the last generation went, and how many tasks are waiting
+        self.metricsLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.metricsLabel)
+        self.llm_manager.metricsRecorded.connect(self.showMetrics)
         self.llm_manager.load_llm_config()
 
+        # Tasks run on per-backend thread pools, with separate lanes for token counts and generations
+        self.global_worker = TaskExecutor(self.llm_manager)
+
         # Create a menu bar
         menubar = QMenuBar(self)
         self.setMenuBar(menubar)
@@ -378,6 +688,7 @@ class StoryWriter(QMainWindow):
         new_action = QAction("New", self)
         load_action = QAction("Load", self)
         save_action = QAction("Save", self)
+        save_as_action = QAction("Save As...", self)
         export_action = QAction("Export", self)
         llm_settings_action = QAction("LLM Settings", self)
         exit_action = QAction("Exit", self)
@@ -386,6 +697,7 @@ class StoryWriter(QMainWindow):
         file_menu.addAction(new_action)
         file_menu.addAction(load_action)
         file_menu.addAction(save_action)
+        file_menu.addAction(save_as_action)
         file_menu.addAction(export_action)
         file_menu.addAction(llm_settings_action)
         file_menu.addAction(exit_action)
@@ -398,6 +710,8 @@ class StoryWriter(QMainWindow):
         settings_menu.addAction(new_chapter_action)
         story_objects_action = QAction('Story Objects', self)
         settings_menu.addAction(story_objects_action)
+        regenerate_summaries_action = QAction('Regenerate all chapter summaries', self)
+        settings_menu.addAction(regenerate_summaries_action)
 
         # Create main layout
         layout = QVBoxLayout()
@@ -412,6 +726,16 @@ class StoryWriter(QMainWindow):
         self.scrollArea.setWidget(self.scrollContent)
         self.scrollArea.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Expanding)
 
+        # Chapter views and scene editors are only created for the chapters and scenes around the visible part of the story
+        self.chapterPool = WidgetPool(lambda: Chapter(self))
+        self.scenePool = WidgetPool(lambda: Scene(self))
+        self.visibleTimer = QTimer(self)
+        self.visibleTimer.setSingleShot(True)
+        self.visibleTimer.setInterval(VISIBLE_UPDATE_DELAY)
+        self.visibleTimer.timeout.connect(self.updateVisibleScenes)
+        self.scrollArea.verticalScrollBar().valueChanged.connect(self.scheduleVisibleUpdate)
+        self.summaryRegeneration = SummaryRegeneration(self)
+
         layout.addWidget(self.scrollArea)
 
         # Set main layout
@@ -423,130 +747,280 @@ class StoryWriter(QMainWindow):
         new_action.triggered.connect(self.newStory)
         load_action.triggered.connect(self.loadStory)
         save_action.triggered.connect(self.saveStory)
+        save_as_action.triggered.connect(self.saveStoryAs)
         export_action.triggered.connect(self.exportStory)
         llm_settings_action.triggered.connect(self.open_llm_settings)
         exit_action.triggered.connect(self.quit_app)
         settings_action.triggered.connect(self.open_settings)
         new_chapter_action.triggered.connect(self.addChapter)
         story_objects_action.triggered.connect(self.open_story_objects)
+        regenerate_summaries_action.triggered.connect(self.regenerateChapterSummaries)
         self.closeEvent = self.quit_app
+        self.exportProgress.connect(self.showExportProgress)
+        self.exportFinished.connect(self.showExportFinished)
 
-        # Initialize default prompts
-        self.chapter_summary_prompt = "Please summarize this chapter in 200 words or less, focusing on the information that's important for writing future scenes in this story."
-        self.scene_generation_prompt = "Please write out this scene."
+        self.autosaveTimer = QTimer(self)
+        self.autosaveTimer.setInterval(AUTOSAVE_INTERVAL)
+        self.autosaveTimer.timeout.connect(self.autosave)
+        self.autosaveTimer.start()
 
-        # Initialize story objects
-        self.story_objects = []
+        self.updateLLMStatus()
 
     def open_llm_settings(self):
         dialog = LLMSettingsDialog(self)
         if dialog.exec_():
             self.llm_manager.save_llm_config()
-            # Update generate menus in scenes and chapters
-            for i in range(self.chapterLayout.count()):
-                chapter = self.chapterLayout.itemAt(i).widget()
-                # Update chapter generate menus
-                #generate_menu = chapter.layout.itemAt(2).itemAt(1).widget().menu()
-                generate_menu.clear()
-                for llm in self.llm_manager.llms:
-                    action = QAction(f'Generate with {llm.name}', self)
-                    action.triggered.connect(lambda checked, llm=llm: chapter.generateSummary(llm))
-                    generate_menu.addAction(action)
-                # Update scenes generate menus
-                for j in range(chapter.scenesLayout.count()):
-                    scene = chapter.scenesLayout.itemAt(j).widget()
-                    generate_menu = scene.generate_menu
-                    generate_menu.clear()
-                    for llm in self.llm_manager.llms:
-                        action = QAction(f'Generate with {llm.name}', self)
-                        action.triggered.connect(lambda checked, llm=llm: scene.generateScene(llm))
-                        generate_menu.addAction(action)
+            # Unchanged LLMs keep their status, they may be busy generating
+            self.llm_manager.check_connections(dialog.new_llms)
+            self.updateLLMStatus()
+
+    # Called whenever a backend's connection status changes
+    def updateLLMStatus(self, llm=None):
+        if llm is not None and llm.online and self.story.chapters:
+            self.primeCache([llm])
+        self.llmStatusLabel.setText(" | ".join(f"{llm.name}: {llm.status}" for llm in self.llm_manager.llms))
+        # Update generate menus in scenes and chapters
+        for chapter in self.chapterPool.widgets:
+            populateGenerateMenu(chapter.generate_menu, self.llm_manager, chapter.generateSummary, chapter.showPreviousGenerations,
+                                 chapter.cancelGeneration)
+        for scene in self.scenePool.widgets:
+            populateGenerateMenu(scene.generate_menu, self.llm_manager, scene.generateScene, scene.showPreviousGenerations,
+                                 scene.cancelGeneration)
+
+    def scheduleVisibleUpdate(self):
+        self.visibleTimer.start()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.scheduleVisibleUpdate()
+
+    def chapterSlots(self):
+        return [self.chapterLayout.itemAt(i).widget() for i in range(self.chapterLayout.count())]
+
+    # Gives the chapter and scene slots near the viewport a view or editor and takes them back from the others.
+    # The scenes of a chapter that just got its view are looked at in the next pass, once it has been laid out.
+    def updateVisibleScenes(self):
+        top = self.scrollArea.verticalScrollBar().value()
+        height = self.scrollArea.viewport().height()
+        low = top - height * VISIBLE_MARGIN
+        high = top + height * (1 + VISIBLE_MARGIN)
+        def near(slot):
+            y = slot.mapTo(self.scrollContent, QPoint(0, 0)).y()
+            return y + slot.height() >= low and y <= high
+        chapters = []
+        scenes = []
+        for chapter in self.chapterSlots():
+            if near(chapter):
+                if chapter.view is None:
+                    chapters.append(chapter)
+            elif chapter.view is not None:
+                self.releaseChapter(chapter)
+            if chapter.view is None:
+                continue
+            for slot in chapter.view.slots():
+                if near(slot):
+                    if slot.editor is None:
+                        scenes.append(slot)
+                elif slot.editor is not None:
+                    self.releaseSlot(slot)
+        for chapter in chapters:
+            chapter.attach(self.chapterPool.acquire())
+        for slot in scenes:
+            slot.attach(self.scenePool.acquire())
+        # Views and editors take up different heights than placeholders, so check again once the layout has settled
+        if chapters or scenes:
+            self.scheduleVisibleUpdate()
+
+    # Takes a chapter's view back into the pool, along with its scenes' editors, unless it's busy
+    def releaseChapter(self, slot):
+        if not slot.view.busy():
+            self.chapterPool.release(slot.detach())
+
+    # Takes a slot's editor back into the pool. Busy editors stay, unless the slot is being deleted,
+    # in which case the editor goes with it.
+    def releaseSlot(self, slot, deleting=False):
+        if slot.editor.busy():
+            if deleting:
+                self.scenePool.discard(slot.editor)
+            return
+        self.scenePool.release(slot.detach())
+
+    def newPromptPlan(self):
+        return new_prompt_plan(self.story, self.llm_manager.token_cache, self.llm_manager.get_token_count_llm())
+
+    # Lets the user pick one of the responses the online LLMs generated for a plan's prompt before.
+    # Returns the chosen text, or None.
+    def choosePreviousGeneration(self, plan):
+        responses = []
+        for llm in self.llm_manager.llms:
+            if llm.online:
+                prompt = plan.build(llm, DEFAULT_MAX_LENGTH)
+                responses += [(generated, llm.name, text) for generated, text
+                              in self.llm_manager.generation_cache.get(llm, prompt, DEFAULT_MAX_LENGTH)]
+        if not responses:
+            QMessageBox.information(self, "Previous generations", "Nothing has been generated for this prompt yet.")
+            return None
+        responses.sort(key=lambda response: response[0], reverse=True)
+        dialog = GenerationHistoryDialog(self, responses)
+        if dialog.exec_():
+            return dialog.selected_text()
+        return None
+
+    # Sends the stable prefix of the last chapter's scene prompts to backends that can cache it
+    def primeCache(self, llms=None):
+        if not self.story.prime_cache or self.story.prompt_layout != LAYOUT_STABLE or not self.story.chapters:
+            return
+        plan = add_story_prefix(self.newPromptPlan(), self.story, len(self.story.chapters) - 1)
+        for llm in (self.llm_manager.llms if llms is None else llms):
+            if llm.online and llm.supports_prefix_cache:
+                self.global_worker.addTask(PrimeCacheTask(plan.stable_prefix(), llm))
 
     def open_settings(self):
         dialog = SettingsDialog(self)
-        dialog.set_chapter_summary_prompt(self.chapter_summary_prompt)
-        dialog.set_scene_generation_prompt(self.scene_generation_prompt)
+        dialog.set_chapter_summary_prompt(self.story.chapter_summary_prompt)
+        dialog.set_scene_generation_prompt(self.story.scene_generation_prompt)
+        dialog.set_prompt_trim_order(self.story.prompt_trim_order)
+        dialog.set_prompt_layout(self.story.prompt_layout)
+        dialog.set_prime_cache(self.story.prime_cache)
+        dialog.set_retrieved_passages(self.story.retrieved_passages)
         if dialog.exec_():
-            self.chapter_summary_prompt = dialog.get_chapter_summary_prompt()
-            self.scene_generation_prompt = dialog.get_scene_generation_prompt()
+            self.story.chapter_summary_prompt = dialog.get_chapter_summary_prompt()
+            self.story.scene_generation_prompt = dialog.get_scene_generation_prompt()
+            self.story.prompt_trim_order = dialog.get_prompt_trim_order()
+            self.story.prompt_layout = dialog.get_prompt_layout()
+            self.story.prime_cache = dialog.get_prime_cache()
+            self.story.retrieved_passages = dialog.get_retrieved_passages()
 
     def newStory(self):
         # TODO remove old to create a new story
         pass
 
+    def showMetrics(self, record):
+        if record['kind'] == GENERATE:
+            self.metricsLabel.setText(f"{describe(record)} | {self.global_worker.pending()} queued")
+
     def quit_app(self, event=None):
+        if self.journal is not None:
+            TokenizedTextEdit.commitFocused()
+            self.journal.flush()
+        self.llm_manager.token_cache.save()
+        self.llm_manager.close()
         sys.exit()
 
+    # Regenerates the summaries that are out of date on every online backend, see SummaryRegeneration.
+    # Summaries whose prompt hasn't changed since they were generated, and ones written by hand, are left alone.
+    def regenerateChapterSummaries(self):
+        TokenizedTextEdit.commitFocused()
+        llms = [llm for llm in self.llm_manager.llms if llm.online]
+        if not llms:
+            QMessageBox.information(self, "Regenerate summaries", "No LLM is online.")
+            return
+        self.summaryRegeneration.cancel()
+        stale = []
+        unchanged = 0
+        handwritten = 0
+        for i, chapter in enumerate(self.chapterSlots()):
+            if i == 0 or chapter.job is not None:
+                continue
+            if self.story.summary_is_handwritten(i):
+                handwritten += 1
+            elif self.story.summary_is_current(i):
+                unchanged += 1
+            else:
+                stale.append(chapter)
+        self.summaryRegeneration = SummaryRegeneration(self, stale, llms)
+        self.summaryRegeneration.fill()
+        self.statusBar().showMessage(f"Regenerating {len(stale)} chapter summaries on {len(llms)} LLMs, {unchanged} unchanged, "
+                                     f"{handwritten} written by hand", 5000)
+
+    def summaryEnded(self, slot):
+        self.summaryRegeneration.ended(slot)
+
     def addChapter(self):
-        Chapter(self)
+        chapter = StoryChapter()
+        self.story.chapters.append(chapter)
+        self.chapterLayout.addWidget(ChapterSlot(self, chapter))
+        self.scrollContent.adjustSize()
+        self.scheduleVisibleUpdate()
 
     def loadStory(self):
         file_dialog = QFileDialog()
-        file_path, _ = file_dialog.getOpenFileName()
+        file_path, _ = file_dialog.getOpenFileName(self, "Load Story", "", STORY_FILE_FILTER)
         if not file_path:
             return
-        jsonData = None
-        with open(file_path, "r") as f:
-            jsonData = json.load(f)
-        if jsonData is None:
-            return
-        if self.chapter_summary_prompt is not None:
-            self.chapter_summary_prompt = jsonData.get("chapter_summary_prompt", self.chapter_summary_prompt)
-        if self.scene_generation_prompt is not None:
-            self.scene_generation_prompt = jsonData.get("scene_generation_prompt", self.scene_generation_prompt)
-        self.summary = jsonData.get("summary", "")
-        self.storytitle = jsonData["title"]
-        for widget in self.scrollContent.findChildren(QWidget):
-            widget.deleteLater()
+        if self.journal is not None:
+            TokenizedTextEdit.commitFocused()
+            self.saveJournal()
+        self.story = load_story(file_path)
+        self.journal = StoryJournal(self.story, file_path, loaded=True)
+        self.summaryRegeneration.cancel()
+        while self.chapterLayout.count():
+            self.chapterLayout.takeAt(0).widget().dispose()
         self.chapterLayout.update()
-        for chapterData in jsonData["chapters"]:
-            Chapter(self, chapterData)
-
+        for chapter in self.story.chapters:
+            self.chapterLayout.addWidget(ChapterSlot(self, chapter))
+        self.scrollContent.adjustSize()
+        self.scheduleVisibleUpdate()
+        self.primeCache()
+
+    # Only what changed since the last save is written, on the save lane. A loaded story is saved back to
+    # its file, a new one to a file named after its title.
     def saveStory(self):
-        filename = sanitize_filename(self.storytitle.text())
-        jsonData = {}
-        jsonData["title"] = self.storytitle.text()
-        jsonData["chapter_summary_prompt"] = self.chapter_summary_prompt
-        jsonData["scene_generation_prompt"] = self.scene_generation_prompt
-        jsonData["summary"] = self.summary
-        jsonData["chapters"] = []
-        for i in range(self.chapterLayout.count()):
-            chapter = self.chapterLayout.itemAt(i).widget()
-            chapterData = {}
-            jsonData["chapters"].append(chapterData)
-            chapterData["title"] = chapter.title.text()
-            chapterData["summary"] = chapter.summary.toPlainText()
-            chapterData["summaryTokens"] = chapter.summary.tokenCount
-            chapterData["scenes"] = []
-            for i in range(chapter.scenesLayout.count()):
-                scene = chapter.scenesLayout.itemAt(i).widget()
-                sceneData = {}
-                chapterData["scenes"].append(sceneData)
-                sceneData["summary"] = scene.summary.toPlainText()
-                sceneData["summaryTokens"] = scene.summary.tokenCount
-                sceneData["text"] = scene.text.toPlainText()
-                sceneData["textTokens"] = scene.text.tokenCount
-
-        with open(filename + ".json", "w") as f:
-            f.write(json.dumps(jsonData))
-
+        TokenizedTextEdit.commitFocused()
+        if self.journal is None:
+            self.journal = StoryJournal(self.story, sanitize_filename(self.story.title) + ".json")
+        self.saveJournal()
+
+    # Also converts between the formats: .story files are compact and load scene texts on demand
+    def saveStoryAs(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Story As", sanitize_filename(self.story.title) + PACK_SUFFIX,
+                                                   STORY_FILE_FILTER)
+        if not file_path:
+            return
+        TokenizedTextEdit.commitFocused()
+        if self.journal is not None:
+            self.saveJournal()
+        self.journal = StoryJournal(self.story, file_path)
+        self.saveJournal()
+
+    def autosave(self):
+        if self.journal is not None:
+            TokenizedTextEdit.commitFocused()
+            self.saveJournal()
+
+    def saveJournal(self):
+        if self.journal.save():
+            self.global_worker.addTask(SaveTask(self.journal))
+
+    # Exports on a background thread, the format is picked by the file's extension
     def exportStory(self):
-        filename = sanitize_filename(self.storytitle.text())
-        with open(filename + ".txt", "w") as f:
-            f.write(self.storytitle.text())
-            f.write("\n\n")
-            for i in range(self.chapterLayout.count()):
-                chapter = self.chapterLayout.itemAt(i).widget()
-                f.write(chapter.title.text())
-                f.write("\n")
-                f.write("="*len(chapter.title.text()))
-                f.write("\n\n")
-                for i in range(chapter.scenesLayout.count()):
-                    scene = chapter.scenesLayout.itemAt(i).widget()
-                    f.write(scene.text.toPlainText())
-                    f.write("\n\n")
-
-
+        filters = ";;".join(f"{writer.name} (*{extension})" for extension, writer in EXPORT_WRITERS.items())
+        file_path, selected = QFileDialog.getSaveFileName(self, "Export Story", sanitize_filename(self.story.title) + ".txt", filters)
+        if not file_path:
+            return
+        extension = next((extension for extension, writer in EXPORT_WRITERS.items() if selected.startswith(writer.name)), '.txt')
+        if not file_path.lower().endswith(tuple(EXPORT_WRITERS)):
+            file_path += extension
+        TokenizedTextEdit.commitFocused()
+        self.statusBar().showMessage(f"Exporting to {file_path}...")
+        self.global_worker.addTask(ExportTask(snapshot_story(self.story), file_path, self))
+
+    # Called from the export's thread
+    def onExportProgress(self, done, total):
+        self.exportProgress.emit(done, total)
+
+    def onExportFinished(self, path, error):
+        self.exportFinished.emit(path, error)
+
+    def showExportProgress(self, done, total):
+        self.statusBar().showMessage(f"Exporting... {done}/{total} scenes")
+
+    def showExportFinished(self, path, error):
+        if error:
+            self.statusBar().clearMessage()
+            QMessageBox.warning(self, "Export failed", f"Couldn't export to {path}:\n{error}")
+        else:
+            self.statusBar().showMessage(f"Exported to {path}", 5000)
 
     def open_story_objects(self):
         dialog = StoryObjectDialog(self)
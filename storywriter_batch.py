@@ -0,0 +1,228 @@
+# Generates a saved story without the GUI: every empty scene, in order, and the chapter summaries
+# those scenes' prompts need. Prompts are built by the same rules as generating from the editor.
+# Every generation is saved to the story's journal right away, so an interrupted run picks up where it stopped.
+#
+#   python storywriter_batch.py MyStory.json --llm Kobold
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from src.llm import GenerateTask, DEFAULT_MAX_LENGTH, is_generation_error
+from src.llm_base import LLMBase
+from src.prompt import new_prompt_plan, add_scene_prompt, add_chapter_summary_prompt, chapter_summary_source_hash
+from src.storyjournal import StoryJournal
+from src.storymodel import load_story
+from src.tokencache import TokenCountCache
+from src.generationcache import GenerationCache
+from src.telemetry import Telemetry
+
+# Left in a scene or summary by a generation that was interrupted in the editor
+PLACEHOLDER = "Generating..."
+
+# Collects a GenerateTask's response, and when its first text arrived
+class BatchResult:
+    def __init__(self, echo=False):
+        self.echo = echo
+        self.start = time.monotonic()
+        self.first_token = None
+        self.text = ""
+
+    def onResponseGenerated(self, response, partial):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+        if partial:
+            if self.echo:
+                sys.stdout.write(response)
+                sys.stdout.flush()
+        else:
+            self.text = response
+
+    def failed(self):
+        return is_generation_error(self.text)
+
+
+def is_empty(text):
+    return not text.strip() or text.strip() == PLACEHOLDER
+
+def load_llms(config_path):
+    with open(config_path, 'r') as f:
+        data = json.load(f)
+    llms = []
+    for llm_data in data.get('llms', []):
+        llm_data.setdefault('type', 'Kobold')
+        try:
+            llms.append(LLMBase.create_llm(llm_data))
+        except ValueError as e:
+            print(f"Skipping LLM {llm_data.get('name')}: {e}", file=sys.stderr)
+    return llms, data.get('token_count_llm_name')
+
+
+class BatchGenerator:
+    def __init__(self, story, journal, llm, token_cache, count_llm, max_length, overwrite, echo, generation_cache=None, replay=False,
+                 telemetry=None):
+        self.story = story
+        self.journal = journal
+        self.llm = llm
+        self.token_cache = token_cache
+        self.count_llm = count_llm
+        self.max_length = max_length
+        self.overwrite = overwrite
+        self.echo = echo
+        self.generation_cache = generation_cache
+        self.replay = replay
+        # Records every generation in metrics.jsonl, like the editor does
+        self.telemetry = telemetry
+        self.generated = 0
+        self.failed = 0
+        self.total_tokens = 0
+        self.total_time = 0.0
+        # Whether any of the tokens added up were only estimated
+        self.estimated = False
+
+    def run(self, chapters, summaries=True, scenes=True):
+        for chapter_index in chapters:
+            chapter = self.story.chapters[chapter_index]
+            # A chapter's summary field holds the summary of the chapter before it, which its scene prompts include
+            if summaries and chapter_index > 0 and (self.overwrite or is_empty(chapter.summary)):
+                previous = self.story.chapters[chapter_index - 1]
+                if any(not is_empty(scene.text) for scene in previous.scenes):
+                    plan = add_chapter_summary_prompt(self.newPlan(), self.story, chapter_index - 1)
+                    source_hash = chapter_summary_source_hash(self.story, chapter_index - 1)
+                    if self.generate(plan, chapter, 'summary', f"chapter {chapter_index + 1} summary"):
+                        chapter.summary_source_hash = source_hash
+                        self.journal.flush()
+            if not scenes:
+                continue
+            for scene_index, scene in enumerate(chapter.scenes):
+                if not (self.overwrite or is_empty(scene.text)):
+                    continue
+                if is_empty(scene.summary):
+                    print(f"chapter {chapter_index + 1} scene {scene_index + 1}: no summary, skipped")
+                    continue
+                plan = add_scene_prompt(self.newPlan(), self.story, chapter_index, scene_index)
+                self.generate(plan, scene, 'text', f"chapter {chapter_index + 1} scene {scene_index + 1}")
+
+    def newPlan(self):
+        return new_prompt_plan(self.story, self.token_cache, self.count_llm)
+
+    # Runs one generation into obj.<attr>, then saves the story. Returns whether it succeeded.
+    def generate(self, plan, obj, attr, label):
+        print(f"{label}: generating with {self.llm.name}...")
+        result = BatchResult(self.echo)
+        task = GenerateTask(plan, result, self.llm, self.max_length, self.generation_cache, self.replay,
+                            telemetry=self.telemetry)
+        try:
+            task.execute()
+        except KeyboardInterrupt:
+            # Otherwise the backend carries on generating after we're gone
+            task.cancel()
+            raise
+        elapsed = time.monotonic() - result.start
+        if self.echo and self.llm.stream:
+            print()
+        if result.failed():
+            self.failed += 1
+            print(f"{label}: failed after {elapsed:.1f}s: {result.text.strip()[-200:]}", file=sys.stderr)
+            return False
+        tokens = self.llm.count_tokens(result.text)
+        setattr(obj, attr, result.text)
+        # The editor shows counts by the token count LLM, so only those are kept in the story
+        setattr(obj, attr + '_tokens', tokens if self.llm is self.count_llm else -1)
+        if tokens >= 0:
+            self.token_cache.put(self.llm, result.text, tokens)
+        self.journal.flush()
+
+        self.generated += 1
+        self.total_time += elapsed
+        first_token = f", first text after {result.first_token - result.start:.1f}s" if result.first_token else ""
+        # What the generation itself came to, as the backend reported it or its stream or a local tokenizer counted it.
+        # Otherwise the count above, which without a local tokenizer is only an estimate for some backends.
+        generated = task.record.get('completion_tokens') if task.record else None
+        estimated = False
+        if not generated:
+            generated = tokens
+            estimated = not self.llm.counts_exactly()
+        if generated > 0:
+            self.total_tokens += generated
+            self.estimated = self.estimated or estimated
+            about = "~" if estimated else ""
+            print(f"{label}: {about}{generated} tokens in {elapsed:.1f}s "
+                  f"({about}{generated / elapsed:.1f} tokens/s{first_token}{', estimated' if estimated else ''})")
+        else:
+            print(f"{label}: done in {elapsed:.1f}s{first_token}")
+        return True
+
+    def report(self):
+        if not self.generated:
+            print(f"Nothing generated, {self.failed} failed")
+            return
+        about = "~" if self.estimated else ""
+        rate = f", {about}{self.total_tokens / self.total_time:.1f} tokens/s" if self.total_tokens and self.total_time else ""
+        print(f"Generated {self.generated} ({self.failed} failed): {about}{self.total_tokens} tokens in {self.total_time:.1f}s, "
+              f"{self.total_time / self.generated:.1f}s each{rate}{' (includes estimates)' if self.estimated else ''}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the empty scenes and missing chapter summaries of a saved story.")
+    parser.add_argument('story', help="story JSON file saved by Story Writer")
+    parser.add_argument('--llm', help="name of the LLM to generate with, defaults to the first one configured")
+    parser.add_argument('--config', default='llm_config.json', help="LLM configuration (default: %(default)s)")
+    parser.add_argument('--output', help="where to save the story, defaults to overwriting the input file")
+    parser.add_argument('--chapter', type=int, action='append', help="only generate this chapter (1-based), may be repeated")
+    parser.add_argument('--max-length', type=int, default=DEFAULT_MAX_LENGTH, help="tokens to generate per task (default: %(default)s)")
+    parser.add_argument('--overwrite', action='store_true', help="regenerate scenes and summaries that already have text")
+    parser.add_argument('--no-summaries', action='store_true', help="don't generate chapter summaries")
+    parser.add_argument('--no-scenes', action='store_true', help="only generate chapter summaries")
+    parser.add_argument('--replay', action='store_true', help="reuse the earlier response to a prompt that was generated before")
+    parser.add_argument('--echo', action='store_true', help="print generated text as it streams in")
+    args = parser.parse_args(argv)
+
+    try:
+        llms, token_count_llm_name = load_llms(args.config)
+    except FileNotFoundError:
+        parser.error(f"LLM configuration {args.config} not found, set up an LLM in Story Writer first")
+    if not llms:
+        parser.error("no LLMs are configured")
+    llm = llms[0] if args.llm is None else next((llm for llm in llms if llm.name == args.llm), None)
+    if llm is None:
+        parser.error(f"no LLM named {args.llm}, configured: " + ", ".join(llm.name for llm in llms))
+    if not llm.test_connection():
+        print(f"Can't connect to {llm.name} at {llm.address}", file=sys.stderr)
+        return 1
+    count_llm = next((other for other in llms if other.name == token_count_llm_name), None)
+    if count_llm is not None and count_llm is not llm:
+        count_llm.test_connection()
+
+    story = load_story(args.story)
+    chapters = range(len(story.chapters))
+    if args.chapter:
+        chapters = [index - 1 for index in args.chapter if 0 < index <= len(story.chapters)]
+
+    token_cache = TokenCountCache()
+    token_cache.load()
+    generation_cache = GenerationCache()
+    generation_cache.load()
+    telemetry = Telemetry()
+    output = args.output or args.story
+    journal = StoryJournal(story, output, loaded=os.path.abspath(output) == os.path.abspath(args.story))
+    generator = BatchGenerator(story, journal, llm, token_cache, count_llm, args.max_length, args.overwrite, args.echo,
+                               generation_cache, args.replay, telemetry)
+    start = time.monotonic()
+    try:
+        generator.run(chapters, summaries=not args.no_summaries, scenes=not args.no_scenes)
+    except KeyboardInterrupt:
+        print("\nInterrupted, everything generated so far has been saved", file=sys.stderr)
+        return 130
+    finally:
+        token_cache.save()
+        telemetry.close()
+        generator.report()
+        print(f"Wall time {time.monotonic() - start:.1f}s")
+    return 1 if generator.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())